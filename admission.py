@@ -0,0 +1,128 @@
+import math
+import threading
+import time
+
+from werkzeug.wsgi import ClosingIterator
+
+from cache import TTLCache
+from metrics import admission_in_flight, admission_over_budget, admission_rejected
+from sms_dispatch import TokenBucket
+
+# --- Admission control ---
+# Each route class (SMS webhook, interactive pages/APIs, OTP) gets its own budget of concurrent
+# requests and a short wait queue in front of it. A request that finds both full is answered
+# right away with a 503 and Retry-After instead of holding a waitress thread while it waits.
+# So a reply spike that slows Firestore can use up the webhook budget, but not the threads that
+# serve /calendar or /login. Keep the sum of all budgets and queues below the server's thread count.
+# Classes whose callers never retry (Twilio doesn't retry its webhooks) are not shed: when full,
+# their requests run anyway, flagged so the app can take a cheaper path than the normal one.
+
+
+class ConcurrencyLimiter:
+    """At most max_concurrent holders; up to max_queue more callers wait up to queue_timeout seconds."""
+
+    def __init__(self, name, max_concurrent, max_queue=0, queue_timeout=1.0):
+        if max_concurrent < 1:
+            raise ValueError("ConcurrencyLimiter needs max_concurrent >= 1.")
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self._active = 0
+        self._waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Takes a slot, waiting in the queue if there's room. Returns False if the request should be shed."""
+        with self._condition:
+            if self._active >= self.max_concurrent:
+                if self._waiting >= self.max_queue:
+                    return False
+                self._waiting += 1
+                try:
+                    deadline = time.monotonic() + self.queue_timeout
+                    while self._active >= self.max_concurrent:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return False
+                        self._condition.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._active += 1
+            admission_in_flight.set(self._active, route_class=self.name)
+            return True
+
+    def release(self):
+        with self._condition:
+            self._active -= 1
+            admission_in_flight.set(self._active, route_class=self.name)
+            self._condition.notify()
+
+    def stats(self):
+        with self._condition:
+            return {'active': self._active, 'waiting': self._waiting,
+                    'max_concurrent': self.max_concurrent, 'max_queue': self.max_queue}
+
+
+class AdmissionControl:
+    """
+    WSGI middleware that runs each request under its route class's ConcurrencyLimiter.
+    classify(method, path) returns the class name, or None for requests that are never limited
+    (e.g. /metrics and static files). The slot is held until the response has been sent, so
+    streamed responses count for as long as they stream. Requests of a class in never_shed that
+    find it full run without a slot, with environ[OVER_BUDGET_KEY] set, instead of getting a 503.
+    """
+
+    OVER_BUDGET_KEY = 'admission.over_budget'
+
+    def __init__(self, wsgi_app, limiters, classify, retry_after_seconds=1.0, never_shed=()):
+        self.wsgi_app = wsgi_app
+        self.limiters = limiters
+        self.classify = classify
+        self.retry_after = str(max(1, math.ceil(retry_after_seconds)))
+        self.never_shed = frozenset(never_shed)
+
+    def __call__(self, environ, start_response):
+        limiter = self.limiters.get(self.classify(environ.get('REQUEST_METHOD', 'GET'), environ.get('PATH_INFO', '')))
+        if limiter is None:
+            return self.wsgi_app(environ, start_response)
+        if not limiter.acquire():
+            if limiter.name in self.never_shed:
+                admission_over_budget.inc(route_class=limiter.name)
+                environ[self.OVER_BUDGET_KEY] = True
+                return self.wsgi_app(environ, start_response)
+            admission_rejected.inc(route_class=limiter.name)
+            body = b"Service busy, please retry shortly.\n"
+            start_response('503 Service Unavailable', [('Content-Type', 'text/plain; charset=utf-8'),
+                                                       ('Content-Length', str(len(body))),
+                                                       ('Retry-After', self.retry_after)])
+            return [body]
+        try:
+            app_iter = self.wsgi_app(environ, start_response)
+        except BaseException:
+            limiter.release()
+            raise
+        return ClosingIterator(app_iter, limiter.release)
+
+
+class KeyedRateLimiter:
+    """
+    A token bucket per key (e.g. per phone number): 'burst' requests at once, then one every
+    refill_seconds. Idle buckets are dropped once they would have refilled, so memory is bounded
+    by the keys seen recently (up to max_keys).
+    """
+
+    def __init__(self, burst, refill_seconds, max_keys=10000):
+        self.burst = burst
+        self.refill_seconds = refill_seconds
+        self._buckets = TTLCache(maxsize=max_keys, ttl=burst * refill_seconds)
+        self._lock = threading.Lock()
+
+    def try_acquire(self, key):
+        """Takes a token for 'key'. Returns True if the request is allowed."""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(1.0 / self.refill_seconds, capacity=self.burst)
+            self._buckets.set(key, bucket) # Also restarts the idle timer
+        return bucket.try_acquire()
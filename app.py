@@ -1,230 +1,333 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
-from flask_login import LoginManager, login_user, logout_user, current_user, login_required, UserMixin # UserMixin for our custom Firebase user
-from datetime import datetime, date, timedelta, timezone # timedelta is needed for OTP expiration
-from waitress import serve
+from flask import (Flask, Blueprint, Response, current_app, render_template, request, redirect, url_for, flash, session, jsonify, g,
+                   has_app_context, make_response, stream_with_context)
+from flask_login import LoginManager, login_user, logout_user, current_user, login_required
+from markupsafe import Markup
+from datetime import datetime, date, timedelta, timezone
 import re
 import os
-from apscheduler.schedulers.background import BackgroundScheduler
 import click
-import random # For OTP generation
-from datetime import datetime
+import secrets # For OTP generation
+import itertools
+import json
 import logging
+import signal
+import sys
+import time
 import pytz
 
 # Set the timezone to 'America/Los_Angeles'
 cronjob_timezone = pytz.timezone('America/Los_Angeles')
 
-# Firebase Admin SDK
-import firebase_admin
-from firebase_admin import credentials, auth as firebase_auth, firestore
-
-# Import configurations and SMS handling functions
+# Import configurations and SMS handling functions (config.py loads .env)
 from config import Config
-from sms_handler import send_sms, send_daily_mood_prompt_sms, format_phone_to_e164 # Removed send_otp_sms, handled in-app
+from sms_handler import send_daily_mood_prompt_sms, format_phone_to_e164, DAILY_MOOD_PROMPT_TEXT # Removed send_otp_sms, handled in-app
+from sms_queue import enqueue_sms, get_outbound_queue, get_sender_limiter, PRIORITY_OTP, PRIORITY_WELCOME, PRIORITY_PROMPT
+from sms_dispatch import dispatch_concurrently
+from cache import TTLCache, SizedTTLCache
+from emoji_parser import parse_mood_response
+from otp_store import create_otp_store
+from write_behind import SQLiteSpool, WriteBehindBuffer
+from mood_rollups import month_key, build_month_rollup
+from storage import create_repository, UserNotFoundError
+from scheduler_shards import ShardedRun, bucket_range, create_lease_store
+from prompt_schedule import parse_prompt_time, format_prompt_time, is_valid_timezone, default_local_minute, slot_for_profile, SlotCheckpoint
+from mood_export import EXPORT_MIMETYPES, iter_export_records, render_export
+from subscriber_import import IMPORT_FORMATS, iter_subscriber_phones, import_subscribers
+from http_caching import etag_for, make_conditional, as_datetime
+from lazy import created_on_first_use
+from admission import AdmissionControl, ConcurrencyLimiter, KeyedRateLimiter
+import metrics
+import profiling
+
+# Flask names app.logger after the import name, so this is the same logger as create_app().logger
+logger = logging.getLogger(__name__)
 
-import os
-from dotenv import load_dotenv
+# --- Application Initialization ---
+# Routes and CLI commands live on this blueprint and create_app() builds the Flask app around it.
+# Firebase, Firestore, Twilio and the scheduler are created on first use rather than at import,
+# so CLI commands and worker starts only pay for the clients they actually touch.
+bp = Blueprint('main', __name__, cli_group=None)
+
+def create_app(config_object=Config):
+    """Application factory (used by `flask` via FLASK_APP=app.py, and by the __main__ block)."""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    app = Flask(__name__)
+    app.config.from_object(config_object)
+    # Per-route latency histograms and the Prometheus /metrics endpoint (see metrics.py)
+    metrics.init_app(app)
+    # Sampled and X-Profile-Request requests write profiles under PROFILE_DIR (see profiling.py)
+    profiling.init_app(app, profiler)
+    login_manager.init_app(app)
+    app.register_blueprint(bp)
+    if Config.ADMISSION_CONTROL:
+        # Twilio doesn't retry a webhook that fails, so a shed reply would be lost: sms_receive spools it instead
+        app.wsgi_app = AdmissionControl(app.wsgi_app, create_admission_limiters(), classify_request,
+                                        retry_after_seconds=Config.ADMISSION_RETRY_AFTER_SECONDS,
+                                        never_shed=('webhook',))
+    return app
+
+# --- Profiling (see profiling.py) ---
+profiler = profiling.Profiler(profiling.ProfileRing(Config.PROFILE_DIR, max_dumps=Config.PROFILE_MAX_DUMPS),
+                              sample_rate=Config.PROFILE_SAMPLE_RATE, header_token=Config.PROFILE_HEADER_TOKEN,
+                              interval=Config.PROFILE_SAMPLE_INTERVAL_MS / 1000)
+
+# --- Admission control (see admission.py) ---
+# Route classes with their own concurrency budget; anything not listed (/, /logout, /metrics,
+# static files) is never limited.
+def classify_request(method, path):
+    if path == '/sms/receive':
+        return 'webhook'
+    if method == 'POST' and path in ('/login', '/verify_otp'):
+        return 'otp'
+    if path == '/calendar' or path.startswith('/api/'):
+        return 'interactive'
+    return None
+
+def create_admission_limiters():
+    budgets = {
+        'webhook': (Config.ADMISSION_WEBHOOK_CONCURRENCY, Config.ADMISSION_WEBHOOK_QUEUE),
+        'interactive': (Config.ADMISSION_INTERACTIVE_CONCURRENCY, Config.ADMISSION_INTERACTIVE_QUEUE),
+        'otp': (Config.ADMISSION_OTP_CONCURRENCY, Config.ADMISSION_OTP_QUEUE),
+    }
+    return {route_class: ConcurrencyLimiter(route_class, max_concurrent, max_queue, Config.ADMISSION_QUEUE_TIMEOUT_SECONDS)
+            for route_class, (max_concurrent, max_queue) in budgets.items()}
 
-basedir = os.path.abspath(os.path.dirname(__file__))
-load_dotenv(os.path.join(basedir, '.env'))
+# --- Firebase Initialization (on first use) ---
+@created_on_first_use
+def get_firebase_clients():
+    """Returns (firestore_db, firebase_auth), or (None, None) if the Firebase Admin SDK can't be initialized."""
+    try:
+        # Imported here: firebase_admin and google-cloud-firestore are the slowest imports by far
+        import firebase_admin
+        from firebase_admin import credentials, auth as firebase_auth, firestore
+        cred = credentials.Certificate(Config.GOOGLE_APPLICATION_CREDENTIALS)
+        firebase_admin.initialize_app(cred)
+        db_firestore = firestore.client() # Firestore client
+        print("Firebase Admin SDK initialized successfully.")
+        logger.info("Firebase Admin SDK initialized successfully.")
+        return db_firestore, firebase_auth
+    except Exception as e:
+        print(f"Error initializing Firebase Admin SDK: {e}. Ensure GOOGLE_APPLICATION_CREDENTIALS is set correctly in .env and the file exists.")
+        logger.error(f"Firebase initialization error: {e}")
+        return None, None
 
-# --- Application Initialization ---
-app = Flask(__name__)
-app.config.from_object(Config)
-# db.init_app(app) # REMOVE SQLAlchemy initialization
-
-# Configure logging
-logging.basicConfig(level=logging.INFO, 
-                    format='%(asctime)s - %(levelname)s - %(message)s')
-
-# --- Firebase Initialization ---
-try:
-    cred = credentials.Certificate(Config.GOOGLE_APPLICATION_CREDENTIALS)
-    firebase_admin.initialize_app(cred)
-    db_firestore = firestore.client() # Firestore client
-    app_firebase_auth = firebase_auth # Firebase Auth client
-    print("Firebase Admin SDK initialized successfully.")
-    app.logger.info("Firebase Admin SDK initialized successfully.")
-except Exception as e:
-    print(f"Error initializing Firebase Admin SDK: {e}. Ensure GOOGLE_APPLICATION_CREDENTIALS is set correctly in .env and the file exists.")
-    app.logger.error(f"Firebase initialization error: {e}")
-    db_firestore = None
-    app_firebase_auth = None
-    # Optionally, exit the app if Firebase fails to initialize:
-    # import sys
-    # sys.exit("Could not initialize Firebase. Exiting.")
+# --- Storage ---
+# All reads and writes go through this repository (see storage.py). STORAGE_BACKEND=sqlite runs the
+# app on a local SQLite file instead of Firestore/Firebase Auth.
+@created_on_first_use
+def get_repository():
+    """Returns the storage repository, or None if the backend isn't available."""
+    if Config.STORAGE_BACKEND != 'firestore':
+        return create_repository(Config.STORAGE_BACKEND, sqlite_path=Config.STORAGE_SQLITE_PATH)
+    db_firestore, app_firebase_auth = get_firebase_clients()
+    return create_repository(Config.STORAGE_BACKEND, firestore_db=db_firestore, firebase_auth=app_firebase_auth)
+
+
+@created_on_first_use
+def get_mood_analytics():
+    """Returns the analytics engine behind /api/stats (NumPy is imported on first use, not at startup)."""
+    from mood_analytics import MoodAnalytics
+    return MoodAnalytics(get_repository(), max_users=Config.ANALYTICS_CACHE_MAX_USERS, ttl=Config.ANALYTICS_CACHE_TTL_SECONDS)
+
+
+# --- Phone -> (uid, is_subscribed) index ---
+# Lets /sms/receive skip the Firebase Auth phone lookup and the profile read for known senders.
+# Warmed by the daily prompt job; invalidated on STOP/START and after /verify_otp writes.
+phone_index = TTLCache(maxsize=Config.PHONE_INDEX_MAX_ENTRIES, ttl=Config.PHONE_INDEX_TTL_SECONDS)
 
 
 # --- Custom User Class for Flask-Login with Firebase ---
-class FirebaseUser(UserMixin):
-    def __init__(self, uid, phone_number=None, is_subscribed=False, consent_updated_at=None, **kwargs):
-        self.id = uid # UserMixin expects an 'id' attribute
+# Loaded users are cached per process (LRU+TTL) and per request (flask.g), so Flask-Login
+# doesn't read users/{uid} from Firestore on every authenticated request.
+user_cache = TTLCache(maxsize=Config.USER_CACHE_MAX_ENTRIES, ttl=Config.USER_CACHE_TTL_SECONDS)
+
+class FirebaseUser:
+    """
+    Flask-Login user backed by the Firestore users/{uid} profile.
+    Uses fixed __slots__ instead of a per-instance __dict__ so a large user_cache stays small;
+    it implements the Flask-Login user interface itself because inheriting UserMixin
+    (which has no __slots__) would bring the __dict__ back.
+    """
+    __slots__ = ('uid', 'phone_number', 'is_subscribed', 'consent_updated_at', 'created_at', 'timezone', 'prompt_time')
+
+    # Flask-Login user interface
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, uid, phone_number=None, is_subscribed=False, consent_updated_at=None, created_at=None,
+                 timezone=None, prompt_time=None, **kwargs):
+        # Other profile fields in Firestore are ignored; add a slot above if the app needs one.
         self.uid = uid
         self.phone_number = phone_number
         self.is_subscribed = is_subscribed
         self.consent_updated_at = consent_updated_at
-        # Store any other user data from Firestore
-        for key, value in kwargs.items():
-            setattr(self, key, value)
+        self.created_at = created_at
+        self.timezone = timezone # IANA name; None means Config.PROMPT_DEFAULT_TIMEZONE
+        self.prompt_time = prompt_time # 'HH:MM' local; None means the staggered default
+
+    @property
+    def id(self): # UserMixin-style 'id' attribute
+        return self.uid
+
+    def get_id(self):
+        return str(self.uid)
+
+    def __eq__(self, other):
+        if isinstance(other, FirebaseUser):
+            return self.uid == other.uid
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash(self.uid)
 
     @staticmethod
     def get(user_id): # user_id here is the Firebase UID
-        if not db_firestore: return None
+        repository = get_repository()
+        request_users = g.setdefault('firebase_users', {}) if has_app_context() else {}
+        if user_id in request_users:
+            return request_users[user_id]
+        cached = user_cache.get(user_id)
+        if cached is not None:
+            request_users[user_id] = cached
+            return cached
+
+        if not repository: return None
         try:
-            user_doc = db_firestore.collection('users').document(user_id).get()
-            if user_doc.exists:
-                user_data = user_doc.to_dict()
-                return FirebaseUser(uid=user_id, **user_data)
+            user_data = repository.get_user(user_id)
+            if user_data is not None:
+                user = FirebaseUser(uid=user_id, **user_data)
+                user_cache.set(user_id, user)
+                request_users[user_id] = user
+                return user
             return None
         except Exception as e:
-            app.logger.error(f"Error fetching user {user_id} from Firestore: {e}")
+            logger.error(f"Error fetching user {user_id}: {e}")
             return None
 
-@app.context_processor
+    @staticmethod
+    def invalidate(user_id):
+        """Drops a cached user after its profile was written."""
+        user_cache.invalidate(user_id)
+        if has_app_context():
+            g.get('firebase_users', {}).pop(user_id, None)
+
+@bp.app_context_processor
 def inject_global_vars():
     return {'current_year': '2025'}
 
 # --- Flask-Login Setup ---
-login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
+login_manager = LoginManager() # Attached to the app in create_app()
+login_manager.login_view = 'main.login'
 login_manager.login_message_category = "info"
 
 @login_manager.user_loader
 def load_user(user_id): # user_id is Firebase UID from session
     return FirebaseUser.get(user_id)
 
-# --- Temporary OTP Storage (In-memory, for simplicity. Use Redis/Firestore for production) ---
-# This replaces OTP fields in the User model for this OTP flow.
-# If using Firebase Phone Auth directly on client-side, this isn't needed.
+# --- OTP Storage ---
 # Since we are doing Twilio OTP -> then Firebase user creation/linking, we still manage OTP state briefly.
-otp_store = {} # Format: { "phone_number_e164": {"otp": "123456", "expires_at": datetime_object} }
+# The 'sqlite' backend lets several waitress processes on one host verify each other's codes.
+otp_store = create_otp_store(Config.OTP_STORE_BACKEND, path=Config.OTP_STORE_PATH, capacity=Config.OTP_STORE_CAPACITY)
+# Per process: with several waitress processes each one allows OTP_PHONE_BURST codes per number
+otp_rate_limiter = KeyedRateLimiter(Config.OTP_PHONE_BURST, Config.OTP_PHONE_REFILL_SECONDS, max_keys=Config.OTP_STORE_CAPACITY)
+
+OTP_MESSAGE = "Your Mindful Moments verification code is: {otp}."
 
 def generate_and_store_otp(phone_number_e164):
-    otp_code = str(random.randint(100000, 999999))
-    otp_store[phone_number_e164] = {
-        "otp": otp_code,
-        "expires_at": datetime.now(timezone.utc) + timedelta(minutes=10)
-    }
+    otp_code = f"{secrets.randbelow(900000) + 100000}" # 6 digits, from a CSPRNG
+    otp_store.put(phone_number_e164, otp_code, time.time() + Config.OTP_TTL_MINUTES * 60)
     return otp_code
 
 def verify_stored_otp(phone_number_e164, otp_code):
-    stored = otp_store.get(phone_number_e164)
-    if stored and stored["otp"] == otp_code and stored["expires_at"] > datetime.now(timezone.utc):
-        otp_store.pop(phone_number_e164, None) # Clear OTP after use
-        return True
-    return False
-
-
-# --- Helper Functions (parse_mood_response remains the same) ---
-
-def parse_mood_response(sms_body):
-    emoji_pattern = re.compile(
-        "["
-        "\U0001F600-\U0001F64F"  # Emoticons
-        "\U0001F300-\U0001F5FF"  # Symbols & Pictographs
-        "\U0001F680-\U0001F6FF"  # Transport & Map Symbols
-        "\U0001F1E0-\U0001F1FF"  # Regional Indicator Symbols (flags)
-        "\U00002600-\U000027BF"  # Miscellaneous Symbols
-        "\U0001F900-\U0001F9FF"  # Supplemental Symbols and Pictographs
-        "\U000024C2-\U0001F251"
-        "]+",
-        flags=re.UNICODE 
-    )
-
-    # Use re.search() to find the first occurrence of an emoji anywhere in the string
-    match = emoji_pattern.search(sms_body)
+    return otp_store.verify_and_consume(phone_number_e164, otp_code) # Clears the OTP on success
 
-    detected_emoji = None
-    if match:
-        # .group(0) will return the entire matched emoji sequence (e.g., "😊", "👍", "🎉")
-        # The `+` in the pattern ensures it can match sequences like skin tone modifiers
-        # or multi-character emojis if they are composed of characters within the defined ranges.
-        detected_emoji = match.group(0)
-    full_text_response = sms_body
-
-    return detected_emoji, full_text_response
 
 # --- Routes ---
-@app.route('/')
+@bp.route('/')
 def index():
     if current_user.is_authenticated:
-        return redirect(url_for('calendar_view'))
+        return redirect(url_for('main.calendar_view'))
     return render_template('landing.html')
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
-    app.logger.info("Login route accessed.")
+    repository = get_repository()
+    logger.info("Login route accessed.")
     if current_user.is_authenticated:
-        return redirect(url_for('calendar_view'))
+        return redirect(url_for('main.calendar_view'))
 
     if request.method == 'POST':
-        if not db_firestore or not app_firebase_auth: # Check if Firebase is initialized
+        if not repository: # Check if storage (Firebase or SQLite) is initialized
             flash('Application is not properly configured. Please contact support.', 'danger')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
 
         phone_number_input = request.form.get('phone_number')
         # ... (phone number validation as before) ...
         formatted_phone_e164 = format_phone_to_e164(phone_number_input)
         if not formatted_phone_e164:
             flash('Invalid phone number format...', 'danger') # Keep full message
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
+
+        # Per-phone limit, so a flood of requests for one number can't use up our Twilio throughput
+        if not otp_rate_limiter.try_acquire(formatted_phone_e164):
+            metrics.otp_rate_limited.inc()
+            logger.warning(f"OTP rate limit reached for {formatted_phone_e164}")
+            flash('Too many codes requested for this number. Please wait a few minutes and try again.', 'warning')
+            return render_template('login.html'), 429, {'Retry-After': str(int(Config.OTP_PHONE_REFILL_SECONDS))}
 
-        # Generate and send OTP via Twilio (using our temporary store)
+        # Generate the OTP and queue it on the priority lane; the queue workers send it via Twilio
         otp = generate_and_store_otp(formatted_phone_e164)
-        otp_message = (
-            f"Your Mindful Moments verification code is: {otp}."
-        )
-        if send_sms(formatted_phone_e164, otp_message):
+        if enqueue_sms(formatted_phone_e164, OTP_MESSAGE.format(otp=otp), priority=PRIORITY_OTP):
             session['phone_for_verification'] = formatted_phone_e164
             flash(f'OTP sent to {formatted_phone_e164}. Please check your messages.', 'info')
-            return redirect(url_for('verify_otp'))
+            return redirect(url_for('main.verify_otp'))
         else:
             flash('Failed to send OTP...', 'danger') # Keep full message
-            app.logger.error(f"Failed to send OTP to {formatted_phone_e164}")
-            return redirect(url_for('login'))
+            logger.error(f"Failed to send OTP to {formatted_phone_e164}")
+            return redirect(url_for('main.login'))
     return render_template('login.html')
 
-@app.route('/verify_otp', methods=['GET', 'POST'])
+WELCOME_MESSAGES = (
+    "Welcome to Mindful Moments! Each day, we'll send a gentle SMS asking about your day. Reply with an emoji and optional text to capture your feeling. Reply STOP to unsubscribe.",
+    "How are you feeling today? 😊",
+)
+
+@bp.route('/verify_otp', methods=['GET', 'POST'])
 def verify_otp():
+    repository = get_repository()
     new_user = False # Track if this is a new user creation
     if current_user.is_authenticated:
-        return redirect(url_for('calendar_view'))
+        return redirect(url_for('main.calendar_view'))
 
     phone_for_verification = session.get('phone_for_verification')
     if not phone_for_verification:
         flash('Please provide your phone number first.', 'warning')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     if request.method == 'POST':
         otp_code = request.form.get('otp')
 
         if verify_stored_otp(phone_for_verification, otp_code):
             try:
-                # OTP verified with our system. Now, get/create Firebase Auth user
-                firebase_user_record = None
+                # OTP verified with our system. Now, get/create the account (Firebase Auth user)
                 try:
-                    firebase_user_record = app_firebase_auth.get_user_by_phone_number(phone_for_verification)
-                    app.logger.info(f"Firebase Auth: Found existing user {firebase_user_record.uid} for {phone_for_verification}")
-                except firebase_auth.UserNotFoundError:
-                    firebase_user_record = app_firebase_auth.create_user(phone_number=phone_for_verification)
-                    app.logger.info(f"Firebase Auth: Created new user {firebase_user_record.uid} for {phone_for_verification}")
-
-                user_uid = firebase_user_record.uid
-
-                # Create/Update user profile in Firestore
-                user_doc_ref = db_firestore.collection('users').document(user_uid)
-                user_data_firestore = {
-                    'phone_number': phone_for_verification,
-                    'is_subscribed': True,
-                    'consent_updated_at': firestore.SERVER_TIMESTAMP, # Use server timestamp
-                }
-                # Add created_at only if document doesn't exist (new user profile in Firestore)
-                if not user_doc_ref.get().exists:
-                    user_data_firestore['created_at'] = firestore.SERVER_TIMESTAMP
-                    new_user = True
-
-                user_doc_ref.set(user_data_firestore, merge=True) # merge=True to update if exists, create if not
+                    user_uid = repository.get_uid_by_phone(phone_for_verification)
+                    logger.info(f"Storage: Found existing user {user_uid} for {phone_for_verification}")
+                except UserNotFoundError:
+                    user_uid = repository.create_user_for_phone(phone_for_verification)
+                    logger.info(f"Storage: Created new user {user_uid} for {phone_for_verification}")
+
+                # Create/Update the subscribed user profile
+                new_user = repository.subscribe_user(user_uid, phone_for_verification)
+                if new_user:
+                    repository.update_user(user_uid, {'prompt_slot_utc': prompt_slot_for(user_uid, {})})
+                phone_index.invalidate(phone_for_verification)
+                FirebaseUser.invalidate(user_uid)
 
                 # Log in with Flask-Login using our FirebaseUser wrapper
                 app_user = FirebaseUser.get(user_uid) # Fetch the newly created/updated user data
@@ -233,70 +336,222 @@ def verify_otp():
                     session.pop('phone_for_verification', None)
 
                     if new_user:
-                        welcome_message = "Welcome to Mindful Moments! Each day, we'll send a gentle SMS asking about your day. Reply with an emoji and optional text to capture your feeling. Reply STOP to unsubscribe."
-                        send_sms(phone_for_verification, welcome_message)
-                        welcome_message = "How are you feeling today? 😊"
-                        send_sms(phone_for_verification, welcome_message)
+                        # Queued, not sent inline; the queue keeps per-recipient order within a lane
+                        for welcome_message in WELCOME_MESSAGES:
+                            enqueue_sms(phone_for_verification, welcome_message, priority=PRIORITY_WELCOME)
                     
 
                     flash('Successfully subscribed and logged in!', 'success')
-                    return redirect(request.args.get('next') or url_for('calendar_view'))
+                    return redirect(request.args.get('next') or url_for('main.calendar_view'))
                 else:
                     flash('Login failed after OTP verification. Please try again.', 'danger')
-                    app.logger.error(f"Failed to load FirebaseUser for UID {user_uid} after OTP verification.")
+                    logger.error(f"Failed to load FirebaseUser for UID {user_uid} after OTP verification.")
 
             except Exception as e:
                 flash(f'An error occurred during Firebase user setup: {e}', 'danger')
-                app.logger.error(f"Firebase setup error for {phone_for_verification}: {e}")
+                logger.error(f"Firebase setup error for {phone_for_verification}: {e}")
                 # Consider what to do here. Maybe redirect to login or show a generic error.
-                return redirect(url_for('login'))
+                return redirect(url_for('main.login'))
         else:
             flash('Invalid OTP or OTP expired. Please try again.', 'danger')
-            return redirect(url_for('verify_otp'))
+            return redirect(url_for('main.verify_otp'))
 
     return render_template('verify_otp.html', phone_number=phone_for_verification)
 
 
-@app.route('/logout')
+@bp.route('/logout')
 @login_required
 def logout():
     logout_user()
     flash('You have been logged out.', 'info')
-    return redirect(url_for('index'))
-
-@app.route('/calendar')
+    return redirect(url_for('main.index'))
+
+# --- Mood entry queries ---
+MOOD_ENTRIES_MAX_PAGE_SIZE = 100
+EXPORT_PAGE_SIZE = 500 # Entries per storage read while streaming an export
+MOOD_ENTRIES_BATCH_MAX_DATES = 62 # Two months of days
+
+def query_mood_entries(uid, from_date_str, to_date_str, cursor=None, limit=None):
+    """
+    Returns (entries_by_date_iso, next_cursor) for the user's mood entries dated
+    from_date_str..to_date_str (inclusive).
+    'cursor' is the last entry date of the previous page; next_cursor is None on the last page.
+    """
+    return get_repository().list_entries(uid, from_date_str, to_date_str, cursor=cursor, limit=limit)
+
+def _month_bounds(day):
+    """Returns the first and last day (ISO strings) of the month containing 'day'."""
+    first_day = day.replace(day=1)
+    next_month = (first_day + timedelta(days=32)).replace(day=1)
+    return first_day.isoformat(), (next_month - timedelta(days=1)).isoformat()
+
+def get_month_rollup(uid, month):
+    """
+    Returns the users/{uid}/mood_months/{YYYY-MM} rollup (one document read).
+    Months without a rollup yet (e.g. not backfilled) are built from their entries instead.
+    """
+    repository = get_repository()
+    rollup = repository.get_month_rollup(uid, month)
+    if rollup is not None:
+        return rollup
+    month_start, month_end = _month_bounds(date.fromisoformat(month + '-01'))
+    entries, _ = query_mood_entries(uid, month_start, month_end)
+    return build_month_rollup(month, {day: entry['emoji'] for day, entry in entries.items()})
+
+def _rollup_calendar_entries(rollup):
+    """Calendar-shaped entries from a rollup. text_response isn't in rollups; the modal fetches it on demand."""
+    return {day: {'emoji': emoji, 'entry_date': day} for day, emoji in (rollup.get('days') or {}).items()}
+
+# Part of the calendar page's ETag, so a deploy (new template or script URLs) invalidates cached pages
+PAGE_BUILD_ID = str(int(time.time()))
+
+def _rollup_etag(uid, rollup):
+    """ETag for a month: its write version and time, plus its days for months built on the fly (no rollup yet)."""
+    return etag_for(uid, rollup.get('month'), rollup.get('version'), rollup.get('updated_at'),
+                    sorted((rollup.get('days') or {}).items()))
+
+# --- Month fragment cache ---
+# The calendar's embedded month data (templates/calendar_month.html) and the /api/mood_month JSON are
+# rendered once per (uid, YYYY-MM) and reused until that month is written to (see write_mood_entries),
+# so a repeat visit costs no storage reads and no re-rendering. Bounded by total size, LRU first;
+# past months rarely change, so they are kept much longer than the current one.
+month_fragments = SizedTTLCache(max_bytes=Config.FRAGMENT_CACHE_MAX_BYTES, ttl=Config.FRAGMENT_CACHE_TTL_SECONDS)
+
+class MonthFragments:
+    """A month's rendered pieces and the validators for them."""
+    __slots__ = ('etag', 'last_modified', 'calendar_html', 'summary_json')
+
+    def __init__(self, etag, last_modified, calendar_html, summary_json):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.calendar_html = calendar_html
+        self.summary_json = summary_json
+
+def get_month_fragments(uid, month, today=None):
+    """Returns the MonthFragments for (uid, month) from the cache, rendering them from the month's rollup on a miss."""
+    key = (uid, month)
+    fragments = month_fragments.get(key)
+    if fragments is not None:
+        metrics.fragment_cache_lookups.inc(result='hit')
+        return fragments
+    metrics.fragment_cache_lookups.inc(result='miss')
+
+    read_started_at = time.monotonic()
+    rollup = get_month_rollup(uid, month)
+    entries = _rollup_calendar_entries(rollup)
+    summary = {field: value for field, value in rollup.items() if field != 'days'}
+    summary['entries'] = entries
+    fragments = MonthFragments(
+        etag=_rollup_etag(uid, rollup),
+        last_modified=rollup.get('updated_at'),
+        calendar_html=Markup(render_template('calendar_month.html', entries_by_date_iso=entries, loaded_month=month)),
+        summary_json=current_app.json.dumps(summary).encode('utf-8') + b'\n', # Same body jsonify() would send
+    )
+    current_month = (today or date.today()).isoformat()[:7]
+    ttl = Config.FRAGMENT_CACHE_TTL_SECONDS if month >= current_month else Config.FRAGMENT_CACHE_PAST_MONTH_TTL_SECONDS
+    month_fragments.set(key, fragments, size=len(fragments.calendar_html.encode('utf-8')) + len(fragments.summary_json),
+                        ttl=ttl, read_started_at=read_started_at)
+    metrics.fragment_cache_bytes.set(month_fragments.bytes)
+    metrics.fragment_cache_entries.set(len(month_fragments))
+    return fragments
+
+@bp.route('/calendar')
 @login_required
 def calendar_view():
     if not current_user.is_subscribed: # current_user is now a FirebaseUser instance
         flash('You are not currently subscribed.', 'warning')
 
-    entries_by_date_iso = {}
+    # Only the visible (current) month is embedded, from its cached fragment; the page
+    # fetches other months from /api/mood_month/<YYYY-MM> as the user navigates.
+    today = date.today()
+    current_month = today.isoformat()[:7]
+    fragments = None
     try:
-        # Firestore: Get mood entries for the current user
-        # Entries are stored as subcollection: users/{uid}/mood_entries
-        # Document ID in mood_entries can be YYYY-MM-DD
-        entries_ref = db_firestore.collection('users').document(current_user.uid).collection('mood_entries')
-        for entry_doc in entries_ref.stream():
-            entry_data = entry_doc.to_dict()
-            # Ensure entry_date is a string in YYYY-MM-DD. Firestore Timestamp needs conversion.
-            entry_date_val = entry_data.get('entry_date')
-            if isinstance(entry_date_val, datetime): # If Firestore Timestamp
-                 entry_date_str = entry_date_val.strftime('%Y-%m-%d')
-            elif isinstance(entry_date_val, str): # If already string
-                 entry_date_str = entry_date_val
-            else: # Fallback or error
-                 entry_date_str = entry_doc.id # Assuming doc ID is YYYY-MM-DD
-
-            entries_by_date_iso[entry_date_str] = {
-                'emoji': entry_data.get('emoji'),
-                'text_response': entry_data.get('text_response'),
-                'entry_date': entry_date_str # Ensure this key exists for the template
-            }
+        fragments = get_month_fragments(current_user.uid, current_month, today)
+        month_fragment = fragments.calendar_html
     except Exception as e:
-        app.logger.error(f"Error fetching calendar entries for user {current_user.uid}: {e}")
+        logger.error(f"Error fetching calendar entries for user {current_user.uid}: {e}")
         flash('Could not load calendar entries.', 'danger')
+        month_fragment = Markup(render_template('calendar_month.html', entries_by_date_iso={}, loaded_month=current_month))
 
-    return render_template('calendar.html', entries_by_date_iso=entries_by_date_iso, today_iso=date.today().isoformat())
+    has_flashes = '_flashes' in session # Checked before rendering: the template's get_flashed_messages() pops them
+    response = make_response(render_template('calendar.html', month_fragment=month_fragment, today_iso=today.isoformat()))
+    if fragments is None or has_flashes:
+        return response # Pages showing a one-off message aren't reused
+    return make_conditional(response, etag_for(PAGE_BUILD_ID, today.isoformat(), current_user.is_subscribed, fragments.etag))
+
+@bp.route('/api/mood_month/<string:month>') # month is YYYY-MM
+@login_required
+def get_mood_month(month):
+    """Returns one month's summary: calendar entries (emoji only), emoji counts and streaks."""
+    try:
+        date.fromisoformat(month + '-01')
+    except ValueError:
+        return jsonify({'error': 'Month must be in YYYY-MM format'}), 400
+    try:
+        fragments = get_month_fragments(current_user.uid, month)
+        return make_conditional(Response(fragments.summary_json, mimetype='application/json'),
+                                fragments.etag, fragments.last_modified)
+    except Exception as e:
+        logger.error(f"API error fetching mood month {month} for user {current_user.uid}: {e}")
+        return jsonify({'error': f'Could not load mood month: {e}'}), 500
+
+@bp.route('/api/mood_entries')
+@login_required
+def get_mood_entries():
+    """
+    Returns mood entries between ?from=YYYY-MM-DD and ?to=YYYY-MM-DD (inclusive), one page at a time.
+    Pass the returned next_cursor as ?cursor= to get the next page; it is null on the last page.
+    """
+    try:
+        from_date = date.fromisoformat(request.args.get('from', ''))
+        to_date = date.fromisoformat(request.args.get('to', ''))
+    except ValueError:
+        return jsonify({'error': "'from' and 'to' must be dates in YYYY-MM-DD format"}), 400
+    if from_date > to_date:
+        return jsonify({'error': "'from' must not be after 'to'"}), 400
+    limit = request.args.get('limit', MOOD_ENTRIES_MAX_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MOOD_ENTRIES_MAX_PAGE_SIZE))
+    cursor = request.args.get('cursor') or None
+    if cursor:
+        try:
+            date.fromisoformat(cursor) # Cursors are entry dates (YYYY-MM-DD)
+        except ValueError:
+            return jsonify({'error': "'cursor' is not valid"}), 400
+
+    try:
+        entries, next_cursor = query_mood_entries(current_user.uid, from_date.isoformat(), to_date.isoformat(),
+                                                  cursor=cursor, limit=limit)
+        return jsonify({'entries': entries, 'next_cursor': next_cursor})
+    except Exception as e:
+        logger.error(f"API error fetching mood entries for user {current_user.uid}, {from_date} to {to_date}: {e}")
+        return jsonify({'error': f'Could not load mood entries: {e}'}), 500
+
+@bp.route('/api/export')
+@login_required
+def export_mood_history():
+    """
+    Downloads the user's whole mood history as ?format=csv (default) or ?format=ndjson.
+    The response is streamed as entries are read, one page at a time.
+    """
+    repository = get_repository()
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in EXPORT_MIMETYPES:
+        return jsonify({'error': f"'format' must be one of: {', '.join(EXPORT_MIMETYPES)}"}), 400
+    user_uid = current_user.uid
+
+    def generate():
+        try:
+            yield from render_export(iter_export_records(repository, [user_uid], EXPORT_PAGE_SIZE), export_format)
+        except Exception as e:
+            # Headers are already sent, so the download just ends early; the log says why
+            logger.error(f"API error exporting mood history for user {user_uid}: {e}")
+            raise
+
+    filename = f"mood-history-{date.today().isoformat()}.{export_format}"
+    return Response(stream_with_context(generate()), mimetype=EXPORT_MIMETYPES[export_format],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"',
+                             'X-Content-Type-Options': 'nosniff'})
 
 # FOR TESTING ONLY
 # @app.route('/calendar')
@@ -379,25 +634,70 @@ def calendar_view():
 
 
 
-@app.route('/api/mood_entry/<string:date_str>') # date_str is YYYY-MM-DD
+def _entry_details(date_str, entry_data):
+    """The modal's view of one entry."""
+    return {
+        'date': date_str, # Or entry_data.get('entry_date') if stored explicitly
+        'emoji': entry_data.get('emoji'),
+        'text_response': entry_data.get('text_response') or ""
+    }
+
+def _entry_stamp(date_str, entry_data):
+    # The content is part of it too, as entries written before versioning have no version
+    return (date_str, entry_data.get('version'), entry_data.get('timestamp'),
+            entry_data.get('emoji'), entry_data.get('text_response'))
+
+@bp.route('/api/mood_entry/<string:date_str>') # date_str is YYYY-MM-DD
 @login_required
 def get_mood_entry_details(date_str):
+    repository = get_repository()
     try:
-        # Firestore: Get mood entry for users/{uid}/mood_entries/{date_str}
-        entry_doc_ref = db_firestore.collection('users').document(current_user.uid).collection('mood_entries').document(date_str)
-        entry_doc = entry_doc_ref.get()
-        if entry_doc.exists:
-            entry_data = entry_doc.to_dict()
-            return jsonify({
-                'date': date_str, # Or entry_data.get('entry_date') if stored explicitly
-                'emoji': entry_data.get('emoji'),
-                'text_response': entry_data.get('text_response') or ""
-            })
+        # Get mood entry for users/{uid}/mood_entries/{date_str}
+        entry_data = repository.get_entry(current_user.uid, date_str)
+        if entry_data is not None:
+            return make_conditional(jsonify(_entry_details(date_str, entry_data)),
+                                    etag_for(current_user.uid, _entry_stamp(date_str, entry_data)),
+                                    entry_data.get('timestamp'))
         return jsonify({'error': 'No entry found for this date'}), 404
     except Exception as e:
-        app.logger.error(f"API error fetching mood entry for user {current_user.uid}, date {date_str}: {e}")
+        logger.error(f"API error fetching mood entry for user {current_user.uid}, date {date_str}: {e}")
         return jsonify({'error': f'Could not load mood details: {e}'}), 500
 
+@bp.route('/api/mood_entries/batch')
+@login_required
+def get_mood_entry_details_batch():
+    """
+    Returns {"entries": {date: details}} (details as /api/mood_entry/<date>) for days that have an entry,
+    either ?dates=YYYY-MM-DD,YYYY-MM-DD,... (up to MOOD_ENTRIES_BATCH_MAX_DATES, one multi-document read)
+    or ?month=YYYY-MM (one range query, which only reads the days that have an entry).
+    """
+    repository = get_repository()
+    month = request.args.get('month')
+    dates = [value for value in request.args.get('dates', '').split(',') if value]
+    if bool(month) == bool(dates):
+        return jsonify({'error': "Pass either 'dates' or 'month'"}), 400
+    try:
+        if month:
+            month_start, month_end = _month_bounds(date.fromisoformat(month + '-01'))
+        else:
+            dates = sorted({date.fromisoformat(value).isoformat() for value in dates})
+    except ValueError:
+        return jsonify({'error': "'dates' must be YYYY-MM-DD and 'month' YYYY-MM"}), 400
+    if len(dates) > MOOD_ENTRIES_BATCH_MAX_DATES:
+        return jsonify({'error': f"At most {MOOD_ENTRIES_BATCH_MAX_DATES} dates per request"}), 400
+
+    try:
+        if month:
+            entries, _ = query_mood_entries(current_user.uid, month_start, month_end)
+        else:
+            entries = repository.get_entries(current_user.uid, dates)
+    except Exception as e:
+        logger.error(f"API error fetching mood entries in batch for user {current_user.uid}: {e}")
+        return jsonify({'error': f'Could not load mood details: {e}'}), 500
+    details = {date_str: _entry_details(date_str, entries[date_str]) for date_str in sorted(entries)}
+    etag = etag_for(current_user.uid, month or dates, [_entry_stamp(date_str, entries[date_str]) for date_str in details])
+    return make_conditional(jsonify({'entries': details}), etag)
+
 
 # FOR TESTING ONLY
 # @app.route('/api/mood_entry/<string:date_str>') # date_str is YYYY-MM-DD
@@ -421,151 +721,717 @@ def get_mood_entry_details(date_str):
 
 
 
+# --- Prompt preferences ---
+def prompt_slot_for(uid, profile, on_date=None):
+    """The UTC minute slot for a user's daily prompt (see prompt_schedule.py)."""
+    return slot_for_profile(uid, profile, Config.PROMPT_DEFAULT_TIMEZONE, parse_prompt_time(Config.PROMPT_DEFAULT_TIME),
+                            Config.PROMPT_DEFAULT_STAGGER_MINUTES, on_date=on_date)
+
+@bp.route('/api/preferences', methods=['GET', 'POST'])
+@login_required
+def prompt_preferences():
+    """
+    GET returns the user's prompt timezone and local prompt time. POST takes JSON
+    {"timezone": "America/New_York", "prompt_time": "20:30"} (either key optional; null resets to the default).
+    """
+    repository = get_repository()
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Expected a JSON object'}), 400
+        profile = {'timezone': current_user.timezone, 'prompt_time': current_user.prompt_time}
+        if 'timezone' in data:
+            if data['timezone'] is not None and not is_valid_timezone(data['timezone']):
+                return jsonify({'error': "'timezone' must be an IANA timezone name, e.g. America/New_York"}), 400
+            profile['timezone'] = data['timezone']
+        if 'prompt_time' in data:
+            if data['prompt_time'] is not None and parse_prompt_time(data['prompt_time']) is None:
+                return jsonify({'error': "'prompt_time' must be HH:MM (24-hour)"}), 400
+            profile['prompt_time'] = data['prompt_time']
+        try:
+            repository.update_user(current_user.uid, dict(profile, prompt_slot_utc=prompt_slot_for(current_user.uid, profile)))
+        except Exception as e:
+            logger.error(f"API error saving preferences for user {current_user.uid}: {e}")
+            return jsonify({'error': f'Could not save preferences: {e}'}), 500
+        FirebaseUser.invalidate(current_user.uid)
+        current_user.timezone, current_user.prompt_time = profile['timezone'], profile['prompt_time']
+
+    local_minute = parse_prompt_time(current_user.prompt_time)
+    uses_default_time = local_minute is None
+    if uses_default_time:
+        local_minute = default_local_minute(current_user.uid, parse_prompt_time(Config.PROMPT_DEFAULT_TIME),
+                                            Config.PROMPT_DEFAULT_STAGGER_MINUTES)
+    return jsonify({
+        'timezone': current_user.timezone or Config.PROMPT_DEFAULT_TIMEZONE,
+        'prompt_time': format_prompt_time(local_minute),
+        'uses_default_time': uses_default_time,
+    })
+
+
+# --- Mood analytics (see mood_analytics.py) ---
+STATS_MAX_WINDOW_DAYS = 366
+
+def _subscribed_since(profile_created_at):
+    """The day daily prompts started for a user (their profile's created_at), or None if unknown."""
+    created_at = as_datetime(profile_created_at)
+    return created_at.date() if created_at else None
+
+@bp.route('/api/stats')
+@login_required
+def get_mood_stats():
+    """Returns the user's streaks, weekday distribution, emoji frequencies and trend, and response rate over ?days= (default 30)."""
+    window_days = request.args.get('days', 30, type=int)
+    if not 1 <= window_days <= STATS_MAX_WINDOW_DAYS:
+        return jsonify({'error': f"'days' must be between 1 and {STATS_MAX_WINDOW_DAYS}"}), 400
+    try:
+        stats = get_mood_analytics().user_stats(current_user.uid, window_days,
+                                                subscribed_since=_subscribed_since(current_user.created_at))
+    except Exception as e:
+        logger.error(f"API error computing stats for user {current_user.uid}: {e}")
+        return jsonify({'error': f'Could not compute stats: {e}'}), 500
+    return jsonify(stats)
+
+
 # --- Twilio Webhook for Incoming SMS ---
-@app.route('/sms/receive', methods=['POST'])
+DEFAULT_MOOD_EMOJI = "♠️" # Used when a reply has no emoji
+
+def _lookup_sms_sender(from_number_e164):
+    """
+    Returns (user_uid, is_subscribed) for an inbound SMS sender. Known senders come straight
+    from the phone index; otherwise look up the account by phone and read their profile.
+    Raises storage.UserNotFoundError for numbers without an account.
+    """
+    repository = get_repository()
+    indexed = phone_index.get(from_number_e164)
+    if indexed:
+        return indexed
+    user_uid = repository.get_uid_by_phone(from_number_e164)
+    user_profile = repository.get_user(user_uid) or {} # Get existing profile or empty dict
+    sender = (user_uid, user_profile.get('is_subscribed', False))
+    phone_index.set(from_number_e164, sender)
+    return sender
+
+def _handle_inbound_sms(from_number_e164, sms_body_original, entry_date_str, received_at):
+    """
+    Applies one inbound SMS: STOP/START update the subscription right away; a mood reply from a
+    subscribed user is returned for the caller to write (alone, or batched with others).
+    Returns (outcome, mood_entry) where outcome is 'not_registered', 'opted_out', 'opted_in',
+    'not_subscribed' or 'logged', and mood_entry is (user_uid, entry_date_str, mood_data) or None.
+    """
+    repository = get_repository()
+    try:
+        user_uid, is_subscribed = _lookup_sms_sender(from_number_e164)
+    except UserNotFoundError:
+        logger.info(f"Webhook /sms/receive: SMS from phone {from_number_e164} not linked to any user.")
+        # Optionally, create user here or send a "please sign up" message
+        return 'not_registered', None
+
+    # Handle STOP, START keywords
+    subscribed = _sms_consent_change(sms_body_original)
+    if subscribed is not None:
+        repository.set_subscription(user_uid, subscribed)
+        _consent_changed(user_uid, from_number_e164, subscribed)
+        return ('opted_in' if subscribed else 'opted_out'), None
+
+    if not is_subscribed:
+        logger.info(f"User {user_uid} ({from_number_e164}) sent message but is not subscribed. Ignoring.")
+        return 'not_subscribed', None
+    return 'logged', (user_uid, entry_date_str, _mood_data_from_sms(sms_body_original, received_at))
+
+# The pieces of _handle_inbound_sms that make no storage calls, shared with async_server.py
+def _sms_consent_change(sms_body_original):
+    """True for a START, False for a STOP, None for anything else (a mood reply)."""
+    sms_body_upper = sms_body_original.strip().upper()
+    if sms_body_upper in ("STOP", "START"):
+        return sms_body_upper == "START"
+    return None
+
+def _consent_changed(user_uid, from_number_e164, subscribed):
+    """Drops the cached subscription state after a STOP/START was written."""
+    phone_index.invalidate(from_number_e164)
+    FirebaseUser.invalidate(user_uid)
+    logger.info(f"User {user_uid} ({from_number_e164}) opted {'in (START)' if subscribed else 'out (STOP)'}.")
+
+def _mood_data_from_sms(sms_body_original, received_at):
+    emoji, text_content = parse_mood_response(sms_body_original)
+    if not emoji: # default emoji if no emoji is attached
+        logger.info(f"No emoji provided. Using default emoji")
+        emoji = DEFAULT_MOOD_EMOJI
+    return {
+        'entry_date': received_at,
+        'emoji': emoji,
+        'text_response': text_content,
+        'timestamp': received_at
+    }
+
+def write_mood_entries(mood_entries):
+    """
+    Saves mood entries (users/{uid}/mood_entries/{YYYY-MM-DD}) and updates each month's
+    rollup in the same write batch; see Repository.write_mood_entries.
+    'mood_entries' is a list of (user_uid, entry_date_str, mood_data).
+    """
+    get_repository().write_mood_entries(mood_entries)
+    _mood_entries_written(mood_entries)
+
+def _mood_entries_written(mood_entries):
+    """Brings this process's caches up to date after mood entries were written."""
+    # Only the months just written to are re-rendered (in this process; see get_month_fragments)
+    for user_uid, entry_date_str, _ in mood_entries:
+        month_fragments.invalidate((user_uid, month_key(entry_date_str)))
+    metrics.fragment_cache_bytes.set(month_fragments.bytes)
+    metrics.fragment_cache_entries.set(len(month_fragments))
+    # Keep this process's analytics cache current (only if something has used it; see mood_analytics.py)
+    mood_analytics = get_mood_analytics.if_created()
+    if mood_analytics is not None:
+        for user_uid, entry_date_str, mood_data in mood_entries:
+            mood_analytics.record_entry(user_uid, entry_date_str, mood_data.get('emoji'))
+
+def _flush_inbound_sms(messages):
+    """
+    Write-behind flush for fast-ack mode: applies queued messages, then writes their entries in one
+    batch. Returns the messages that couldn't be applied or written, for the buffer to retry.
+    """
+    unwritten, written = [], []
+    for message in messages:
+        from_number_e164, sms_body_original, entry_date_str, received_at = message
+        try:
+            _, mood_entry = _handle_inbound_sms(from_number_e164, sms_body_original, entry_date_str, received_at)
+        except Exception as e:
+            logger.error(f"Webhook writer: Error processing SMS from {from_number_e164}: {e}")
+            unwritten.append(message)
+            continue
+        if mood_entry:
+            written.append((message, mood_entry))
+    if not written:
+        return unwritten
+    try:
+        write_mood_entries([mood_entry for _, mood_entry in written])
+        logger.info(f"Webhook writer: Logged {len(written)} mood entries.")
+    except Exception as e:
+        logger.warning(f"Webhook writer: Batch write of {len(written)} mood entries failed: {e}")
+        # Retried later, maybe after newer replies: storage skips a mood older than the stored entry
+        unwritten.extend(message for message, _ in written)
+    return unwritten
+
+def _encode_inbound_sms(message):
+    from_number_e164, sms_body_original, entry_date_str, received_at = message
+    return json.dumps([from_number_e164, sms_body_original, entry_date_str, received_at.isoformat()])
+
+def _decode_inbound_sms(text):
+    from_number_e164, sms_body_original, entry_date_str, received_at = json.loads(text)
+    return from_number_e164, sms_body_original, entry_date_str, datetime.fromisoformat(received_at)
+
+# Fast-ack mode: the webhook validates and queues the message, answers 204 right away, and a
+# background writer groups pending messages into batched writes. Messages whose write fails are
+# spooled to SMS_WRITE_BEHIND_SPOOL_PATH and retried, so an acknowledged reply is never lost.
+# Only mood replies are queued: STOP/START are applied inline, so a retry can't reorder them.
+@created_on_first_use
+def get_inbound_sms_writer():
+    """The write-behind buffer in fast-ack mode, else None."""
+    if Config.SMS_WEBHOOK_MODE != 'fast_ack':
+        return None
+    return WriteBehindBuffer(
+        _flush_inbound_sms,
+        max_items=Config.SMS_WRITE_BEHIND_MAX_QUEUE,
+        batch_size=Config.SMS_WRITE_BEHIND_BATCH_SIZE,
+        flush_interval_seconds=Config.SMS_WRITE_BEHIND_FLUSH_SECONDS,
+        name="sms-write-behind",
+        spool=SQLiteSpool(Config.SMS_WRITE_BEHIND_SPOOL_PATH, _encode_inbound_sms, _decode_inbound_sms),
+    )
+
+@bp.route('/sms/receive', methods=['POST'])
 def sms_receive():
-    app.logger.info("Recieved SMS")
-    if not db_firestore or not app_firebase_auth:
-        app.logger.error("Webhook /sms/receive: Firebase not initialized.")
+    repository = get_repository()
+    logger.info("Recieved SMS")
+    if not repository:
+        logger.error("Webhook /sms/receive: Storage not initialized.")
         return "Error: Service not configured", 500
 
     from_number_raw = request.values.get('From', None)
     sms_body_original = request.values.get('Body', "") # Keep original for parsing
-    sms_body_upper = sms_body_original.strip().upper()
 
     # ... (phone number validation as before) ...
     from_number_e164 = format_phone_to_e164(from_number_raw)
     if not from_number_e164: # ... (error handling as before) ...
         return "Error: Invalid 'From' number format", 400
 
-    # Get Firebase Auth user by phone
+    # The entry belongs to the day the SMS arrived, even if it is written later
+    entry_date_str = date.today().isoformat()
+    received_at = datetime.now(timezone.utc)
+
+    inbound_sms_writer = get_inbound_sms_writer()
+    if inbound_sms_writer is not None and _sms_consent_change(sms_body_original) is None:
+        message = (from_number_e164, sms_body_original, entry_date_str, received_at)
+        if request.environ.get(AdmissionControl.OVER_BUDGET_KEY):
+            # The webhook budget is full: don't wait for room in the buffer, spool the message if there's none
+            if inbound_sms_writer.submit_or_spool(message):
+                return '', 204
+        elif inbound_sms_writer.submit(message, timeout=Config.SMS_WEBHOOK_ENQUEUE_TIMEOUT_SECONDS):
+            return '', 204
+        # Buffer full: handle this one inline, which slows the webhook down instead of dropping data
+        logger.warning("Webhook /sms/receive: Write-behind buffer full, processing SMS inline.")
+
     try:
-        firebase_user_record = app_firebase_auth.get_user_by_phone_number(from_number_e164)
-        user_uid = firebase_user_record.uid
-        print(user_uid)
-        user_doc_ref = db_firestore.collection('users').document(user_uid)
-        user_profile = user_doc_ref.get().to_dict() or {} # Get existing profile or empty dict
-        print(user_profile)
-    except firebase_auth.UserNotFoundError:
-        app.logger.info(f"Webhook /sms/receive: SMS from phone {from_number_e164} not linked to any Firebase Auth user.")
-        # Optionally, create user here or send a "please sign up" message
-        return "User not registered in Firebase Auth", 200
+        outcome, mood_entry = _handle_inbound_sms(from_number_e164, sms_body_original, entry_date_str, received_at)
     except Exception as e:
-        app.logger.error(f"Webhook /sms/receive: Error fetching Firebase user for {from_number_e164}: {e}")
+        logger.error(f"Webhook /sms/receive: Error fetching user for {from_number_e164}: {e}")
         return "Error: Could not process user", 500
 
-    # Handle STOP, START keywords
-    if sms_body_upper == "STOP":
-        user_doc_ref.update({'is_subscribed': False, 'consent_updated_at': firestore.SERVER_TIMESTAMP})
-        app.logger.info(f"User {user_uid} ({from_number_e164}) opted out (STOP).")
-        return '', 204
-
-    if sms_body_upper == "START":
-        user_doc_ref.update({'is_subscribed': True, 'consent_updated_at': firestore.SERVER_TIMESTAMP})
-        app.logger.info(f"User {user_uid} ({from_number_e164}) opted in (START).")
-        return '', 204
-
-    if not user_profile.get('is_subscribed', False):
-        app.logger.info(f"User {user_uid} ({from_number_e164}) sent message but is not subscribed. Ignoring.")
+    if outcome == 'not_registered':
+        return "User not registered in Firebase Auth", 200
+    if outcome == 'not_subscribed':
         return "User not subscribed", 200
-
-    emoji, text_content = parse_mood_response(sms_body_original)
-    if not emoji: # default emoji if no emoji is attached
-        app.logger.info(f"No emoji provided. Using default emoji")
-        emoji = "♠️"
-
-    # Save mood entry to Firestore: users/{uid}/mood_entries/{YYYY-MM-DD}
-    entry_date_str = date.today().isoformat()
-    mood_entry_ref = user_doc_ref.collection('mood_entries').document(entry_date_str)
-    mood_data = {
-        'entry_date': datetime.now(timezone.utc),
-        'emoji': emoji,
-        'text_response': text_content,
-        'timestamp': datetime.now(timezone.utc)
-    }
-    mood_entry_ref.set(mood_data) # Overwrites if entry for today already exists
-    app.logger.info(f"Webhook /sms/receive: Logged mood for user {user_uid} on {entry_date_str}")
+    if mood_entry:
+        write_mood_entries([mood_entry])
+        logger.info(f"Webhook /sms/receive: Logged mood for user {mood_entry[0]} on {entry_date_str}")
     return '', 204
 
 
 # --- APScheduler Setup for Daily SMS ---
-def scheduled_daily_prompt_job():
-    app.logger.info("Running Scheduled job: Sending daily mood prompts to subscribed users.")
-    if not db_firestore:
-        app.logger.error("Scheduler: Firestore not initialized. Skipping job.")
-        return
-
-    with app.app_context(): # Still useful for Flask context, though not strictly needed for Firestore
-        try:
-            users_ref = db_firestore.collection('users').where('is_subscribed', '==', True)
-            subscribed_users_docs = users_ref.stream()
-
-            count = 0
-            for user_doc in subscribed_users_docs:
-                user_data = user_doc.to_dict()
-                phone_number = user_data.get('phone_number')
-                if phone_number:
-                    app.logger.info(f"Scheduler: Sending daily prompt to {phone_number} (User ID: {user_doc.id})")
-                    send_daily_mood_prompt_sms(phone_number)
-                    count += 1
-            app.logger.info(f"Scheduler: Sent daily prompts to {count} subscribed user(s).")
-            if count == 0:
-                 app.logger.info("Scheduler: No subscribed users found to send daily prompts.")
-        except Exception as e:
-            app.logger.error(f"Scheduler: Error fetching subscribed users: {e}")
-
-scheduler = BackgroundScheduler(daemon=True, timezone=cronjob_timezone)
-hour = os.environ.get('SMS_CRON_JOB_HOUR', '9') # Default to 9 AM if not set
-minute = os.environ.get('SMS_CRON_JOB_MINUTE', '15') # Default to 15 minutes past the hour if not set
-day_of_week = os.environ.get('SMS_CRON_JOB_DAY_OF_WEEK', 'mon-sun') # Default to every day
-# log the cron job schedule
-app.logger.info(f"Scheduler: Daily prompt job scheduled at {hour}:{minute} on {day_of_week}")
-scheduler.add_job(scheduled_daily_prompt_job, 'cron', hour=hour, minute=minute, day_of_week=day_of_week, )
+def _iter_subscribed_phone_numbers(bucket_range=None, after_uid=None, slot=None):
+    """
+    Yields (uid, phone_number) for every subscribed user (or one shard's/prompt slot's), streamed from storage.
+    Warms the phone index along the way, ahead of the reply spike that follows each prompt run.
+    """
+    repository = get_repository()
+    for user_uid, phone_number in repository.iter_subscribed_users(bucket_range=bucket_range, after_uid=after_uid, slot=slot):
+        phone_index.set(phone_number, (user_uid, True))
+        yield user_uid, phone_number
+
+def _dispatch_daily_prompts(users, dispatch_mode):
+    """Sends (or, in 'queue' mode, enqueues) the daily prompt to (uid, phone_number) pairs. Returns counts."""
+    if dispatch_mode == 'queue':
+        enqueued = get_outbound_queue().enqueue_many(
+            ((phone_number, DAILY_MOOD_PROMPT_TEXT) for _, phone_number in users),
+            priority=PRIORITY_PROMPT,
+        )
+        return {'enqueued': enqueued, 'sent': 0, 'failed': 0}
+    if dispatch_mode == 'parallel':
+        stats = dispatch_concurrently(
+            (phone_number for _, phone_number in users),
+            send_daily_mood_prompt_sms,
+            max_workers=Config.SMS_DISPATCH_WORKERS,
+            limiter=get_sender_limiter(), # Shared with the queue workers, so OTPs sent meanwhile count too
+        )
+        return {'enqueued': 0, 'sent': stats['sent'], 'failed': stats['failed']}
+    sent = failed = 0
+    for user_uid, phone_number in users:
+        logger.info(f"Scheduler: Sending daily prompt to {phone_number} (User ID: {user_uid})")
+        if send_daily_mood_prompt_sms(phone_number):
+            sent += 1
+        else:
+            failed += 1
+    return {'enqueued': 0, 'sent': sent, 'failed': failed}
+
+# With several app instances, each run's subscribers are split into shards that the instances
+# lease from each other (see scheduler_shards.py), so every user gets one prompt per run.
+@created_on_first_use
+def get_prompt_lease_store():
+    """The configured lease store, or None without leases (or if it can't be set up)."""
+    if Config.SCHEDULER_LEASE_BACKEND == 'none':
+        return None
+    try:
+        db_firestore = get_firebase_clients()[0] if Config.SCHEDULER_LEASE_BACKEND == 'firestore' else None
+        return create_lease_store(Config.SCHEDULER_LEASE_BACKEND, path=Config.SCHEDULER_LEASE_PATH,
+                                  firestore_db=db_firestore)
+    except Exception as e:
+        logger.error(f"Scheduler: Could not set up {Config.SCHEDULER_LEASE_BACKEND} leases: {e}")
+        return None
+
+def _dispatch_sharded_prompts(run_id, dispatch_mode, slot=None):
+    """
+    Works through this run's shards alongside the other instances. Progress is checkpointed
+    every SCHEDULER_CHECKPOINT_EVERY users, so a shard taken over after a crash resends at
+    most one chunk. Returns (counts, shard_result).
+    A prompt slot is small, so it is one shard, and it must finish before the next minute's tick.
+    """
+    counts = {'enqueued': 0, 'sent': 0, 'failed': 0}
+    num_shards = Config.SCHEDULER_SHARDS if slot is None else 1
+    run_window_seconds = Config.SCHEDULER_RUN_WINDOW_SECONDS if slot is None else 50
+    chunk_size = max(1, Config.SCHEDULER_CHECKPOINT_EVERY)
+
+    def process_shard(shard, lease):
+        users = _iter_subscribed_phone_numbers(bucket_range(shard, num_shards), after_uid=lease.cursor, slot=slot)
+        while True:
+            chunk = list(itertools.islice(users, chunk_size))
+            if not chunk:
+                return
+            for key, value in _dispatch_daily_prompts(chunk, dispatch_mode).items():
+                counts[key] += value
+            lease.checkpoint(chunk[-1][0])
+
+    shard_run = ShardedRun(get_prompt_lease_store(), num_shards,
+                           lease_ttl_seconds=Config.SCHEDULER_LEASE_TTL_SECONDS,
+                           run_window_seconds=run_window_seconds)
+    return counts, shard_run.run(run_id, process_shard)
+
+# Stacks of every thread are sampled, so 'parallel' sends on the dispatch workers show up too
+@profiler.profiled('scheduled_daily_prompt_job', sample_rate=Config.PROFILE_JOB_SAMPLE_RATE, all_threads=True)
+def scheduled_daily_prompt_job(dispatch_mode=None, run_id=None, slot=None):
+    """
+    Sends the daily prompt to every subscribed user and returns per-run stats
+    (sent, failed, total, wall_time_seconds, throughput_per_second).
+    dispatch_mode defaults to Config.SMS_DISPATCH_MODE ('queue', 'parallel' or 'sequential').
+    In 'queue' mode prompts are spooled on the outbound queue and 'enqueued' is reported
+    instead of sent/failed; the queue workers do the sending.
+    With scheduler leases configured, only this instance's share of run 'run_id' (default: today's
+    daily run) is sent, and shards_processed/shards_pending are added to the stats.
+    With 'slot' (a UTC minute of the day), only users whose prompt time falls in that slot are sent.
+    """
+    repository = get_repository()
+    logger.info("Running Scheduled job: Sending daily mood prompts to subscribed users.")
+    if not repository:
+        logger.error("Scheduler: Storage not initialized. Skipping job.")
+        return None
+    prompt_lease_store = get_prompt_lease_store()
+    if Config.SCHEDULER_LEASE_BACKEND != 'none' and prompt_lease_store is None:
+        logger.error("Scheduler: Leases are configured but unavailable. Skipping job to avoid duplicate prompts.")
+        return None
+
+    dispatch_mode = dispatch_mode or Config.SMS_DISPATCH_MODE
+    if slot is not None:
+        run_id = run_id or f"slot-{datetime.now(timezone.utc).date().isoformat()}-{slot}"
+    run_id = run_id or f"daily-{datetime.now(cronjob_timezone).date().isoformat()}"
+    job_started_at = time.monotonic()
+    try:
+        started_at = time.monotonic()
+        shard_result = None
+        if prompt_lease_store is not None:
+            counts, shard_result = _dispatch_sharded_prompts(run_id, dispatch_mode, slot=slot)
+        else:
+            counts = _dispatch_daily_prompts(_iter_subscribed_phone_numbers(slot=slot), dispatch_mode)
+        wall_time = time.monotonic() - started_at
+        total = counts['enqueued'] if dispatch_mode == 'queue' else counts['sent'] + counts['failed']
+        stats = {
+            'sent': counts['sent'],
+            'failed': counts['failed'],
+            'total': total,
+            'wall_time_seconds': round(wall_time, 3),
+            'throughput_per_second': round(total / wall_time, 2) if wall_time > 0 else 0.0,
+        }
+        if dispatch_mode == 'queue':
+            stats['enqueued'] = counts['enqueued']
+        if shard_result is not None:
+            stats.update(shard_result)
+        stats['mode'] = dispatch_mode
+        if dispatch_mode == 'queue':
+            logger.info(
+                f"Scheduler: Daily prompts (queue) - enqueued {stats['enqueued']} "
+                f"in {stats['wall_time_seconds']}s ({stats['throughput_per_second']} msg/s)."
+            )
+        else:
+            logger.info(
+                f"Scheduler: Daily prompts ({dispatch_mode}) - sent {stats['sent']}, failed {stats['failed']} "
+                f"in {stats['wall_time_seconds']}s ({stats['throughput_per_second']} msg/s)."
+            )
+        if shard_result is not None:
+            logger.info(f"Scheduler: Run {run_id} - processed shards {shard_result['shards_processed']}, "
+                        f"unfinished shards {shard_result['shards_pending']}.")
+        if stats['total'] == 0:
+             logger.info("Scheduler: No subscribed users found to send daily prompts.")
+        logger.info(f"Scheduler: Phone index stats: {phone_index.stats()}")
+        metrics.record_scheduler_run(dispatch_mode, stats, time.monotonic() - job_started_at)
+        return stats
+    except Exception as e:
+        logger.error(f"Scheduler: Error fetching subscribed users: {e}")
+        metrics.record_scheduler_run(dispatch_mode, None, time.monotonic() - job_started_at)
+        return None
+
+prompt_slot_checkpoint = SlotCheckpoint(Config.PROMPT_SLOT_STATE_PATH)
+
+def prompt_slot_tick():
+    """
+    Runs every minute in 'slots' mode: sends the prompts of every UTC minute after the last one
+    dispatched, up to the current one. A late or skipped tick (or a restart) is caught up by the
+    next, and no minute is sent twice; minutes older than PROMPT_SLOT_CATCH_UP_MINUTES are dropped.
+    Returns {'HH:MM': stats} for the slots it dispatched.
+    """
+    results = {}
+    last_done = prompt_slot_checkpoint.load()
+    while True:
+        current = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        oldest = current - timedelta(minutes=Config.PROMPT_SLOT_CATCH_UP_MINUTES)
+        minute = current if last_done is None else last_done + timedelta(minutes=1)
+        if minute < oldest:
+            logger.warning(f"Scheduler: Skipping prompt slots {minute:%Y-%m-%d %H:%M} to {oldest - timedelta(minutes=1):%H:%M} UTC "
+                           f"(older than PROMPT_SLOT_CATCH_UP_MINUTES).")
+            minute = oldest
+        if minute > current:
+            return results
+        slot = minute.hour * 60 + minute.minute
+        stats = scheduled_daily_prompt_job(slot=slot, run_id=f"slot-{minute.date().isoformat()}-{slot}")
+        if stats is None: # Not sent; the next tick retries it
+            return results
+        results[format_prompt_time(slot)] = stats
+        prompt_slot_checkpoint.save(minute)
+        last_done = minute
+
+def rebuild_prompt_slots(on_date=None):
+    """
+    Recomputes every subscribed user's prompt_slot_utc for 'on_date' (default: today, UTC), so DST
+    changes take effect, and writes only the slots that changed. Returns how many were updated.
+    """
+    repository = get_repository()
+    on_date = on_date or datetime.now(timezone.utc).date()
+    changed = {}
+    for user_uid, profile in repository.iter_subscribed_profiles():
+        slot = prompt_slot_for(user_uid, profile, on_date=on_date)
+        if profile.get('prompt_slot_utc') != slot:
+            changed[user_uid] = slot
+    if changed:
+        repository.put_prompt_slots(changed)
+    logger.info(f"Scheduler: Rebuilt prompt slots for {on_date}; {len(changed)} changed.")
+    return len(changed)
+
+def scheduled_prompt_slot_rebuild():
+    """
+    Daily job for 'slots' mode, run shortly before midnight UTC for the coming day.
+    With scheduler leases configured, only one instance does the rebuild.
+    """
+    on_date = datetime.now(timezone.utc).date() + timedelta(days=1)
+    prompt_lease_store = get_prompt_lease_store()
+    try:
+        if prompt_lease_store is None:
+            rebuild_prompt_slots(on_date)
+            return
+        ShardedRun(prompt_lease_store, 1, lease_ttl_seconds=Config.SCHEDULER_LEASE_TTL_SECONDS,
+                   run_window_seconds=Config.SCHEDULER_RUN_WINDOW_SECONDS).run(
+            f"slots-rebuild-{on_date.isoformat()}", lambda shard, lease: rebuild_prompt_slots(on_date))
+    except Exception as e:
+        logger.error(f"Scheduler: Error rebuilding prompt slots: {e}")
+
+@created_on_first_use
+def get_scheduler():
+    """Builds the APScheduler instance and its prompt jobs (not started; see the __main__ block)."""
+    from apscheduler.schedulers.background import BackgroundScheduler # Only needed by the process that runs jobs
+    scheduler = BackgroundScheduler(daemon=True, timezone=cronjob_timezone)
+    if Config.PROMPT_SCHEDULING == 'slots':
+        logger.info(f"Scheduler: Daily prompts sent per user at their local prompt time "
+                    f"(default {Config.PROMPT_DEFAULT_TIME} {Config.PROMPT_DEFAULT_TIMEZONE})")
+        # Slots are rebuilt just before 00:00 UTC is dispatched, so the new day's DST offsets apply to it
+        scheduler.add_job(scheduled_prompt_slot_rebuild, 'cron', hour=23, minute=58, timezone=pytz.utc)
+        # One tick at a time: a tick that runs long catches up on the minutes that passed meanwhile
+        scheduler.add_job(prompt_slot_tick, 'cron', minute='*', timezone=pytz.utc, max_instances=1, coalesce=True,
+                          misfire_grace_time=Config.PROMPT_SLOT_CATCH_UP_MINUTES * 60)
+    else:
+        hour = os.environ.get('SMS_CRON_JOB_HOUR', '9') # Default to 9 AM if not set
+        minute = os.environ.get('SMS_CRON_JOB_MINUTE', '15') # Default to 15 minutes past the hour if not set
+        day_of_week = os.environ.get('SMS_CRON_JOB_DAY_OF_WEEK', 'mon-sun') # Default to every day
+        # log the cron job schedule
+        logger.info(f"Scheduler: Daily prompt job scheduled at {hour}:{minute} on {day_of_week}")
+        scheduler.add_job(scheduled_daily_prompt_job, 'cron', hour=hour, minute=minute, day_of_week=day_of_week, )
+    return scheduler
 
 # --- Flask CLI Commands ---
-@app.cli.command("init-db") # This command is now a misnomer, as there's no SQL DB to init tables for.
+@bp.cli.command("init-db") # This command is now a misnomer, as there's no SQL DB to init tables for.
                             # Could be removed or repurposed for other Firebase setup tasks if any.
 def init_db_command():
     click.echo("Database is Firestore. No table initialization needed via this command.")
     click.echo("Ensure your Firebase project is set up and GOOGLE_APPLICATION_CREDENTIALS points to your service account key.")
 
-@app.cli.command("test-prompt")
+@bp.cli.command("backfill-rollups")
+@click.option('--uid', default=None, help='Only backfill this user (defaults to all users).')
+def backfill_rollups_command(uid):
+    """Builds users/{uid}/mood_months/{YYYY-MM} rollups from existing mood entries."""
+    repository = get_repository()
+    if not repository:
+        click.echo("Storage not initialized. Cannot backfill rollups.", err=True)
+        return
+    user_uids = [uid] if uid else repository.iter_user_ids()
+
+    pending_rollups = {}
+    users_done = rollups_written = 0
+    for user_uid in user_uids:
+        days_by_month = {}
+        for entry_date_str, entry in repository.iter_entries(user_uid):
+            days_by_month.setdefault(month_key(entry_date_str), {})[entry_date_str] = entry['emoji']
+        for month, days in days_by_month.items():
+            pending_rollups[(user_uid, month)] = build_month_rollup(month, days)
+            rollups_written += 1
+        if len(pending_rollups) >= 500: # Firestore's per-transaction write limit
+            repository.merge_month_rollups(pending_rollups)
+            pending_rollups = {}
+        users_done += 1
+        if users_done % 100 == 0:
+            click.echo(f"Processed {users_done} users, {rollups_written} rollups...")
+    if pending_rollups:
+        repository.merge_month_rollups(pending_rollups)
+    click.echo(f"Backfilled {rollups_written} monthly rollups for {users_done} user(s).")
+
+@bp.cli.command("backfill-shard-buckets")
+def backfill_shard_buckets_command():
+    """Sets shard_bucket on user profiles that predate scheduler sharding."""
+    repository = get_repository()
+    if not repository:
+        click.echo("Storage not initialized. Cannot backfill shard buckets.", err=True)
+        return
+    click.echo(f"Set shard_bucket on {repository.backfill_shard_buckets()} user profile(s).")
+
+@bp.cli.command("rebuild-prompt-slots")
+@click.option('--date', 'date_str', default=None, help='Day (YYYY-MM-DD) to compute slots for (defaults to today, UTC).')
+def rebuild_prompt_slots_command(date_str):
+    """Recomputes prompt_slot_utc for every subscribed user (e.g. after changing the PROMPT_DEFAULT_* settings)."""
+    repository = get_repository()
+    if not repository:
+        click.echo("Storage not initialized. Cannot rebuild prompt slots.", err=True)
+        return
+    on_date = datetime.strptime(date_str, '%Y-%m-%d').date() if date_str else None
+    click.echo(f"Updated prompt_slot_utc on {rebuild_prompt_slots(on_date)} user profile(s).")
+
+@bp.cli.command("export-moods")
+@click.option('--format', 'export_format', type=click.Choice(sorted(EXPORT_MIMETYPES)), default='ndjson', help='Output format.')
+@click.option('--output', type=click.File('w', encoding='utf-8'), default='-', help='File to write (defaults to stdout).')
+@click.option('--uid', default=None, help='Only export this user (defaults to all users).')
+def export_moods_command(export_format, output, uid):
+    """Streams every user's mood entries (with their uid) to a CSV or NDJSON file, e.g. for a data migration."""
+    repository = get_repository()
+    if not repository:
+        click.echo("Storage not initialized. Cannot export mood entries.", err=True)
+        return
+    user_uids = [uid] if uid else repository.iter_user_ids(page_size=EXPORT_PAGE_SIZE)
+    records = iter_export_records(repository, user_uids, EXPORT_PAGE_SIZE, include_uid=True)
+    for chunk in render_export(records, export_format, include_uid=True):
+        output.write(chunk)
+    output.flush()
+
+@bp.cli.command("import-subscribers")
+@click.argument('input_file', type=click.File('r', encoding='utf-8'), default='-')
+@click.option('--format', 'input_format', type=click.Choice(IMPORT_FORMATS), default=None,
+              help="Input format (defaults to the file's extension, else csv). CSV needs a phone_number column.")
+@click.option('--batch-size', type=int, default=Config.SUBSCRIBER_IMPORT_BATCH_SIZE, help='Numbers per batch.')
+@click.option('--workers', type=int, default=Config.SUBSCRIBER_IMPORT_WORKERS, help='Batches written in parallel.')
+@click.option('--send-welcome', is_flag=True, help='Queue the welcome SMS for numbers that get a new profile.')
+def import_subscribers_command(input_file, input_format, batch_size, workers, send_welcome):
+    """Creates accounts for and subscribes every phone number in a CSV or NDJSON file (e.g. a partner cohort), except opt-outs."""
+    repository = get_repository()
+    if not repository:
+        click.echo("Storage not initialized. Cannot import subscribers.", err=True)
+        return
+    if input_format is None:
+        input_format = 'ndjson' if input_file.name.endswith(('.ndjson', '.jsonl')) else 'csv'
+
+    def after_batch(result):
+        # What verify_otp does for a single new subscriber, once per batch
+        new_uids = result['new_uids']
+        if new_uids:
+            repository.put_prompt_slots({uid: prompt_slot_for(uid, {}) for uid in new_uids})
+        for uid in new_uids: # Existing profiles aren't written
+            phone_index.invalidate(result['phone_numbers_by_uid'][uid])
+            FirebaseUser.invalidate(uid)
+        if send_welcome:
+            for uid in new_uids:
+                for welcome_message in WELCOME_MESSAGES:
+                    enqueue_sms(result['phone_numbers_by_uid'][uid], welcome_message, priority=PRIORITY_WELCOME)
+
+    def on_progress(stats):
+        click.echo(f"  {stats['rows']} rows read, {stats['subscribed']} subscribed, {stats['failed']} failed "
+                   f"({stats['throughput_per_second']:.0f} rows/s)", err=True)
+
+    stats = import_subscribers(repository, iter_subscriber_phones(input_file, input_format), batch_size=batch_size,
+                               max_workers=workers, after_batch=after_batch, on_progress=on_progress)
+    click.echo(f"Imported {stats['rows']} rows in {stats['wall_time_seconds']:.1f}s "
+               f"({stats['throughput_per_second']:.0f} rows/s): {stats['subscribed']} subscribed "
+               f"({stats['created']} new accounts, {stats['new_profiles']} new profiles), {stats['existing']} already had "
+               f"an account, {stats['opted_out']} opted out (left unsubscribed), {stats['invalid']} invalid, "
+               f"{stats['duplicates']} duplicates, {stats['failed']} failed.")
+    if send_welcome:
+        click.echo(f"Welcome SMS queued for {stats['new_profiles']} new subscriber(s). Queue status: {get_outbound_queue().stats()}")
+
+@bp.cli.command("mood-stats")
+@click.option('--uid', default=None, help='Stats for this user (defaults to the cohort of all subscribed users).')
+@click.option('--days', 'window_days', type=click.IntRange(1, STATS_MAX_WINDOW_DAYS), default=30, help='Response-rate window.')
+def mood_stats_command(uid, window_days):
+    """Prints mood stats (streaks, weekday/emoji distributions, response rate) as JSON for one user or all subscribers."""
+    repository = get_repository()
+    if not repository:
+        click.echo("Storage not initialized. Cannot compute stats.", err=True)
+        return
+    mood_analytics = get_mood_analytics()
+    started_at = time.monotonic()
+    if uid:
+        profile = repository.get_user(uid) or {}
+        stats = mood_analytics.user_stats(uid, window_days, subscribed_since=_subscribed_since(profile.get('created_at')))
+    else:
+        cohort = ((user_uid, _subscribed_since(profile.get('created_at'))) for user_uid, profile in repository.iter_subscribed_profiles())
+        stats = mood_analytics.cohort_stats(cohort, window_days)
+    click.echo(json.dumps(stats, ensure_ascii=False, indent=2))
+    click.echo(f"Computed in {time.monotonic() - started_at:.2f}s. Cache: {mood_analytics.stats()}", err=True)
+
+@bp.cli.command("test-prompt")
 @click.option('--phone', required=True, help='Phone number (E.164) to send test prompt.')
 def test_prompt_command(phone):
-    if not db_firestore or not app_firebase_auth:
-        click.echo("Firebase not initialized. Cannot test prompt.", err=True)
+    repository = get_repository()
+    if not repository:
+        click.echo("Storage not initialized. Cannot test prompt.", err=True)
         return
     try:
-        firebase_user_record = app_firebase_auth.get_user_by_phone_number(phone)
-        user_uid = firebase_user_record.uid
-        user_doc = db_firestore.collection('users').document(user_uid).get()
-        if user_doc.exists and user_doc.to_dict().get('is_subscribed'):
+        user_profile = repository.get_user(repository.get_uid_by_phone(phone))
+        if user_profile and user_profile.get('is_subscribed'):
             if send_daily_mood_prompt_sms(phone):
                 click.echo(f"Test prompt sent to subscribed user {phone}")
             else:
                 click.echo(f"Failed to send test prompt to {phone}.", err=True)
         else:
-            click.echo(f"User {phone} not found or not subscribed in Firestore.", err=True)
-    except firebase_auth.UserNotFoundError:
-        click.echo(f"User with phone {phone} not found in Firebase Auth.", err=True)
+            click.echo(f"User {phone} not found or not subscribed.", err=True)
+    except UserNotFoundError:
+        click.echo(f"User with phone {phone} not found.", err=True)
     except Exception as e:
         click.echo(f"Error during test-prompt: {e}", err=True)
 
+@bp.cli.command("send-prompts")
+@click.option('--mode', type=click.Choice(['queue', 'parallel', 'sequential']), default=None, help='Dispatch mode (defaults to SMS_DISPATCH_MODE).')
+@click.option('--run-id', default=None, help='Scheduler lease run to join or resume (defaults to a new manual run).')
+def send_prompts_command(mode, run_id):
+    """Runs the daily prompt job now and prints the run stats."""
+    stats = scheduled_daily_prompt_job(dispatch_mode=mode, run_id=run_id or f"manual-{int(time.time())}")
+    if stats is None:
+        click.echo("Daily prompt run failed. See logs for details.", err=True)
+        return
+    if stats['mode'] == 'queue':
+        click.echo(f"Enqueued: {stats['enqueued']} in {stats['wall_time_seconds']}s. Queue status: {get_outbound_queue().stats()}")
+        return
+    click.echo(f"Sent: {stats['sent']}, failed: {stats['failed']}, "
+               f"wall time: {stats['wall_time_seconds']}s, throughput: {stats['throughput_per_second']} msg/s")
+
 
 # --- Main Execution Block ---
 if __name__ == '__main__':
+    # Run as a script this module is '__main__'; register it as 'app' too, so `import app` (async_server)
+    # gets this module instead of a second copy with its own OTP store, caches and Firebase app
+    sys.modules.setdefault('app', sys.modules[__name__])
     # db.create_all() # REMOVE SQLAlchemy specific call
+    app = create_app()
 
     if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
-        if not scheduler.running: # Check if Firebase was initialized before starting scheduler
-            if db_firestore:
+        scheduler = get_scheduler()
+        if not scheduler.running: # Check if storage was initialized before starting scheduler
+            if get_repository():
                 scheduler.start()
-                app.logger.info("APScheduler started for daily prompts.")
+                logger.info("APScheduler started for daily prompts.")
             else:
-                app.logger.error("APScheduler not started because Firebase is not initialized.")
+                logger.error("APScheduler not started because storage is not initialized.")
         else:
-            app.logger.info("APScheduler already running.")
+            logger.info("APScheduler already running.")
     else:
-        app.logger.info("APScheduler not started in this Flask reloader process.")
+        logger.info("APScheduler not started in this Flask reloader process.")
 
-    serve(app, host="0.0.0.0", port=5000)
\ No newline at end of file
+    # Start the outbound SMS workers now so anything spooled before a restart goes out right away
+    get_outbound_queue()
+    # Connect to storage and start the fast-ack writer before the first request rather than during it
+    get_repository()
+    get_inbound_sms_writer()
+
+    # Turn SIGTERM into a normal exit so atexit hooks run (e.g. draining the fast-ack write-behind buffer)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    async_server = None
+    if Config.SERVER_MODE == 'async':
+        try:
+            import async_server
+        except ImportError as e:
+            logger.error(f"SERVER_MODE=async needs aiohttp ({e}); serving with waitress instead.")
+    if async_server is not None:
+        async_server.serve(app, host="0.0.0.0", port=Config.SERVER_PORT)
+    else:
+        from waitress import serve
+        serve(app, host="0.0.0.0", port=Config.SERVER_PORT, threads=Config.SERVER_THREADS)
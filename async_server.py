@@ -0,0 +1,369 @@
+import asyncio
+import contextvars
+import io
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
+from urllib.parse import unquote_to_bytes
+
+from aiohttp import web
+from multidict import CIMultiDict
+from flask import flash, jsonify, redirect, session, url_for, request as flask_request
+
+from config import Config
+from sms_handler import format_phone_to_e164
+from sms_queue import enqueue_sms, PRIORITY_OTP
+from storage import UserNotFoundError
+from http_caching import etag_for, make_conditional
+from lazy import created_on_first_use
+from async_storage import AsyncFirestoreRepository, ExecutorRepository
+from app import (FirebaseUser, OTP_MESSAGE, generate_and_store_otp, get_firebase_clients, get_inbound_sms_writer,
+                 get_repository, otp_rate_limiter, phone_index, user_cache, _consent_changed, _entry_details,
+                 _entry_stamp, _mood_data_from_sms, _mood_entries_written, _sms_consent_change)
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Asyncio serving mode (SERVER_MODE=async) ---
+# aiohttp serves the routes that spend their time waiting on Firestore: the SMS webhook, the
+# calendar modal's /api/mood_entry/<date> and the OTP request on POST /login. They run as
+# coroutines on Firestore's async client, so a slow dependency holds a socket rather than a
+# thread, and a request's independent reads run concurrently. OTPs go out through the outbound
+# SMS queue's priority lane as in the WSGI mode, under the same sender rate limit.
+# Every other request (the HTML pages, the other APIs, /metrics, static files), and any request
+# the native routes can't answer on their own, goes to the unchanged Flask app in a thread pool
+# of SERVER_THREADS, with admission control as in the WSGI mode. The native routes don't hold a
+# thread, so they aren't under admission control's budgets; the per-phone OTP limit still applies.
+
+
+# Shared objects on the aiohttp application
+FLASK_APP = web.AppKey('flask_app', object)
+WSGI_BRIDGE = web.AppKey('wsgi_bridge', object)
+
+
+@created_on_first_use
+def get_async_repository():
+    """The async counterpart of app.get_repository(): Firestore's async client, or the sync backend in a thread pool."""
+    if Config.STORAGE_BACKEND != 'firestore':
+        repository = get_repository()
+        return ExecutorRepository(repository) if repository else None
+    db_firestore, app_firebase_auth = get_firebase_clients()
+    if db_firestore is None:
+        return None
+    from firebase_admin import firestore_async
+    return AsyncFirestoreRepository(firestore_async.client(), app_firebase_auth)
+
+
+def _observe(request, route, status, started_at):
+    """Same latency histogram as the Flask routes (see metrics.init_app)."""
+    metrics.http_request_duration.observe(time.perf_counter() - started_at, method=request.method, route=route, status=status)
+
+
+# --- WSGI bridge ---
+
+def wsgi_environ(request, body):
+    """A WSGI environ for an aiohttp request whose body has already been read."""
+    host, _, port = request.host.partition(':')
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': unquote_to_bytes(request.rel_url.raw_path).decode('latin-1'),
+        'QUERY_STRING': request.rel_url.raw_query_string,
+        'SERVER_NAME': host,
+        'SERVER_PORT': port or ('443' if request.scheme == 'https' else '80'),
+        'SERVER_PROTOCOL': f"HTTP/{request.version.major}.{request.version.minor}",
+        'REMOTE_ADDR': request.remote or '',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': request.scheme,
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in request.headers.items():
+        key = name.upper().replace('-', '_')
+        if key == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif key != 'CONTENT_LENGTH':
+            key = 'HTTP_' + key
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+_NO_MORE_CHUNKS = object()
+_HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'upgrade'}
+
+
+class WSGIBridge:
+    """
+    aiohttp handler that runs a WSGI app in a thread pool. Responses are streamed: each chunk is
+    produced in the pool and written as it comes (e.g. /api/export), and the app's iterable is
+    closed afterwards, which is what releases its admission slot.
+    """
+
+    def __init__(self, wsgi_app, max_threads):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_threads), thread_name_prefix='wsgi')
+
+    def _start(self, environ):
+        """Calls the app and produces the first chunk (start_response may be deferred until then)."""
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'], started['headers'] = status, headers
+            return lambda data: None # The write() callable: Flask doesn't use it
+
+        app_iter = self.wsgi_app(environ, start_response)
+        try:
+            chunks = iter(app_iter)
+            first_chunk = next(chunks, _NO_MORE_CHUNKS)
+        except BaseException:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+            raise
+        return app_iter, chunks, first_chunk, started['status'], started['headers']
+
+    async def __call__(self, request, body=None):
+        if body is None:
+            body = await request.read()
+        loop = asyncio.get_running_loop()
+        # Each step may run on a different thread; one context for all of them keeps Flask's
+        # context variables in place between chunks (e.g. for stream_with_context)
+        context = contextvars.copy_context()
+        app_iter, chunks, chunk, status, headers = await loop.run_in_executor(
+            self.executor, context.run, self._start, wsgi_environ(request, body))
+        try:
+            status_code, _, reason = status.partition(' ')
+            response = web.StreamResponse(status=int(status_code), reason=reason or None)
+            for name, value in headers:
+                if name.lower() not in _HOP_BY_HOP_HEADERS:
+                    response.headers.add(name, value)
+            await response.prepare(request)
+            while chunk is not _NO_MORE_CHUNKS:
+                if chunk:
+                    await response.write(chunk)
+                chunk = await loop.run_in_executor(self.executor, context.run, next, chunks, _NO_MORE_CHUNKS)
+            await response.write_eof()
+            return response
+        finally:
+            if hasattr(app_iter, 'close'):
+                await loop.run_in_executor(self.executor, context.run, app_iter.close)
+
+
+def _aiohttp_response(flask_response):
+    """Copies a (non-streamed) Flask response built inside a request context."""
+    headers = CIMultiDict((name, value) for name, value in flask_response.headers.items()
+                          if name.lower() not in _HOP_BY_HOP_HEADERS and name.lower() != 'content-length')
+    return web.Response(status=flask_response.status_code, body=flask_response.get_data(), headers=headers)
+
+
+def _save_session(flask_app, flask_response):
+    """What Flask does at the end of every request: writes the session cookie if it changed (or is refreshed)."""
+    flask_app.session_interface.save_session(flask_app, session, flask_response)
+    return flask_response
+
+
+# --- Native routes ---
+
+async def _load_user(repository, uid):
+    """FirebaseUser.get for the native routes: the process cache first, else one async profile read."""
+    user = user_cache.get(uid)
+    if user is not None:
+        return user
+    try:
+        user_data = await repository.get_user(uid)
+    except Exception as e:
+        logger.error(f"Error fetching user {uid}: {e}")
+        return None
+    if user_data is None:
+        return None
+    user = FirebaseUser(uid=uid, **user_data)
+    user_cache.set(uid, user)
+    return user
+
+
+async def _handle_inbound_sms(repository, from_number_e164, sms_body_original, entry_date_str, received_at):
+    """
+    app._handle_inbound_sms on the async repository; same outcomes. The mood entry is written here
+    (with its month rollup, in one transaction). Returns (outcome, mood_entry).
+    """
+    subscribed = _sms_consent_change(sms_body_original)
+    indexed = phone_index.get(from_number_e164)
+    if indexed:
+        user_uid, is_subscribed = indexed
+    else:
+        try:
+            user_uid = await repository.get_uid_by_phone(from_number_e164)
+        except UserNotFoundError:
+            logger.info(f"Webhook /sms/receive: SMS from phone {from_number_e164} not linked to any user.")
+            return 'not_registered', None
+        user_profile = await repository.get_user(user_uid)
+        is_subscribed = (user_profile or {}).get('is_subscribed', False)
+        phone_index.set(from_number_e164, (user_uid, is_subscribed))
+
+    if subscribed is not None:
+        await repository.set_subscription(user_uid, subscribed)
+        _consent_changed(user_uid, from_number_e164, subscribed)
+        return ('opted_in' if subscribed else 'opted_out'), None
+
+    if not is_subscribed:
+        logger.info(f"User {user_uid} ({from_number_e164}) sent message but is not subscribed. Ignoring.")
+        return 'not_subscribed', None
+    mood_entry = (user_uid, entry_date_str, _mood_data_from_sms(sms_body_original, received_at))
+    await repository.write_mood_entries([mood_entry])
+    _mood_entries_written([mood_entry])
+    return 'logged', mood_entry
+
+
+async def sms_receive(request):
+    """POST /sms/receive (see app.sms_receive)."""
+    started_at = time.perf_counter()
+    response = await _sms_receive(request)
+    _observe(request, '/sms/receive', response.status, started_at)
+    return response
+
+
+async def _sms_receive(request):
+    repository = get_async_repository()
+    logger.info("Recieved SMS")
+    if not repository:
+        logger.error("Webhook /sms/receive: Storage not initialized.")
+        return web.Response(status=500, text="Error: Service not configured")
+
+    form = await request.post()
+    from_number_raw = request.query.get('From', form.get('From')) # Query first, then form, as Flask's request.values
+    sms_body_original = request.query.get('Body', form.get('Body', ""))
+
+    from_number_e164 = format_phone_to_e164(from_number_raw)
+    if not from_number_e164:
+        return web.Response(status=400, text="Error: Invalid 'From' number format")
+
+    entry_date_str = date.today().isoformat()
+    received_at = datetime.now(timezone.utc)
+
+    inbound_sms_writer = get_inbound_sms_writer()
+    if inbound_sms_writer is not None:
+        # Never wait for room here: that would block the event loop. A full buffer is handled inline.
+        if inbound_sms_writer.submit((from_number_e164, sms_body_original, entry_date_str, received_at)):
+            return web.Response(status=204)
+        logger.warning("Webhook /sms/receive: Write-behind buffer full, processing SMS inline.")
+
+    try:
+        outcome, mood_entry = await _handle_inbound_sms(repository, from_number_e164, sms_body_original,
+                                                        entry_date_str, received_at)
+    except Exception as e:
+        logger.error(f"Webhook /sms/receive: Error processing SMS from {from_number_e164}: {e}")
+        return web.Response(status=500, text="Error: Could not process user")
+
+    if outcome == 'not_registered':
+        return web.Response(text="User not registered in Firebase Auth")
+    if outcome == 'not_subscribed':
+        return web.Response(text="User not subscribed")
+    if mood_entry:
+        logger.info(f"Webhook /sms/receive: Logged mood for user {mood_entry[0]} on {entry_date_str}")
+    return web.Response(status=204)
+
+
+async def get_mood_entry_details(request):
+    """GET /api/mood_entry/<date_str> (see app.get_mood_entry_details)."""
+    started_at = time.perf_counter()
+    flask_app, wsgi = request.app[FLASK_APP], request.app[WSGI_BRIDGE]
+    repository = get_async_repository()
+    date_str = request.match_info['date_str']
+    environ = wsgi_environ(request, b'')
+    with flask_app.request_context(environ):
+        uid = session.get('_user_id')
+    if uid is None or repository is None: # Not signed in, or only by remember-me cookie: Flask-Login decides
+        return await wsgi(request, b'')
+
+    # The session user's profile (what @login_required loads) and the entry don't depend on each other
+    user, entry_data = await asyncio.gather(_load_user(repository, uid), repository.get_entry(uid, date_str),
+                                            return_exceptions=True)
+    if user is None: # The account is gone: let Flask-Login answer as it would
+        return await wsgi(request, b'')
+
+    with flask_app.request_context(environ):
+        if isinstance(entry_data, Exception):
+            logger.error(f"API error fetching mood entry for user {uid}, date {date_str}: {entry_data}")
+            flask_response = jsonify({'error': f'Could not load mood details: {entry_data}'})
+            flask_response.status_code = 500
+        elif entry_data is not None:
+            flask_response = make_conditional(jsonify(_entry_details(date_str, entry_data)),
+                                              etag_for(uid, _entry_stamp(date_str, entry_data)),
+                                              entry_data.get('timestamp'))
+        else:
+            flask_response = jsonify({'error': 'No entry found for this date'})
+            flask_response.status_code = 404
+        response = _aiohttp_response(_save_session(flask_app, flask_response))
+    _observe(request, '/api/mood_entry/<string:date_str>', response.status, started_at)
+    return response
+
+
+def _send_otp(phone_number_e164):
+    """Generates and stores a code for the number and queues it on the OTP lane. Returns whether it was queued."""
+    otp_message = OTP_MESSAGE.format(otp=generate_and_store_otp(phone_number_e164))
+    return enqueue_sms(phone_number_e164, otp_message, PRIORITY_OTP)
+
+
+async def login(request):
+    """
+    POST /login when it sends a code: the OTP is queued on the outbound SMS queue's priority lane,
+    as app.login does. Anything else (already signed in, a bad number, the per-phone limit) is
+    answered by app.login.
+    """
+    started_at = time.perf_counter()
+    flask_app, wsgi = request.app[FLASK_APP], request.app[WSGI_BRIDGE]
+    body = await request.read()
+    environ = wsgi_environ(request, body)
+    remember_cookie = flask_app.config.get('REMEMBER_COOKIE_NAME', 'remember_token')
+    with flask_app.request_context(environ):
+        signed_in = session.get('_user_id') is not None or remember_cookie in flask_request.cookies
+        formatted_phone_e164 = format_phone_to_e164(flask_request.form.get('phone_number'))
+    if signed_in or not formatted_phone_e164 or not get_repository():
+        return await wsgi(request, body)
+    if not otp_rate_limiter.try_acquire(formatted_phone_e164):
+        return await wsgi(request, body) # Still over the limit there, so app.login answers 429
+
+    # Storing the code (in SQLite with OTP_STORE_BACKEND=sqlite) and queuing the SMS both block, so they run in the pool
+    sent = await asyncio.get_running_loop().run_in_executor(wsgi.executor, _send_otp, formatted_phone_e164)
+
+    with flask_app.request_context(environ):
+        if sent:
+            session['phone_for_verification'] = formatted_phone_e164
+            flash(f'OTP sent to {formatted_phone_e164}. Please check your messages.', 'info')
+            flask_response = redirect(url_for('main.verify_otp'))
+        else:
+            flash('Failed to send OTP...', 'danger')
+            logger.error(f"Failed to send OTP to {formatted_phone_e164}")
+            flask_response = redirect(url_for('main.login'))
+        response = _aiohttp_response(_save_session(flask_app, flask_response))
+    _observe(request, '/login', response.status, started_at)
+    return response
+
+
+async def _close_clients(aiohttp_app):
+    aiohttp_app[WSGI_BRIDGE].executor.shutdown(wait=False)
+
+
+def create_async_app(flask_app):
+    """The aiohttp application: the native routes, with everything else bridged to 'flask_app'."""
+    wsgi = WSGIBridge(flask_app, Config.SERVER_THREADS)
+    aiohttp_app = web.Application(client_max_size=16 * 1024 * 1024)
+    aiohttp_app[FLASK_APP] = flask_app
+    aiohttp_app[WSGI_BRIDGE] = wsgi
+    aiohttp_app.on_cleanup.append(_close_clients)
+    aiohttp_app.router.add_post('/sms/receive', sms_receive)
+    aiohttp_app.router.add_get('/api/mood_entry/{date_str}', get_mood_entry_details)
+    aiohttp_app.router.add_post('/login', login)
+    aiohttp_app.router.add_route('*', '/{path:.*}', wsgi)
+    return aiohttp_app
+
+
+def serve(flask_app, host='0.0.0.0', port=5000):
+    """Runs the async server until SIGINT/SIGTERM."""
+    logger.info(f"Serving on http://{host}:{port} (asyncio mode, {Config.SERVER_THREADS} threads for WSGI routes)")
+    web.run_app(create_async_app(flask_app), host=host, port=port, print=None, access_log=None)
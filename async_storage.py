@@ -0,0 +1,97 @@
+import asyncio
+import functools
+
+from metrics import instrumented
+from scheduler_shards import shard_bucket
+from storage import FirestoreRepository, UserNotFoundError
+
+# --- Async storage access (for async_server.py) ---
+# Kept out of storage.py so the WSGI server and CLI commands don't import asyncio at startup.
+
+
+class AsyncFirestoreRepository:
+    """
+    The Firestore backend on Firestore's AsyncClient: the part of Repository the async server's
+    routes use, as coroutines with the same arguments and results. Firebase Auth has no async
+    API, so the phone number lookup runs in the event loop's default thread pool.
+    """
+
+    MAX_BATCH_WRITES = FirestoreRepository.MAX_BATCH_WRITES
+
+    def __init__(self, db, auth):
+        from firebase_admin import firestore # Only needed by this backend
+        self.db = db # A firestore_async client
+        self.auth = auth
+        self._firestore = firestore
+
+    # Same document layout as FirestoreRepository; building references makes no calls
+    _user_ref = FirestoreRepository._user_ref
+    _entries_ref = FirestoreRepository._entries_ref
+    _rollup_ref = FirestoreRepository._rollup_ref
+    _rollup_writes = FirestoreRepository._rollup_writes
+    _mood_write_refs = FirestoreRepository._mood_write_refs
+    _mood_writes = FirestoreRepository._mood_writes
+
+    @instrumented('firebase_auth', 'get_user_by_phone_number', expected_errors=(UserNotFoundError,))
+    async def get_uid_by_phone(self, phone_number_e164):
+        def lookup():
+            try:
+                return self.auth.get_user_by_phone_number(phone_number_e164).uid
+            except self.auth.UserNotFoundError as e:
+                raise UserNotFoundError(phone_number_e164) from e
+        return await asyncio.get_running_loop().run_in_executor(None, lookup)
+
+    @instrumented('firestore', 'get_user')
+    async def get_user(self, uid):
+        user_doc = await self._user_ref(uid).get()
+        return user_doc.to_dict() if user_doc.exists else None
+
+    @instrumented('firestore', 'set_subscription')
+    async def set_subscription(self, uid, is_subscribed):
+        await self._user_ref(uid).update({'is_subscribed': is_subscribed,
+                                          'consent_updated_at': self._firestore.SERVER_TIMESTAMP,
+                                          'shard_bucket': shard_bucket(uid)})
+
+    @instrumented('firestore', 'get_entry')
+    async def get_entry(self, uid, date_str):
+        entry_doc = await self._entries_ref(uid).document(date_str).get()
+        return FirestoreRepository._stamped_entry_to_dict(entry_doc) if entry_doc.exists else None
+
+    async def _read_and_write(self, refs, build_writes):
+        """As FirestoreRepository._read_and_write."""
+        @self._firestore.async_transactional
+        async def _apply(transaction):
+            docs = dict.fromkeys(ref.path for ref in refs)
+            async for doc in self.db.get_all(refs, transaction=transaction):
+                if doc.exists:
+                    docs[doc.reference.path] = doc.to_dict()
+            for doc_ref, data, merge in build_writes(docs):
+                transaction.set(doc_ref, data, merge=merge)
+        await _apply(self.db.transaction())
+
+    @instrumented('firestore', 'write_mood_entries')
+    async def write_mood_entries(self, mood_writes):
+        """As Repository.write_mood_entries."""
+        for start in range(0, len(mood_writes), self.MAX_BATCH_WRITES // 2):
+            chunk = mood_writes[start:start + self.MAX_BATCH_WRITES // 2]
+            refs = self._mood_write_refs(chunk)
+            await self._read_and_write(refs, lambda docs, chunk=chunk: self._mood_writes(chunk, docs))
+
+
+class ExecutorRepository:
+    """
+    Async view of a synchronous repository: every method call becomes a coroutine that runs
+    the call in a thread pool. Lets the async server use backends without an async client (SQLite).
+    """
+
+    def __init__(self, repository, executor=None):
+        self.repository = repository
+        self._executor = executor # None: the event loop's default thread pool
+
+    def __getattr__(self, name):
+        method = getattr(self.repository, name)
+
+        async def call(*args, **kwargs):
+            return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(method, *args, **kwargs))
+        return call
+
@@ -0,0 +1,118 @@
+"""
+Smoke test for SERVER_MODE=async: starts `python app.py` the way production does, on the SQLite
+storage and OTP store backends with no Twilio credentials, and walks one phone number through
+POST /login -> POST /verify_otp -> GET /calendar. The OTP is read back from the outbound SMS queue file.
+
+    python benchmarks/async_smoke.py [--timeout 30]
+
+Exits 0 when the login succeeds, 1 (with the server's log) otherwise. Needs aiohttp.
+"""
+import argparse
+import http.cookiejar
+import os
+import re
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PHONE_NUMBER = '+14155550123'
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port, process, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"app.py exited with code {process.returncode} before listening")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"app.py did not listen on port {port} within {timeout:.0f}s")
+
+
+def _request(opener, base_url, method, path, form=None):
+    """Returns (status, Location header) without following redirects."""
+    data = urllib.parse.urlencode(form).encode() if form is not None else None
+    try:
+        with opener.open(urllib.request.Request(base_url + path, data=data, method=method), timeout=10) as response:
+            return response.status, response.headers.get('Location')
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers.get('Location')
+
+
+def _queued_otp(queue_path, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with sqlite3.connect(queue_path) as conn:
+            row = conn.execute("SELECT body FROM outbound_sms WHERE to_number = ? ORDER BY id DESC LIMIT 1",
+                               (PHONE_NUMBER,)).fetchone()
+        match = re.search(r'\d{6}', row[0]) if row else None
+        if match:
+            return match.group(0)
+        time.sleep(0.2)
+    raise RuntimeError("no OTP was queued for the test number")
+
+
+def run(timeout):
+    with tempfile.TemporaryDirectory() as tmp:
+        port = _free_port()
+        env = dict(os.environ, SECRET_KEY='smoke-test', SERVER_MODE='async', SERVER_PORT=str(port),
+                   STORAGE_BACKEND='sqlite', STORAGE_SQLITE_PATH=os.path.join(tmp, 'mood.sqlite3'),
+                   SMS_QUEUE_PATH=os.path.join(tmp, 'sms_queue.sqlite3'), SMS_QUEUE_BACKOFF_SECONDS='60',
+                   OTP_STORE_BACKEND='sqlite', OTP_STORE_PATH=os.path.join(tmp, 'otp_store.sqlite3'),
+                   PROFILE_DIR=os.path.join(tmp, 'profiles'))
+        for name in ('TWILIO_ACCOUNT_SID', 'TWILIO_AUTH_TOKEN', 'TWILIO_PHONE_NUMBER', 'FLASK_DEBUG'):
+            env.pop(name, None)
+        log_path = os.path.join(tmp, 'app.log')
+        with open(log_path, 'w') as log:
+            process = subprocess.Popen([sys.executable, 'app.py'], cwd=APP_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            _wait_for_port(port, process, timeout)
+            base_url = f"http://127.0.0.1:{port}"
+            opener = urllib.request.build_opener(_NoRedirect, urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+            status, location = _request(opener, base_url, 'POST', '/login', {'phone_number': PHONE_NUMBER})
+            assert status == 302 and location.endswith('/verify_otp'), f"POST /login: {status} -> {location}"
+            otp = _queued_otp(env['SMS_QUEUE_PATH'], timeout)
+            status, location = _request(opener, base_url, 'POST', '/verify_otp', {'otp': otp})
+            assert status == 302 and location.endswith('/calendar'), f"POST /verify_otp: {status} -> {location}"
+            status, _ = _request(opener, base_url, 'GET', '/calendar')
+            assert status == 200, f"GET /calendar: {status}"
+            print("OK: POST /login -> POST /verify_otp -> GET /calendar in SERVER_MODE=async")
+            return 0
+        except (AssertionError, RuntimeError) as e:
+            print(f"FAILED: {e}")
+            process.terminate()
+            process.wait(10)
+            with open(log_path) as log:
+                print(log.read())
+            return 1
+        finally:
+            if process.poll() is None:
+                process.terminate()
+                process.wait(10)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--timeout', type=float, default=30.0, help='Seconds to wait for the server and the OTP.')
+    sys.exit(run(parser.parse_args().timeout))
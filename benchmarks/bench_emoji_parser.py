@@ -0,0 +1,125 @@
+"""
+Micro-benchmark: emoji_parser vs. the original per-call regex in parse_mood_response.
+
+    python benchmarks/bench_emoji_parser.py [--bodies 20000] [--repeat 5]
+
+Prints per-body timings for both parsers and the parse_many batch path, then counts the
+bodies where they disagree (the legacy parser splits ZWJ/skin-tone/keycap sequences, runs
+adjacent emojis together and matches CJK text and other non-emoji symbols).
+
+The legacy parser's re.compile is a lookup in re's pattern cache, so the gap is small and its
+size depends on the machine and its load: parse_mood_response has measured from about 1.1x to
+2.6x faster per body across runs and machines. Compare the rows of one run, not across runs.
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from emoji_parser import find_emojis, parse_mood_response, parse_many  # noqa: E402
+
+
+def legacy_parse_mood_response(sms_body):
+    """parse_mood_response as it was in app.py: the pattern is rebuilt on every call."""
+    emoji_pattern = re.compile(
+        "["
+        "\U0001F600-\U0001F64F"  # Emoticons
+        "\U0001F300-\U0001F5FF"  # Symbols & Pictographs
+        "\U0001F680-\U0001F6FF"  # Transport & Map Symbols
+        "\U0001F1E0-\U0001F1FF"  # Regional Indicator Symbols (flags)
+        "\U00002600-\U000027BF"  # Miscellaneous Symbols
+        "\U0001F900-\U0001F9FF"  # Supplemental Symbols and Pictographs
+        "\U000024C2-\U0001F251"
+        "]+",
+        flags=re.UNICODE
+    )
+    match = emoji_pattern.search(sms_body)
+    return (match.group(0) if match else None), sms_body
+
+
+# Replies we see in practice: mostly an emoji with a few words, some long journal-style texts,
+# some STOP/START/no-emoji messages, and the sequences the legacy parser gets wrong.
+_TEMPLATES = [
+    "{e}",
+    "{e} {t}",
+    "{t} {e}",
+    "{e}{e}",
+    "{t}",
+    "STOP",
+    "START",
+    "{t} {t} {e} {t} {t} {t}",
+]
+_EMOJIS = [
+    "😊", "😢", "😡", "😴", "🥰", "🙂", "😐", "🤯", "❤️", "♠️", "☀️", "⭐",
+    "👍🏽", "👋🏿", "🏃‍♀️", "👨‍👩‍👧", "❤️‍🔥", "🇺🇸", "1️⃣", "🏳️‍🌈",
+]
+_TEXTS = [
+    "good day", "rough morning but better now", "tired", "had lunch with mom",
+    "work was stressful, meeting ran late and I missed the bus home",
+    "feeling okay I guess", "在家休息", "© 2025 notes", "→ gym later", "meh",
+]
+
+
+def build_corpus(size, seed=42):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        template = rng.choice(_TEMPLATES)
+        body = template
+        while "{e}" in body:
+            body = body.replace("{e}", rng.choice(_EMOJIS), 1)
+        while "{t}" in body:
+            body = body.replace("{t}", rng.choice(_TEXTS), 1)
+        corpus.append(body)
+    return corpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bodies', type=int, default=20000, help='Number of SMS bodies in the corpus.')
+    parser.add_argument('--repeat', type=int, default=5, help='Timing repeats (best is reported).')
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.bodies)
+    runs = {
+        'legacy (per-call re.compile)': lambda: [legacy_parse_mood_response(body) for body in corpus],
+        'emoji_parser.parse_mood_response': lambda: [parse_mood_response(body) for body in corpus],
+        'emoji_parser.parse_many': lambda: parse_many(corpus),
+    }
+
+    print(f"Corpus: {len(corpus)} SMS bodies, best of {args.repeat} runs")
+    baseline = None
+    for name, run in runs.items():
+        best = min(timeit.repeat(run, number=1, repeat=args.repeat))
+        per_body_us = best / len(corpus) * 1e6
+        baseline = baseline or per_body_us
+        print(f"  {name:<36} {per_body_us:8.3f} us/body  ({baseline / per_body_us:5.2f}x vs legacy)")
+
+    # Bucket disagreements by why the legacy result is wrong, with one example each
+    reasons = {}
+    for body in corpus:
+        legacy_emoji, _ = legacy_parse_mood_response(body)
+        new_emoji, _ = parse_mood_response(body)
+        if legacy_emoji == new_emoji:
+            continue
+        if legacy_emoji and not find_emojis(legacy_emoji):
+            reason = 'legacy matched non-emoji text'
+        elif new_emoji and legacy_emoji and new_emoji.startswith(legacy_emoji):
+            reason = 'legacy split a ZWJ/keycap/modifier sequence'
+        elif legacy_emoji and new_emoji and legacy_emoji.startswith(new_emoji):
+            reason = 'legacy ran several emojis together'
+        else:
+            reason = 'other'
+        count, example = reasons.get(reason, (0, (body, legacy_emoji, new_emoji)))
+        reasons[reason] = (count + 1, example)
+    print(f"\nBodies where the parsers disagree: {sum(count for count, _ in reasons.values())} of {len(corpus)}")
+    for reason, (count, (body, legacy_emoji, new_emoji)) in sorted(reasons.items()):
+        print(f"  {reason:<46} {count:6d}  e.g. {body!r}: legacy={legacy_emoji!r} new={new_emoji!r}")
+
+
+if __name__ == '__main__':
+    main()
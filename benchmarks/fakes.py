@@ -0,0 +1,336 @@
+"""
+In-process stand-ins for Firestore, Firebase Auth and Twilio, used by the benchmarks.
+
+Each fake sleeps for an injected latency on every round trip it would make over the network
+and counts it in a shared RemoteCalls, so a benchmark can report remote calls per request.
+Only the API surface the app uses is implemented.
+"""
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+
+class RemoteCalls:
+    """Thread-safe round-trip counters, keyed by dependency (e.g. 'firestore.read')."""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, kind, n=1):
+        with self._lock:
+            self._counts[kind] = self._counts.get(kind, 0) + n
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+    @staticmethod
+    def delta(after, before):
+        return {kind: count - before.get(kind, 0) for kind, count in after.items() if count - before.get(kind, 0)}
+
+
+class Latency:
+    """Sleeps for 'ms' milliseconds, +/- 'jitter' (a fraction), per simulated round trip."""
+
+    def __init__(self, ms=0.0, jitter=0.25, seed=None):
+        self.ms = ms
+        self.jitter = jitter
+        self._rng = random.Random(seed)
+
+    def wait(self):
+        if self.ms > 0:
+            spread = self.ms * self.jitter
+            time.sleep(max(0.0, self.ms + self._rng.uniform(-spread, spread)) / 1000.0)
+
+
+# --- Firestore ---
+
+class _Snapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class _DocumentReference:
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def collection(self, name):
+        return _CollectionReference(self._db, f"{self.path}/{name}")
+
+    def get(self, *args, transaction=None, **kwargs):
+        self._db._round_trip('firestore.read')
+        if transaction is not None:
+            transaction._lock_documents([self.path])
+        return _Snapshot(self, self._db._load(self.path))
+
+    def set(self, data, merge=False):
+        self._db._round_trip('firestore.write')
+        self._db._store(self.path, data, merge)
+
+    def update(self, data):
+        self._db._round_trip('firestore.write')
+        if self._db._load(self.path) is None:
+            raise KeyError(f"No document to update: {self.path}")
+        self._db._store(self.path, data, merge=True)
+
+
+class _Query:
+    def __init__(self, collection, filters=(), limit=None):
+        self._collection = collection
+        self._filters = tuple(filters)
+        self._limit = limit
+
+    def where(self, *args, filter=None):
+        condition = (filter.field_path, filter.op_string, filter.value) if filter is not None else args
+        return _Query(self._collection, self._filters + (condition,), self._limit)
+
+    def order_by(self, field, direction=None):
+        return self # Results always come back in document-ID order, which is all the app asks for
+
+    def limit(self, count):
+        return _Query(self._collection, self._filters, count)
+
+    def _matches(self, doc_id, data):
+        for field, op, value in self._filters:
+            if field == '__name__':
+                actual, value = doc_id, getattr(value, 'id', value)
+            else:
+                actual = data.get(field)
+            if actual is None:
+                return False
+            if not {'==': actual == value, '>': actual > value, '>=': actual >= value,
+                    '<': actual < value, '<=': actual <= value}[op]:
+                return False
+        return True
+
+    def stream(self):
+        db = self._collection._db
+        db._round_trip('firestore.query')
+        with db._lock:
+            docs = sorted(db._collections.get(self._collection.path, {}).items())
+        results = []
+        for doc_id, data in docs:
+            if self._matches(doc_id, data):
+                results.append(_Snapshot(self._collection.document(doc_id), dict(data)))
+                if self._limit and len(results) == self._limit:
+                    break
+        return iter(results)
+
+
+class _CollectionReference(_Query):
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+        super().__init__(self)
+
+    def document(self, doc_id=None):
+        return _DocumentReference(self._db, f"{self.path}/{doc_id or uuid.uuid4().hex[:20]}")
+
+
+class _WriteBatch:
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append((reference.path, data, merge))
+
+    def update(self, reference, data):
+        self._writes.append((reference.path, data, True))
+
+    def commit(self):
+        self._db._round_trip('firestore.commit')
+        with self._db._lock:
+            for path, data, merge in self._writes:
+                self._db._store(path, data, merge)
+        return []
+
+
+class _Transaction(_WriteBatch):
+    """
+    What firestore.transactional needs from a transaction. Like Firestore's server client
+    libraries, it locks the documents it reads until it commits or rolls back, so a concurrent
+    transaction reading them waits (or gets Aborted after LOCK_TIMEOUT_SECONDS).
+    """
+
+    LOCK_TIMEOUT_SECONDS = 30.0
+    _read_only = False
+    _max_attempts = 5
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._id = None
+        self._locked = {}
+
+    def _clean_up(self):
+        self._writes = []
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._db._round_trip('firestore.begin_transaction')
+        self._id = uuid.uuid4().hex
+
+    def _lock_documents(self, paths):
+        for path in sorted(set(paths) - set(self._locked)): # One order for every transaction, so no deadlocks
+            lock = self._db._document_lock(path)
+            if not lock.acquire(timeout=self.LOCK_TIMEOUT_SECONDS):
+                from google.api_core import exceptions # Only needed once transactions are used
+                raise exceptions.Aborted(f"Timed out waiting for a lock on {path}")
+            self._locked[path] = lock
+
+    def _release(self):
+        for lock in self._locked.values():
+            lock.release()
+        self._locked = {}
+
+    def _commit(self):
+        try:
+            return self.commit()
+        finally:
+            self._clean_up()
+            self._release()
+
+    def _rollback(self):
+        self._clean_up()
+        self._release()
+
+
+class FakeFirestore:
+    """A Firestore client kept in memory: {collection path: {document id: data}}."""
+
+    def __init__(self, calls=None, latency=None):
+        self.calls = calls or RemoteCalls()
+        self.latency = latency or Latency()
+        self._collections = {}
+        self._lock = threading.RLock() # Also held across a whole commit, to make it atomic
+        self._document_locks = {}
+
+    def _round_trip(self, kind):
+        self.calls.record(kind)
+        self.latency.wait()
+
+    def _document_lock(self, path):
+        with self._lock:
+            return self._document_locks.setdefault(path, threading.Lock())
+
+    def _load(self, path):
+        collection_path, doc_id = path.rsplit('/', 1)
+        with self._lock:
+            data = self._collections.get(collection_path, {}).get(doc_id)
+            return dict(data) if data is not None else None
+
+    def _store(self, path, data, merge):
+        collection_path, doc_id = path.rsplit('/', 1)
+        resolved = {key: self._resolve(value) for key, value in data.items()}
+        with self._lock:
+            docs = self._collections.setdefault(collection_path, {})
+            if merge and doc_id in docs:
+                docs[doc_id].update(resolved)
+            else:
+                docs[doc_id] = resolved
+
+    @staticmethod
+    def _resolve(value):
+        # firestore.SERVER_TIMESTAMP is a Sentinel; store the time it would have been resolved to
+        return datetime.now(timezone.utc) if type(value).__name__ == 'Sentinel' else value
+
+    def seed(self, path, data):
+        """Writes a document without latency or counting (test setup)."""
+        self._store(path, data, merge=False)
+
+    def collection(self, name):
+        return _CollectionReference(self, name)
+
+    def document(self, path):
+        return _DocumentReference(self, path)
+
+    def batch(self):
+        return _WriteBatch(self)
+
+    def transaction(self):
+        return _Transaction(self)
+
+    def get_all(self, references, *args, transaction=None, **kwargs):
+        self._round_trip('firestore.get_all')
+        if transaction is not None:
+            transaction._lock_documents([reference.path for reference in references])
+        return [_Snapshot(reference, self._load(reference.path)) for reference in references]
+
+
+# --- Firebase Auth ---
+
+class _UserRecord:
+    def __init__(self, uid, phone_number):
+        self.uid = uid
+        self.phone_number = phone_number
+
+
+class FakeFirebaseAuth:
+    """Stands in for the firebase_admin.auth module."""
+
+    class UserNotFoundError(Exception):
+        pass
+
+    def __init__(self, calls=None, latency=None):
+        self.calls = calls or RemoteCalls()
+        self.latency = latency or Latency()
+        self._uids_by_phone = {}
+        self._lock = threading.Lock()
+
+    def seed(self, uid, phone_number):
+        self._uids_by_phone[phone_number] = uid
+
+    def get_user_by_phone_number(self, phone_number):
+        self.calls.record('auth.get_user_by_phone_number')
+        self.latency.wait()
+        with self._lock:
+            uid = self._uids_by_phone.get(phone_number)
+        if uid is None:
+            raise self.UserNotFoundError(f"No user record found for the provided phone number: {phone_number}")
+        return _UserRecord(uid, phone_number)
+
+    def create_user(self, phone_number=None, **kwargs):
+        self.calls.record('auth.create_user')
+        self.latency.wait()
+        uid = uuid.uuid4().hex[:28]
+        with self._lock:
+            self._uids_by_phone[phone_number] = uid
+        return _UserRecord(uid, phone_number)
+
+
+# --- Twilio ---
+
+class _Message:
+    def __init__(self):
+        self.sid = 'SM' + uuid.uuid4().hex
+
+
+class _Messages:
+    def __init__(self, client):
+        self._client = client
+
+    def create(self, body=None, from_=None, to=None, **kwargs):
+        self._client.calls.record('twilio.messages.create')
+        self._client.latency.wait()
+        return _Message()
+
+
+class FakeTwilioClient:
+    """Stands in for twilio.rest.Client; only client.messages.create() is used."""
+
+    def __init__(self, calls=None, latency=None):
+        self.calls = calls or RemoteCalls()
+        self.latency = latency or Latency()
+        self.messages = _Messages(self)
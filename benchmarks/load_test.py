@@ -0,0 +1,355 @@
+"""
+Offline load test: runs the app under waitress against in-process fakes for Firestore,
+Firebase Auth and Twilio (benchmarks/fakes.py) with injected latency, and drives it at
+fixed concurrency levels.
+
+    python benchmarks/load_test.py [--concurrency 1,8,32] [--requests 400]
+                                   [--firestore-ms 20 --auth-ms 40 --twilio-ms 150]
+                                   [--save-baseline bench.json] [--compare bench.json]
+
+Scenarios: POST /sms/receive, GET /calendar, GET /api/mood_entry/<date>, POST /login,
+and the daily prompt job (scheduled_daily_prompt_job, with --concurrency used as its
+worker count). Each result reports requests/sec, p50/p95/p99 latency and remote calls per
+request by dependency. --save-baseline writes the results as JSON; --compare prints the
+change against a saved baseline and exits 1 if throughput or p95 regressed by more than
+--threshold percent. Admission control and the per-phone OTP limit are off unless
+ADMISSION_CONTROL=on / OTP_PHONE_BURST are set (shed requests then count as errors).
+"""
+import argparse
+import contextlib
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from fakes import FakeFirebaseAuth, FakeFirestore, FakeTwilioClient, Latency, RemoteCalls  # noqa: E402
+
+SCENARIOS = ('sms_receive', 'calendar', 'mood_entry', 'login', 'daily_prompts')
+SEED_EMOJIS = ["😊", "😢", "😡", "😴", "🥰", "🙂", "😐", "👍🏽"]
+
+
+def load_app(args):
+    """Imports app.py configured for the benchmark, wires in the fakes and builds the Flask app."""
+    work_dir = tempfile.mkdtemp(prefix='mood-bench-')
+    os.environ.update({
+        'SMS_QUEUE_PATH': os.path.join(work_dir, 'sms_queue.sqlite3'),
+        'SMS_WEBHOOK_MODE': args.webhook_mode,
+        'SMS_WRITE_BEHIND_SPOOL_PATH': os.path.join(work_dir, 'sms_write_behind_spool.sqlite3'),
+        'SECRET_KEY': os.environ.get('SECRET_KEY') or 'load-test',
+        # Measure the app itself: no 503 shedding and no per-phone OTP limit unless asked for
+        'ADMISSION_CONTROL': os.environ.get('ADMISSION_CONTROL', 'off'),
+        'OTP_PHONE_BURST': os.environ.get('OTP_PHONE_BURST', '1000000'),
+    })
+    import app as app_module
+    import sms_handler
+    from config import Config
+    from storage import FirestoreRepository
+
+    calls = RemoteCalls()
+    db = FakeFirestore(calls, Latency(args.firestore_ms, seed=1))
+    auth = FakeFirebaseAuth(calls, Latency(args.auth_ms, seed=2))
+    app_module.get_repository.override(FirestoreRepository(db, auth))
+    sms_handler._twilio_client = FakeTwilioClient(calls, Latency(args.twilio_ms, seed=3))
+    Config.TWILIO_PHONE_NUMBER = Config.TWILIO_PHONE_NUMBER or '+14155550100'
+    Config.SMS_MAX_MESSAGES_PER_SECOND = args.sms_rate
+    return app_module, app_module.create_app(), db, auth, calls
+
+
+def seed_users(db, auth, user_count, days):
+    """Creates subscribed users with 'days' of mood entries and matching monthly rollups."""
+    from mood_rollups import build_month_rollup, month_key
+    rng = random.Random(7)
+    today = date.today()
+    users = []
+    for i in range(user_count):
+        uid = f"bench-user-{i:06d}"
+        phone = f"+1415{2000000 + i}"
+        auth.seed(uid, phone)
+        db.seed(f"users/{uid}", {'phone_number': phone, 'is_subscribed': True})
+        days_by_month = {}
+        for offset in range(days):
+            day = (today - timedelta(days=offset)).isoformat()
+            emoji = rng.choice(SEED_EMOJIS)
+            db.seed(f"users/{uid}/mood_entries/{day}", {'entry_date': day, 'emoji': emoji, 'text_response': f"{emoji} seeded"})
+            days_by_month.setdefault(month_key(day), {})[day] = emoji
+        for month, month_days in days_by_month.items():
+            db.seed(f"users/{uid}/mood_months/{month}", build_month_rollup(month, month_days))
+        users.append((uid, phone))
+    return users
+
+
+def session_cookie(flask_app, uid):
+    """A signed Flask session cookie that Flask-Login accepts as a logged-in user."""
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    return f"{flask_app.config.get('SESSION_COOKIE_NAME', 'session')}={serializer.dumps({'_user_id': uid, '_fresh': True})}"
+
+
+def build_request_factory(scenario, flask_app, users):
+    """Returns make_request(rng) -> (method, path, body, headers, expected_statuses)."""
+    form_headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    cookies = {uid: session_cookie(flask_app, uid) for uid, _ in users}
+    today = date.today()
+
+    if scenario == 'sms_receive':
+        def make_request(rng):
+            _, phone = rng.choice(users)
+            body = urlencode({'From': phone, 'Body': f"{rng.choice(SEED_EMOJIS)} load test"})
+            return 'POST', '/sms/receive', body, form_headers, (200, 204)
+    elif scenario == 'calendar':
+        def make_request(rng):
+            uid, _ = rng.choice(users)
+            return 'GET', '/calendar', None, {'Cookie': cookies[uid]}, (200,)
+    elif scenario == 'mood_entry':
+        def make_request(rng):
+            uid, _ = rng.choice(users)
+            day = (today - timedelta(days=rng.randrange(30))).isoformat()
+            return 'GET', f'/api/mood_entry/{day}', None, {'Cookie': cookies[uid]}, (200, 404)
+    elif scenario == 'login':
+        def make_request(rng):
+            _, phone = rng.choice(users)
+            return 'POST', '/login', urlencode({'phone_number': phone}), form_headers, (302,)
+    else:
+        raise ValueError(f"Not an HTTP scenario: {scenario}")
+    return make_request
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(latencies, errors, wall_time, calls_delta, count):
+    latencies = sorted(latencies)
+    return {
+        'requests': count,
+        'errors': errors,
+        'wall_time_seconds': round(wall_time, 3),
+        'requests_per_second': round(count / wall_time, 2) if wall_time > 0 else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        'remote_calls_per_request': round(sum(calls_delta.values()) / count, 3) if count else 0.0,
+        'remote_calls_by_dependency': {kind: round(n / count, 3) for kind, n in sorted(calls_delta.items())} if count else {},
+    }
+
+
+def run_http_scenario(port, make_request, concurrency, total_requests, calls, seed, settle=None):
+    """
+    Sends total_requests requests from 'concurrency' keep-alive connections.
+    'settle' runs after timing stops and before remote calls are counted, so background work
+    the requests caused (e.g. queued OTP sends) is attributed to them without skewing latency.
+    """
+    latencies = []
+    errors = [0]
+    remaining = [total_requests]
+    lock = threading.Lock()
+
+    def worker(worker_id):
+        rng = random.Random(seed * 1000 + worker_id)
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        local_latencies = []
+        local_errors = 0
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            method, path, body, headers, expected = make_request(rng)
+            started_at = time.perf_counter()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                ok = response.status in expected
+                if response.will_close:
+                    connection.close()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                ok = False
+            local_latencies.append(time.perf_counter() - started_at)
+            local_errors += not ok
+        connection.close()
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+
+    before = calls.snapshot()
+    started_at = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - started_at
+    if settle:
+        settle()
+    return summarize(latencies, errors[0], wall_time, RemoteCalls.delta(calls.snapshot(), before), total_requests)
+
+
+def run_prompt_scenario(app_module, concurrency, calls):
+    """Runs the daily prompt job once in 'parallel' mode with 'concurrency' send workers."""
+    from config import Config
+    Config.SMS_DISPATCH_WORKERS = concurrency
+    before = calls.snapshot()
+    started_at = time.perf_counter()
+    stats = app_module.scheduled_daily_prompt_job(dispatch_mode='parallel') or {'sent': 0, 'failed': 0}
+    wall_time = time.perf_counter() - started_at
+    total = stats['sent'] + stats['failed']
+    return summarize([], stats['failed'], wall_time, RemoteCalls.delta(calls.snapshot(), before), total)
+
+
+def wait_for_outbound_queue(timeout=60.0):
+    """Lets queued SMS (e.g. OTPs from /login) go out so they don't bleed into the next scenario."""
+    from sms_queue import get_outbound_queue
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and get_outbound_queue().stats().get('pending'):
+        time.sleep(0.1)
+
+
+def wait_for_write_behind(app_module, calls, timeout=60.0):
+    """
+    In fast_ack mode, lets the webhook's write-behind buffer flush what the requests queued:
+    waits until the buffer is empty and no remote calls have happened for a flush interval.
+    """
+    writer = app_module.get_inbound_sms_writer()
+    if writer is None:
+        return
+    quiet_for = writer.flush_interval_seconds + 0.5
+    deadline = time.monotonic() + timeout
+    last_counts, quiet_since = calls.snapshot(), time.monotonic()
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        counts = calls.snapshot()
+        if counts != last_counts or writer.qsize():
+            last_counts, quiet_since = counts, time.monotonic()
+        elif time.monotonic() - quiet_since >= quiet_for:
+            return
+
+
+def compare_to_baseline(results, baseline, threshold_pct):
+    """Prints changes vs. the baseline. Returns the list of regressed result keys."""
+    regressions = []
+    print(f"\nCompared to baseline ({baseline.get('meta', {}).get('created_at', 'unknown date')}):")
+    for key, result in results.items():
+        old = baseline.get('results', {}).get(key)
+        if not old:
+            print(f"  {key:<24} (not in baseline)")
+            continue
+        rps_change = _pct_change(old['requests_per_second'], result['requests_per_second'])
+        p95_change = _pct_change(old.get('p95_ms'), result.get('p95_ms'))
+        regressed = (rps_change is not None and rps_change < -threshold_pct) or \
+                    (p95_change is not None and p95_change > threshold_pct)
+        if regressed:
+            regressions.append(key)
+        print(f"  {key:<24} rps {_fmt_change(rps_change)}  p95 {_fmt_change(p95_change)}"
+              f"  calls/req {old['remote_calls_per_request']} -> {result['remote_calls_per_request']}"
+              f"{'  REGRESSED' if regressed else ''}")
+    return regressions
+
+
+def _pct_change(old, new):
+    if old in (None, 0) or new is None:
+        return None
+    return (new - old) / old * 100.0
+
+
+def _fmt_change(change):
+    return '   n/a' if change is None else f"{change:+6.1f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma-separated subset of: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--concurrency', default='1,8,32', help='Comma-separated concurrency levels.')
+    parser.add_argument('--requests', type=int, default=400, help='Requests per scenario and concurrency level.')
+    parser.add_argument('--users', type=int, default=200, help='Seeded users (each gets a subscribed profile).')
+    parser.add_argument('--days', type=int, default=45, help='Days of seeded mood entries per user.')
+    parser.add_argument('--firestore-ms', type=float, default=20.0, help='Injected latency per Firestore round trip.')
+    parser.add_argument('--auth-ms', type=float, default=40.0, help='Injected latency per Firebase Auth call.')
+    parser.add_argument('--twilio-ms', type=float, default=150.0, help='Injected latency per Twilio API call.')
+    parser.add_argument('--sms-rate', type=float, default=1000.0, help='SMS_MAX_MESSAGES_PER_SECOND used during the run.')
+    parser.add_argument('--webhook-mode', choices=['sync', 'fast_ack'], default='sync', help='SMS_WEBHOOK_MODE for the run.')
+    parser.add_argument('--server-threads', type=int, default=None, help='Waitress threads (defaults to the highest concurrency).')
+    parser.add_argument('--save-baseline', metavar='PATH', help='Write results as a JSON baseline.')
+    parser.add_argument('--compare', metavar='PATH', help='Compare results against a saved JSON baseline.')
+    parser.add_argument('--threshold', type=float, default=15.0, help='Regression threshold in percent (default 15).')
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenario(s): {', '.join(sorted(unknown))}")
+    levels = [int(level) for level in args.concurrency.split(',')]
+
+    from waitress import create_server
+
+    app_module, flask_app, db, auth, calls = load_app(args)
+    logging.getLogger().setLevel(logging.WARNING) # Per-request INFO lines would swamp the report
+    flask_app.logger.setLevel(logging.WARNING)
+    logging.getLogger('waitress.queue').setLevel(logging.ERROR) # 'Task queue depth' is expected at high concurrency
+    users = seed_users(db, auth, args.users, args.days)
+    server = create_server(flask_app, host='127.0.0.1', port=0,
+                           threads=args.server_threads or max(levels), connection_limit=max(levels) * 2 + 10)
+    threading.Thread(target=server.run, name='waitress', daemon=True).start()
+    port = server.effective_port
+
+    print(f"Seeded {len(users)} users x {args.days} days. Latency: firestore={args.firestore_ms}ms "
+          f"auth={args.auth_ms}ms twilio={args.twilio_ms}ms. Webhook mode: {args.webhook_mode}.")
+    print(f"{'scenario':<24} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7} {'calls/req':>10}")
+
+    results = {}
+    for scenario in scenarios:
+        for concurrency in levels:
+            # The app prints per message (e.g. 'SMS sent to ...'); keep the report readable
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                if scenario == 'daily_prompts':
+                    result = run_prompt_scenario(app_module, concurrency, calls)
+                else:
+                    make_request = build_request_factory(scenario, flask_app, users)
+                    settle = {'login': wait_for_outbound_queue,
+                              'sms_receive': lambda: wait_for_write_behind(app_module, calls)}.get(scenario)
+                    result = run_http_scenario(port, make_request, concurrency, args.requests, calls,
+                                               seed=concurrency, settle=settle)
+            key = f"{scenario}@{concurrency}"
+            results[key] = result
+            fmt = lambda value: f"{value:9.2f}" if value is not None else f"{'-':>9}"
+            print(f"{key:<24} {result['requests_per_second']:9.2f} {fmt(result['p50_ms'])} {fmt(result['p95_ms'])} "
+                  f"{fmt(result['p99_ms'])} {result['errors']:7d} {result['remote_calls_per_request']:10.3f}  "
+                  f"{result['remote_calls_by_dependency']}")
+
+    regressions = []
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare_to_baseline(results, json.load(f), args.threshold)
+    if args.save_baseline:
+        baseline = {
+            'meta': {
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'args': {key: value for key, value in vars(args).items() if key not in ('save_baseline', 'compare')},
+            },
+            'results': results,
+        }
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"\nBaseline written to {args.save_baseline}")
+    if regressions:
+        print(f"\n{len(regressions)} result(s) regressed by more than {args.threshold}%: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
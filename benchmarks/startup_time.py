@@ -0,0 +1,109 @@
+"""
+Cold-start benchmark: how long a fresh process takes to import app.py and build the Flask app,
+which every worker start and every `flask <command>` pays.
+
+    python benchmarks/startup_time.py [--runs 15] [--budget-ms 350] [--importtime]
+
+Each run is a new interpreter, so nothing is warm except the OS file cache. Prints the median,
+p90 and best in-process time (import + create_app) and the whole process's wall time, and exits
+1 if the median is over --budget-ms. --importtime also lists the slowest imports (python -X importtime).
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PACKAGE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Prints the seconds spent importing app.py and building the app. Older trees built the app at import.
+CHILD_SCRIPT = """
+import time
+started_at = time.perf_counter()
+import app
+create_app = getattr(app, 'create_app', None)
+if create_app is not None:
+    create_app()
+print(time.perf_counter() - started_at)
+"""
+
+
+def child_env():
+    """Environment for a cold start: local SQLite files and no real credentials, so nothing leaves the host."""
+    work_dir = tempfile.mkdtemp(prefix='mood-startup-')
+    env = dict(os.environ)
+    env.update({
+        'SECRET_KEY': env.get('SECRET_KEY') or 'startup-benchmark',
+        'SMS_QUEUE_PATH': os.path.join(work_dir, 'sms_queue.sqlite3'),
+    })
+    env.pop('PYTHONDONTWRITEBYTECODE', None) # Measure with .pyc files, as a deployed worker runs
+    return env
+
+
+def run_once(env):
+    """Returns (in-process seconds, process wall seconds) for one cold start."""
+    started_at = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', CHILD_SCRIPT], cwd=PACKAGE_DIR, env=env,
+                            capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - started_at
+    return float(result.stdout.strip().splitlines()[-1]), wall
+
+
+def slowest_imports(env, top=15):
+    """Returns [(cumulative microseconds, module)] for app.py's slowest direct imports."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHILD_SCRIPT], cwd=PACKAGE_DIR, env=env,
+                            capture_output=True, text=True, check=True)
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            continue # The header line
+        # -X importtime indents two spaces per nesting level: ' app', then '   flask', ...
+        if len(name) - len(name.lstrip()) == 3:
+            timings.append((int(cumulative), name.strip()))
+    return sorted(timings, reverse=True)[:top]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=15, help='Cold starts to measure.')
+    parser.add_argument('--budget-ms', type=float, default=350.0,
+                        help='Fail (exit 1) if the median import + create_app time is above this.')
+    parser.add_argument('--importtime', action='store_true', help='Also list the slowest imports.')
+    args = parser.parse_args()
+
+    env = child_env()
+    run_once(env) # Warm the OS file cache and write .pyc files, as a deployed worker would have them
+    samples = [run_once(env) for _ in range(args.runs)]
+    in_process_ms = [seconds * 1000 for seconds, _ in samples]
+    wall_ms = [wall * 1000 for _, wall in samples]
+
+    print(f"Cold start over {args.runs} runs (python {sys.version.split()[0]}):")
+    print(f"  import + create_app: median {statistics.median(in_process_ms):.1f} ms, "
+          f"p90 {percentile(in_process_ms, 0.9):.1f} ms, best {min(in_process_ms):.1f} ms")
+    print(f"  whole process:       median {statistics.median(wall_ms):.1f} ms, "
+          f"p90 {percentile(wall_ms, 0.9):.1f} ms, best {min(wall_ms):.1f} ms")
+
+    if args.importtime:
+        print("Slowest imports (cumulative):")
+        for microseconds, module in slowest_imports(env):
+            print(f"  {microseconds / 1000:8.1f} ms  {module}")
+
+    median_ms = statistics.median(in_process_ms)
+    if median_ms > args.budget_ms:
+        print(f"Over budget: median {median_ms:.1f} ms > {args.budget_ms:.0f} ms")
+        sys.exit(1)
+    print(f"Within budget ({args.budget_ms:.0f} ms).")
+
+
+if __name__ == '__main__':
+    main()
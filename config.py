@@ -13,6 +13,123 @@ class Config:
     TWILIO_ACCOUNT_SID = os.environ.get('TWILIO_ACCOUNT_SID')
     TWILIO_AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN')
     TWILIO_PHONE_NUMBER = os.environ.get('TWILIO_PHONE_NUMBER')
+    # Shared keep-alive connection pool used by the process-wide Twilio client
+    TWILIO_HTTP_POOL_SIZE = int(os.environ.get('TWILIO_HTTP_POOL_SIZE', '10'))
+    TWILIO_HTTP_CONNECT_TIMEOUT = float(os.environ.get('TWILIO_HTTP_CONNECT_TIMEOUT', '5'))
+    TWILIO_HTTP_READ_TIMEOUT = float(os.environ.get('TWILIO_HTTP_READ_TIMEOUT', '15'))
     APP_BASE_URL = os.environ.get('APP_BASE_URL')
 
+    # Daily prompt fan-out: 'queue' spools prompts on the outbound SMS queue,
+    # 'parallel' sends inline over a bounded worker pool, 'sequential' sends one at a time
+    SMS_DISPATCH_MODE = os.environ.get('SMS_DISPATCH_MODE', 'queue').lower()
+    SMS_DISPATCH_WORKERS = int(os.environ.get('SMS_DISPATCH_WORKERS', '8'))
+    # Match this to the sender's cap (Twilio long codes: 1 msg/sec, toll-free: 3, short codes: 100).
+    # It is shared by every process on a host through SMS_QUEUE_PATH; with several hosts sending from
+    # the same number, set it to the cap divided by the number of hosts.
+    SMS_MAX_MESSAGES_PER_SECOND = float(os.environ.get('SMS_MAX_MESSAGES_PER_SECOND', '1'))
+
+    # Durable outbound SMS queue (SQLite spool + background workers)
+    SMS_QUEUE_PATH = os.environ.get('SMS_QUEUE_PATH', os.path.join(basedir, 'instance', 'sms_queue.sqlite3'))
+    SMS_QUEUE_WORKERS = int(os.environ.get('SMS_QUEUE_WORKERS', '4'))
+    SMS_QUEUE_MAX_ATTEMPTS = int(os.environ.get('SMS_QUEUE_MAX_ATTEMPTS', '5'))
+    SMS_QUEUE_BACKOFF_SECONDS = float(os.environ.get('SMS_QUEUE_BACKOFF_SECONDS', '2'))
+    SMS_QUEUE_BACKOFF_MAX_SECONDS = float(os.environ.get('SMS_QUEUE_BACKOFF_MAX_SECONDS', '300'))
+
+    # Pending OTP codes: 'memory' (one process) or 'sqlite' (shared by all processes on this host)
+    OTP_STORE_BACKEND = os.environ.get('OTP_STORE_BACKEND', 'memory').lower()
+    OTP_STORE_PATH = os.environ.get('OTP_STORE_PATH', os.path.join(basedir, 'instance', 'otp_store.sqlite3'))
+    OTP_STORE_CAPACITY = int(os.environ.get('OTP_STORE_CAPACITY', '10000'))
+    OTP_TTL_MINUTES = int(os.environ.get('OTP_TTL_MINUTES', '10'))
+
+    # /sms/receive mode: 'sync' writes before answering Twilio; 'fast_ack' queues the message,
+    # answers 204 immediately and writes entries in the background in Firestore batches
+    SMS_WEBHOOK_MODE = os.environ.get('SMS_WEBHOOK_MODE', 'sync').lower()
+    SMS_WRITE_BEHIND_MAX_QUEUE = int(os.environ.get('SMS_WRITE_BEHIND_MAX_QUEUE', '10000'))
+    SMS_WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('SMS_WRITE_BEHIND_BATCH_SIZE', '200'))
+    SMS_WRITE_BEHIND_FLUSH_SECONDS = float(os.environ.get('SMS_WRITE_BEHIND_FLUSH_SECONDS', '1'))
+    # Messages whose write failed wait here for a retry (survives restarts)
+    SMS_WRITE_BEHIND_SPOOL_PATH = os.environ.get('SMS_WRITE_BEHIND_SPOOL_PATH', os.path.join(basedir, 'instance', 'sms_write_behind_spool.sqlite3'))
+    SMS_WEBHOOK_ENQUEUE_TIMEOUT_SECONDS = float(os.environ.get('SMS_WEBHOOK_ENQUEUE_TIMEOUT_SECONDS', '2'))
+
+    # In-process phone -> (uid, is_subscribed) index used by the /sms/receive webhook
+    PHONE_INDEX_MAX_ENTRIES = int(os.environ.get('PHONE_INDEX_MAX_ENTRIES', '100000'))
+    PHONE_INDEX_TTL_SECONDS = float(os.environ.get('PHONE_INDEX_TTL_SECONDS', '3600'))
+
+    # Per-process LRU+TTL cache of FirebaseUser objects used by Flask-Login's user loader
+    USER_CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', '10000'))
+    USER_CACHE_TTL_SECONDS = float(os.environ.get('USER_CACHE_TTL_SECONDS', '300'))
+
+    # Admission control (see admission.py): concurrent requests and wait-queue slots per route class.
+    # Keep the totals below SERVER_THREADS so /metrics, static files and the 503s themselves always get a thread.
+    # The webhook class is never shed (Twilio doesn't retry): over budget, fast-ack mode spools mood replies
+    # (see write_behind.py) and anything else is handled inline anyway.
+    SERVER_THREADS = int(os.environ.get('SERVER_THREADS', '16'))
+    # 'wsgi' (waitress) or 'async': aiohttp serves /sms/receive, /api/mood_entry/<date> and the OTP request
+    # on Firestore's async client, and runs every other route on the Flask app in SERVER_THREADS threads
+    SERVER_MODE = os.environ.get('SERVER_MODE', 'wsgi').lower()
+    SERVER_PORT = int(os.environ.get('SERVER_PORT', '5000'))
+    ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL', 'on').lower() in ('on', 'true', '1')
+    ADMISSION_WEBHOOK_CONCURRENCY = int(os.environ.get('ADMISSION_WEBHOOK_CONCURRENCY', '4'))
+    ADMISSION_WEBHOOK_QUEUE = int(os.environ.get('ADMISSION_WEBHOOK_QUEUE', '2'))
+    ADMISSION_INTERACTIVE_CONCURRENCY = int(os.environ.get('ADMISSION_INTERACTIVE_CONCURRENCY', '4'))
+    ADMISSION_INTERACTIVE_QUEUE = int(os.environ.get('ADMISSION_INTERACTIVE_QUEUE', '2'))
+    ADMISSION_OTP_CONCURRENCY = int(os.environ.get('ADMISSION_OTP_CONCURRENCY', '2'))
+    ADMISSION_OTP_QUEUE = int(os.environ.get('ADMISSION_OTP_QUEUE', '1'))
+    ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT_SECONDS', '1'))
+    ADMISSION_RETRY_AFTER_SECONDS = float(os.environ.get('ADMISSION_RETRY_AFTER_SECONDS', '2'))
+
+    # Per-phone OTP rate limit on /login: a burst of codes, then one more every OTP_PHONE_REFILL_SECONDS
+    OTP_PHONE_BURST = int(os.environ.get('OTP_PHONE_BURST', '3'))
+    OTP_PHONE_REFILL_SECONDS = float(os.environ.get('OTP_PHONE_REFILL_SECONDS', '300'))
+
+    # Memoized phone number normalization (sms_handler.format_phone_to_e164), per process
+    PHONE_FORMAT_CACHE_SIZE = int(os.environ.get('PHONE_FORMAT_CACHE_SIZE', '100000'))
+
+    # `flask import-subscribers`: accounts per batch and batches written in parallel
+    SUBSCRIBER_IMPORT_BATCH_SIZE = int(os.environ.get('SUBSCRIBER_IMPORT_BATCH_SIZE', '500'))
+    SUBSCRIBER_IMPORT_WORKERS = int(os.environ.get('SUBSCRIBER_IMPORT_WORKERS', '4'))
+
+    # Per-process cache of rendered calendar month fragments and month JSON, keyed by (uid, YYYY-MM).
+    # Writes invalidate their month in the writing process; the TTLs bound staleness in other processes.
+    FRAGMENT_CACHE_MAX_BYTES = int(os.environ.get('FRAGMENT_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+    FRAGMENT_CACHE_TTL_SECONDS = float(os.environ.get('FRAGMENT_CACHE_TTL_SECONDS', '30')) # Current month
+    FRAGMENT_CACHE_PAST_MONTH_TTL_SECONDS = float(os.environ.get('FRAGMENT_CACHE_PAST_MONTH_TTL_SECONDS', '86400'))
+
+    # Per-process columnar entry cache behind /api/stats and `flask mood-stats` (see mood_analytics.py)
+    ANALYTICS_CACHE_MAX_USERS = int(os.environ.get('ANALYTICS_CACHE_MAX_USERS', '10000'))
+    ANALYTICS_CACHE_TTL_SECONDS = float(os.environ.get('ANALYTICS_CACHE_TTL_SECONDS', '900'))
+
+    # Opt-in profiling (see profiling.py): a fraction of requests, requests sending X-Profile-Request with
+    # PROFILE_HEADER_TOKEN, and a fraction of daily prompt runs write cProfile + collapsed-stack files
+    PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(basedir, 'instance', 'profiles'))
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+    PROFILE_HEADER_TOKEN = os.environ.get('PROFILE_HEADER_TOKEN') or None
+    PROFILE_JOB_SAMPLE_RATE = float(os.environ.get('PROFILE_JOB_SAMPLE_RATE', '0'))
+    PROFILE_MAX_DUMPS = int(os.environ.get('PROFILE_MAX_DUMPS', '20')) # Per route or job
+    PROFILE_SAMPLE_INTERVAL_MS = float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', '5'))
+
+    # Where users and mood entries live: 'firestore' (Firestore + Firebase Auth) or 'sqlite' (local file)
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'firestore').lower()
+    STORAGE_SQLITE_PATH = os.environ.get('STORAGE_SQLITE_PATH', os.path.join(basedir, 'instance', 'mood.sqlite3'))
+
+    # Daily prompt coordination across app instances: 'none' (single instance), 'sqlite' (processes on
+    # one host) or 'firestore' (any host). Sharding needs shard_bucket on profiles: flask backfill-shard-buckets
+    SCHEDULER_LEASE_BACKEND = os.environ.get('SCHEDULER_LEASE_BACKEND', 'none').lower()
+    SCHEDULER_LEASE_PATH = os.environ.get('SCHEDULER_LEASE_PATH', os.path.join(basedir, 'instance', 'scheduler_leases.sqlite3'))
+    SCHEDULER_SHARDS = int(os.environ.get('SCHEDULER_SHARDS', '8'))
+    SCHEDULER_LEASE_TTL_SECONDS = float(os.environ.get('SCHEDULER_LEASE_TTL_SECONDS', '60'))
+    SCHEDULER_RUN_WINDOW_SECONDS = float(os.environ.get('SCHEDULER_RUN_WINDOW_SECONDS', '3600'))
+    SCHEDULER_CHECKPOINT_EVERY = int(os.environ.get('SCHEDULER_CHECKPOINT_EVERY', '200'))
+
+    # Daily prompt timing: 'cron' sends everyone at SMS_CRON_JOB_HOUR:SMS_CRON_JOB_MINUTE (Los Angeles time);
+    # 'slots' sends each user at their own local prompt time (see prompt_schedule.py)
+    PROMPT_SCHEDULING = os.environ.get('PROMPT_SCHEDULING', 'cron').lower()
+    PROMPT_DEFAULT_TIMEZONE = os.environ.get('PROMPT_DEFAULT_TIMEZONE', 'America/Los_Angeles')
+    PROMPT_DEFAULT_TIME = os.environ.get('PROMPT_DEFAULT_TIME', '09:15')
+    # Users without a prompt time of their own are spread over this many minutes after the default time
+    PROMPT_DEFAULT_STAGGER_MINUTES = int(os.environ.get('PROMPT_DEFAULT_STAGGER_MINUTES', '60'))
+    # The last dispatched slot; after downtime, missed slots up to this many minutes old are still sent
+    PROMPT_SLOT_STATE_PATH = os.environ.get('PROMPT_SLOT_STATE_PATH', os.path.join(basedir, 'instance', 'prompt_slot_state.txt'))
+    PROMPT_SLOT_CATCH_UP_MINUTES = int(os.environ.get('PROMPT_SLOT_CATCH_UP_MINUTES', '60'))
+
     FLASK_DEBUG = os.environ.get('FLASK_DEBUG', 'False').lower() in ('true', '1', 't')
\ No newline at end of file
@@ -0,0 +1,107 @@
+import re
+
+# --- Emoji tokenizer, compiled once at import ---
+# Matches whole emoji grapheme clusters (after Unicode TS #51): keycaps, flag pairs, tag
+# sequences (e.g. 🏴 subdivision flags) and ZWJ sequences of pictographs with optional VS16
+# and skin-tone modifiers, so "👍🏽", "👨‍👩‍👧" and "1️⃣" come back as one emoji each.
+
+# Pictographs that display as emoji by default: the supplementary-plane pictograph blocks plus
+# the BMP symbol/dingbat ranges that phones send as emoji even without a VS16.
+_EMOJI_BASE = (
+    "\U0001F000-\U0001F0FF"  # Mahjong, Domino, Playing Cards
+    "\U0001F10D-\U0001F10F\U0001F12F\U0001F16C-\U0001F171\U0001F17E\U0001F17F\U0001F18E"
+    "\U0001F191-\U0001F19A"  # Squared words (🆗, 🆘, ...)
+    "\U0001F201-\U0001F20F\U0001F21A\U0001F22F\U0001F232-\U0001F23A\U0001F250\U0001F251"
+    "\U0001F300-\U0001F3FA"  # Symbols & Pictographs (skin tones 1F3FB-1F3FF are modifiers, below)
+    "\U0001F400-\U0001F64F"  # ... and Emoticons
+    "\U0001F680-\U0001F6FF"  # Transport & Map Symbols
+    "\U0001F7E0-\U0001F7EB"  # Coloured circles and squares
+    "\U0001F90C-\U0001F9FF"  # Supplemental Symbols and Pictographs
+    "\U0001FA70-\U0001FAFF"  # Symbols and Pictographs Extended-A
+    "\u231A\u231B\u23E9-\u23F3\u23F8-\u23FA\u25FD\u25FE"
+    "\u2600-\u27BF"          # Miscellaneous Symbols, Dingbats
+    "\u2B1B\u2B1C\u2B50\u2B55"
+)
+# Pictographs that are text by default (©, ™, ↔, ...): only emoji when followed by VS16.
+_TEXT_DEFAULT_PICTOGRAPH = (
+    "\u00A9\u00AE\u203C\u2049\u2122\u2139\u2194-\u2199\u21A9\u21AA\u2328\u23CF"
+    "\u24C2\u25AA\u25AB\u25B6\u25C0\u25FB\u25FC\u2934\u2935\u2B05-\u2B07\u3030\u303D\u3297\u3299"
+)
+_VS16 = "\uFE0F"
+_ZWJ = "\u200D"
+_SKIN_TONE = "[\U0001F3FB-\U0001F3FF]"
+
+_ELEMENT = f"(?:[{_EMOJI_BASE}]{_VS16}?|[{_TEXT_DEFAULT_PICTOGRAPH}]{_VS16}){_SKIN_TONE}?"
+_KEYCAP = f"[0-9#*]{_VS16}?\u20E3"
+_FLAG = "[\U0001F1E6-\U0001F1FF]{2}"
+_TAG_SEQUENCE = "\U0001F3F4[\U000E0020-\U000E007E]+\U000E007F"
+
+EMOJI_PATTERN = re.compile(
+    f"{_KEYCAP}|{_FLAG}|{_TAG_SEQUENCE}"
+    f"|{_ELEMENT}(?:{_ZWJ}{_ELEMENT})*"
+    f"|{_SKIN_TONE}"  # A lone skin-tone swatch is an emoji too
+)
+
+
+# Scanning text with EMOJI_PATTERN directly is slow: its leading alternation defeats the
+# regex engine's first-character skip. Instead, find candidate positions with a cheap
+# character class (any character an emoji can start with, or U+20E3 for keycaps, whose
+# base digit comes just before it) and only run the full pattern there.
+_CANDIDATE = re.compile(
+    "[\u00A9\u00AE\u203C\u2049\u20E3\u2122\u2139\u2194-\u2199\u21A9\u21AA\u231A\u231B\u2328\u23CF"
+    "\u23E9-\u23F3\u23F8-\u23FA\u24C2\u25AA\u25AB\u25B6\u25C0\u25FB-\u25FE\u2600-\u27BF\u2934\u2935"
+    "\u2B05-\u2B07\u2B1B\u2B1C\u2B50\u2B55\u3030\u303D\u3297\u3299\U0001F000-\U0001FAFF]"
+)
+
+def _iter_emoji_matches(text):
+    # Every emoji cluster contains a non-ASCII code point (even keycaps end in U+20E3), so
+    # plain-ASCII bodies like "STOP" or "good day" skip the scan entirely.
+    if not text or text.isascii():
+        return
+    search_candidate = _CANDIDATE.search
+    match_emoji = EMOJI_PATTERN.match
+    pos = 0
+    while True:
+        candidate = search_candidate(text, pos)
+        if candidate is None:
+            return
+        start = candidate.start()
+        if text[start] == "\u20E3": # Keycap: back up to its base ("1\u20E3" or "1\uFE0F\u20E3")
+            start -= 2 if text[start - 1:start] == _VS16 else 1
+            start = max(start, pos)
+        match = match_emoji(text, start)
+        if match:
+            yield match
+            pos = match.end()
+        else:
+            pos = candidate.end()
+
+def find_emojis(text):
+    """Returns every emoji grapheme cluster in 'text', in order."""
+    return [match.group(0) for match in _iter_emoji_matches(text)]
+
+def first_emoji(text):
+    """Returns the first emoji grapheme cluster in 'text', or None."""
+    if not text or text.isascii():
+        return None
+    # Same scan as _iter_emoji_matches, inlined: this runs on every inbound SMS
+    pos = 0
+    while True:
+        candidate = _CANDIDATE.search(text, pos)
+        if candidate is None:
+            return None
+        start = candidate.start()
+        if text[start] == "\u20E3":
+            start = max(start - (2 if text[start - 1:start] == _VS16 else 1), pos)
+        match = EMOJI_PATTERN.match(text, start)
+        if match:
+            return match.group(0)
+        pos = candidate.end()
+
+def parse_mood_response(sms_body):
+    """Returns (detected_emoji, full_text_response) for an inbound SMS body."""
+    return first_emoji(sms_body), sms_body
+
+def parse_many(bodies):
+    """Batch version of parse_mood_response, e.g. for re-parsing stored history."""
+    return [(first_emoji(body), body) for body in bodies]
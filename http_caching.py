@@ -0,0 +1,39 @@
+import hashlib
+from datetime import datetime, timezone
+
+from flask import request
+
+# --- Conditional GET ---
+# Month rollups and mood entries carry a version (bumped on every SMS write, see
+# mood_rollups.apply_entry_to_rollup) and a write time. Responses built from them get an ETag and
+# Last-Modified, and a browser that already has the current version gets an empty 304 instead.
+# Pages are per user, so they are marked private and revalidated on every use.
+
+CACHE_CONTROL = 'private, no-cache'
+
+
+def etag_for(*parts):
+    """A short, stable ETag value for the given parts (e.g. uid, date, version, write time)."""
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:20]
+
+
+def as_datetime(value):
+    """A timezone-aware datetime from a stored write time (a datetime, an ISO string or None)."""
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if not isinstance(value, datetime):
+        return None
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def make_conditional(response, etag, last_modified=None):
+    """Sets the validators on 'response' and turns it into a 304 if the request's copy is current."""
+    response.set_etag(etag)
+    last_modified = as_datetime(last_modified)
+    if last_modified is not None:
+        response.last_modified = last_modified.replace(microsecond=0)
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response.make_conditional(request)
@@ -0,0 +1,32 @@
+import functools
+import threading
+
+
+def created_on_first_use(factory):
+    """
+    Decorator for a zero-argument factory: the first call builds the object (once, even when
+    several threads ask at the same time) and every later call returns the same one.
+    override(value) replaces it, e.g. with a fake in benchmarks; if_created() returns it without
+    building it (None if nothing has asked for it yet).
+    """
+    lock = threading.Lock()
+    state = {}
+
+    @functools.wraps(factory)
+    def get():
+        if 'value' not in state:
+            with lock:
+                if 'value' not in state:
+                    state['value'] = factory()
+        return state['value']
+
+    def override(value):
+        with lock:
+            state['value'] = value
+
+    def if_created():
+        return state.get('value')
+
+    get.override = override
+    get.if_created = if_created
+    return get
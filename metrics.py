@@ -0,0 +1,298 @@
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+
+# --- In-process metrics, exposed in the Prometheus text format ---
+# Per-route request latency, per-dependency call latency/errors (Firestore, Firebase Auth,
+# Twilio, SQLite) and daily prompt runs. Values are per process; with several waitress
+# processes, scrape each one (Prometheus sums them per series).
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SCHEDULER_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._series = {}  # tuple of label values -> series state
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _render_series(self, key, state):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            series = sorted((key, self._snapshot(state)) for key, state in self._series.items())
+        for key, state in series:
+            lines.extend(self._render_series(key, state))
+        return lines
+
+    @staticmethod
+    def _snapshot(state):
+        return state
+
+
+class Counter(_Metric):
+    """Monotonic count per label set."""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._series.get(self._key(labels), 0)
+
+    def _render_series(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Gauge(_Metric):
+    """Last set value per label set."""
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = value
+
+    def _render_series(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram per label set (observations in seconds)."""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._series.get(key)
+            if state is None:
+                state = self._series[key] = [[0] * len(self.buckets), 0.0, 0]  # bucket counts, sum, count
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @staticmethod
+    def _snapshot(state):
+        return [list(state[0]), state[1], state[2]]
+
+    def _render_series(self, key, state):
+        bucket_counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, bucket_counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format (version 0.0.4)."""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+http_request_duration = REGISTRY.register(Histogram(
+    'mood_http_request_duration_seconds', 'HTTP request latency by route.', ('method', 'route', 'status')))
+dependency_duration = REGISTRY.register(Histogram(
+    'mood_dependency_duration_seconds', 'Latency of calls to external services.', ('dependency', 'operation')))
+dependency_errors = REGISTRY.register(Counter(
+    'mood_dependency_errors_total', 'Failed calls to external services.', ('dependency', 'operation')))
+scheduler_run_duration = REGISTRY.register(Histogram(
+    'mood_scheduler_run_duration_seconds', 'Duration of daily prompt runs.', ('mode',), buckets=SCHEDULER_BUCKETS))
+scheduler_messages = REGISTRY.register(Counter(
+    'mood_scheduler_messages_total', 'Daily prompt messages by outcome (sent, failed, enqueued).', ('mode', 'outcome')))
+scheduler_runs = REGISTRY.register(Counter(
+    'mood_scheduler_runs_total', 'Daily prompt runs by result (ok, error).', ('mode', 'result')))
+scheduler_last_run = REGISTRY.register(Gauge(
+    'mood_scheduler_last_run_timestamp_seconds', 'Unix time the last daily prompt run finished.', ('mode',)))
+admission_in_flight = REGISTRY.register(Gauge(
+    'mood_admission_in_flight', 'Requests being served per route class (see admission.py).', ('route_class',)))
+admission_rejected = REGISTRY.register(Counter(
+    'mood_admission_rejected_total', 'Requests shed with a 503 because their route class was full.', ('route_class',)))
+admission_over_budget = REGISTRY.register(Counter(
+    'mood_admission_over_budget_total', 'Requests of a never-shed route class served while it was full.', ('route_class',)))
+otp_rate_limited = REGISTRY.register(Counter(
+    'mood_otp_rate_limited_total', 'OTP requests refused by the per-phone rate limit.'))
+fragment_cache_lookups = REGISTRY.register(Counter(
+    'mood_fragment_cache_lookups_total', 'Calendar month fragment cache lookups by result (hit, miss).', ('result',)))
+fragment_cache_bytes = REGISTRY.register(Gauge(
+    'mood_fragment_cache_bytes', 'Size of the cached calendar month fragments.'))
+fragment_cache_entries = REGISTRY.register(Gauge(
+    'mood_fragment_cache_entries', 'Calendar month fragments in the cache.'))
+profiles_captured = REGISTRY.register(Counter(
+    'mood_profiles_captured_total', 'Profiles written by route or job (see profiling.py).', ('target',)))
+
+
+# --- Dependency timing ---
+
+@contextmanager
+def track_dependency(dependency, operation, expected_errors=()):
+    """
+    Times one call to an external service. Exceptions are counted as errors and re-raised,
+    except 'expected_errors' (e.g. a not-found lookup), which are normal answers.
+    """
+    started_at = time.perf_counter()
+    try:
+        yield
+    except expected_errors:
+        raise
+    except Exception:
+        dependency_errors.inc(dependency=dependency, operation=operation)
+        raise
+    finally:
+        dependency_duration.observe(time.perf_counter() - started_at, dependency=dependency, operation=operation)
+
+
+def instrumented(dependency, operation, expected_errors=()):
+    """
+    Decorator form of track_dependency. For generators (e.g. streamed queries) only the time
+    spent producing items counts, not the time the caller spends between items. Coroutine
+    functions are timed from the call until their result (e.g. the async Firestore client).
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def coroutine_wrapper(*args, **kwargs):
+                with track_dependency(dependency, operation, expected_errors):
+                    return await func(*args, **kwargs)
+            return coroutine_wrapper
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                generator = func(*args, **kwargs)
+                elapsed = 0.0
+                try:
+                    while True:
+                        started_at = time.perf_counter()
+                        try:
+                            item = next(generator)
+                        except StopIteration:
+                            return
+                        except expected_errors:
+                            raise
+                        except Exception:
+                            dependency_errors.inc(dependency=dependency, operation=operation)
+                            raise
+                        finally:
+                            elapsed += time.perf_counter() - started_at
+                        yield item
+                finally:
+                    generator.close()
+                    dependency_duration.observe(elapsed, dependency=dependency, operation=operation)
+            return generator_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with track_dependency(dependency, operation, expected_errors):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# --- Scheduler runs ---
+
+def record_scheduler_run(mode, stats, duration_seconds):
+    """Records one daily prompt run. 'stats' is the job's stats dict, or None if it failed."""
+    scheduler_run_duration.observe(duration_seconds, mode=mode)
+    scheduler_runs.inc(mode=mode, result='ok' if stats is not None else 'error')
+    scheduler_last_run.set(time.time(), mode=mode)
+    if stats is None:
+        return
+    for outcome in ('sent', 'failed', 'enqueued'):
+        if stats.get(outcome):
+            scheduler_messages.inc(stats[outcome], mode=mode, outcome=outcome)
+
+
+# --- Flask integration ---
+
+def init_app(app, endpoint='/metrics'):
+    """Times every request by route template (e.g. /api/mood_entry/<string:date_str>) and serves 'endpoint'."""
+    from flask import g, request
+
+    def _observe(status):
+        started_at = g.pop('_metrics_started_at', None)
+        if started_at is None:
+            return
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        http_request_duration.observe(time.perf_counter() - started_at,
+                                      method=request.method, route=route, status=status)
+
+    @app.before_request
+    def _start_request_timer():
+        g._metrics_started_at = time.perf_counter()
+
+    @app.after_request
+    def _record_request_metrics(response):
+        _observe(response.status_code)
+        return response
+
+    @app.teardown_request
+    def _record_failed_request(exception):
+        if exception is not None:
+            _observe(500) # after_request didn't run
+
+    @app.route(endpoint)
+    def metrics():
+        return REGISTRY.render(), 200, {'Content-Type': CONTENT_TYPE}
@@ -0,0 +1,226 @@
+import threading
+from datetime import date
+
+import numpy as np
+
+from cache import TTLCache
+
+# --- Mood analytics ---
+# Each user's entries are cached as two parallel NumPy arrays sorted by day: date ordinals
+# (date.toordinal()) and interned emoji codes. That is 8 bytes per entry instead of a dict per
+# entry. Streaks, weekday distribution, emoji frequencies and trends, and response rates are all
+# computed with vectorized array operations. A cohort is summarized by concatenating its users'
+# arrays. The cache is filled from storage on first use and kept current by record_entry(),
+# which the SMS write path calls.
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+TREND_MONTHS = 12
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+class EmojiCodes:
+    """Interns emoji strings as small integer codes, shared by every user's columns."""
+
+    def __init__(self):
+        self._codes = {}
+        self._emojis = []
+        self._lock = threading.Lock()
+
+    def code(self, emoji):
+        code = self._codes.get(emoji)
+        if code is None:
+            with self._lock:
+                code = self._codes.get(emoji)
+                if code is None:
+                    code = self._codes[emoji] = len(self._emojis)
+                    self._emojis.append(emoji)
+        return code
+
+    def emoji(self, code):
+        return self._emojis[code]
+
+    def __len__(self):
+        return len(self._emojis)
+
+
+class EntryColumns:
+    """One user's entries as parallel, day-sorted arrays. Never mutated: updates build a new instance."""
+    __slots__ = ('ordinals', 'codes')
+
+    def __init__(self, ordinals, codes):
+        self.ordinals = ordinals
+        self.codes = codes
+
+    @classmethod
+    def from_entries(cls, entries, emoji_codes):
+        """Builds the columns from (date_str, emoji) pairs; a later pair for the same day wins."""
+        days = {date.fromisoformat(date_str).toordinal(): emoji_codes.code(emoji or '') for date_str, emoji in entries}
+        ordinals = np.fromiter(sorted(days), dtype=np.int32, count=len(days))
+        codes = np.fromiter((days[ordinal] for ordinal in ordinals.tolist()), dtype=np.int32, count=len(days))
+        return cls(ordinals, codes)
+
+    def with_entry(self, date_str, code):
+        """Returns the columns with date_str's emoji set (inserted, or replaced if the day has one)."""
+        ordinal = date.fromisoformat(date_str).toordinal()
+        index = int(np.searchsorted(self.ordinals, ordinal))
+        if index < len(self.ordinals) and self.ordinals[index] == ordinal:
+            codes = self.codes.copy()
+            codes[index] = code
+            return EntryColumns(self.ordinals, codes)
+        return EntryColumns(np.insert(self.ordinals, index, ordinal), np.insert(self.codes, index, code))
+
+    def __len__(self):
+        return len(self.ordinals)
+
+
+def _streaks(ordinals, today_ordinal):
+    """(longest, current) runs of consecutive days; the current run must reach today or yesterday."""
+    if len(ordinals) == 0:
+        return 0, 0
+    breaks = np.flatnonzero(np.diff(ordinals) != 1)
+    run_starts = np.concatenate(([0], breaks + 1))
+    run_ends = np.concatenate((breaks, [len(ordinals) - 1]))
+    lengths = run_ends - run_starts + 1
+    current = int(lengths[-1]) if ordinals[-1] >= today_ordinal - 1 else 0
+    return int(lengths.max()), current
+
+
+def _emoji_counts(codes, emoji_codes):
+    """{emoji: count}, most frequent first."""
+    counts = np.bincount(codes, minlength=len(emoji_codes))
+    order = np.argsort(-counts, kind='stable')
+    return {emoji_codes.emoji(code): int(counts[code]) for code in order.tolist() if counts[code]}
+
+
+def _monthly_emoji_counts(ordinals, codes, today, emoji_codes):
+    """{'YYYY-MM': {emoji: count}} for the last TREND_MONTHS months (months without entries are left out)."""
+    months = (ordinals - _EPOCH_ORDINAL).astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    first_month = (today.year - 1970) * 12 + today.month - TREND_MONTHS
+    in_range = months >= first_month
+    width = max(1, len(emoji_codes))
+    cells = (months[in_range] - first_month) * width + codes[in_range]
+    grid = np.bincount(cells, minlength=TREND_MONTHS * width)[:TREND_MONTHS * width].reshape(TREND_MONTHS, width)
+    trend = {}
+    for row in np.flatnonzero(grid.any(axis=1)).tolist():
+        year, month = divmod(first_month + row, 12)
+        trend[f"{1970 + year:04d}-{month + 1:02d}"] = {emoji_codes.emoji(code): int(grid[row, code])
+                                                        for code in np.flatnonzero(grid[row]).tolist()}
+    return trend
+
+
+def _summary(ordinals, codes, today, emoji_codes):
+    """The stats that are plain sums over entries, so they work the same for one user or a cohort."""
+    weekday_counts = np.bincount((ordinals - 1) % 7, minlength=7) # toordinal() 1 is a Monday
+    return {
+        'entry_count': int(len(ordinals)),
+        'weekday_counts': dict(zip(WEEKDAYS, weekday_counts.tolist())),
+        'emoji_counts': _emoji_counts(codes, emoji_codes),
+        'emoji_trend': _monthly_emoji_counts(ordinals, codes, today, emoji_codes),
+    }
+
+
+def _response_window(today_ordinal, window_days, subscribed_since):
+    """
+    (first day ordinal, daily prompts sent) for the last window_days, counting from the day the
+    user subscribed if that is later: one prompt per day.
+    """
+    first_ordinal = today_ordinal - window_days + 1
+    if subscribed_since is not None:
+        first_ordinal = max(first_ordinal, subscribed_since.toordinal())
+    return first_ordinal, max(0, today_ordinal - first_ordinal + 1)
+
+
+def _responses(ordinals, first_ordinal, today_ordinal):
+    """Days with an entry from first_ordinal through today (ordinals are sorted)."""
+    return int(np.searchsorted(ordinals, today_ordinal, side='right') - np.searchsorted(ordinals, first_ordinal))
+
+
+class MoodAnalytics:
+    """Per-process columnar entry cache (LRU + TTL per user) and the stats computed over it."""
+
+    def __init__(self, repository, max_users=10000, ttl=300.0):
+        self.repository = repository
+        self.emoji_codes = EmojiCodes()
+        self._columns = TTLCache(maxsize=max_users, ttl=ttl)
+        self._lock = threading.Lock() # Serializes record_entry's read-modify-write per process
+
+    def columns(self, uid):
+        """Returns the user's EntryColumns, loading them from storage on a cache miss."""
+        columns = self._columns.get(uid)
+        if columns is None:
+            entries = ((date_str, entry.get('emoji')) for date_str, entry in self.repository.iter_entries(uid))
+            columns = EntryColumns.from_entries(entries, self.emoji_codes)
+            self._columns.set(uid, columns)
+        return columns
+
+    def record_entry(self, uid, date_str, emoji):
+        """Applies a just-written entry to a cached user (users not in the cache are loaded fresh when asked for)."""
+        with self._lock:
+            columns = self._columns.get(uid)
+            if columns is not None:
+                self._columns.set(uid, columns.with_entry(date_str, self.emoji_codes.code(emoji or '')))
+
+    def user_stats(self, uid, window_days=30, subscribed_since=None, today=None):
+        """
+        Stats for one user: entry count, longest/current streak, weekday distribution, emoji
+        frequencies and monthly trend, and the response rate over the last window_days
+        (days with an entry / daily prompts sent, counting prompts from subscribed_since).
+        """
+        today = today or date.today()
+        today_ordinal = today.toordinal()
+        columns = self.columns(uid)
+        longest_streak, current_streak = _streaks(columns.ordinals, today_ordinal)
+        first_ordinal, prompts_sent = _response_window(today_ordinal, window_days, subscribed_since)
+        responses = _responses(columns.ordinals, first_ordinal, today_ordinal)
+        stats = _summary(columns.ordinals, columns.codes, today, self.emoji_codes)
+        stats.update({
+            'first_entry_date': date.fromordinal(int(columns.ordinals[0])).isoformat() if len(columns) else None,
+            'last_entry_date': date.fromordinal(int(columns.ordinals[-1])).isoformat() if len(columns) else None,
+            'longest_streak': longest_streak,
+            'current_streak': current_streak,
+            'window_days': window_days,
+            'responses': responses,
+            'prompts_sent': prompts_sent,
+            'response_rate': round(responses / prompts_sent, 4) if prompts_sent else None,
+        })
+        return stats
+
+    def cohort_stats(self, users, window_days=30, today=None):
+        """
+        Stats for a cohort, given (uid, subscribed_since) pairs: the summed distributions over all
+        their entries, streak and response-rate summaries, and how many users replied in the window.
+        """
+        today = today or date.today()
+        today_ordinal = today.toordinal()
+        all_ordinals, all_codes, longest, current, responses, prompts = [], [], [], [], [], []
+        for uid, subscribed_since in users:
+            columns = self.columns(uid)
+            all_ordinals.append(columns.ordinals)
+            all_codes.append(columns.codes)
+            user_longest, user_current = _streaks(columns.ordinals, today_ordinal)
+            longest.append(user_longest)
+            current.append(user_current)
+            first_ordinal, prompts_sent = _response_window(today_ordinal, window_days, subscribed_since)
+            responses.append(_responses(columns.ordinals, first_ordinal, today_ordinal))
+            prompts.append(prompts_sent)
+        ordinals = np.concatenate(all_ordinals) if all_ordinals else np.zeros(0, dtype=np.int32)
+        codes = np.concatenate(all_codes) if all_codes else np.zeros(0, dtype=np.int32)
+        longest, current = np.array(longest, dtype=np.int32), np.array(current, dtype=np.int32)
+        responses, prompts = np.array(responses, dtype=np.int64), np.array(prompts, dtype=np.int64)
+        stats = _summary(ordinals, codes, today, self.emoji_codes)
+        stats.update({
+            'users': len(longest),
+            'active_users': int(np.count_nonzero(responses)),
+            'users_on_a_streak': int(np.count_nonzero(current)),
+            'mean_longest_streak': round(float(longest.mean()), 2) if len(longest) else 0.0,
+            'max_longest_streak': int(longest.max()) if len(longest) else 0,
+            'window_days': window_days,
+            'responses': int(responses.sum()),
+            'prompts_sent': int(prompts.sum()),
+            'response_rate': round(float(responses.sum() / prompts.sum()), 4) if prompts.sum() else None,
+        })
+        return stats
+
+    def stats(self):
+        """Cache size and hit/miss counters."""
+        return dict(self._columns.stats(), emoji_codes=len(self.emoji_codes))
@@ -0,0 +1,82 @@
+import csv
+import io
+import json
+
+# --- Streaming mood history export ---
+# Entries are read one page at a time (Repository.list_entries with a cursor) and written out as
+# they arrive, so memory stays flat however long a user's history is or however many users an
+# admin export covers.
+
+EXPORT_MIMETYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+ENTRY_FIELDS = ('entry_date', 'emoji', 'text_response')
+
+# list_entries takes an inclusive date range; these cover every YYYY-MM-DD entry ID
+_FIRST_DATE = '0000-01-01'
+_LAST_DATE = '9999-12-31'
+_CHUNK_BYTES = 16 * 1024
+
+
+def iter_user_entries(repository, uid, page_size=500):
+    """Yields a user's entries (dicts with ENTRY_FIELDS) in date order, reading 'page_size' at a time."""
+    cursor = None
+    while True:
+        entries, cursor = repository.list_entries(uid, _FIRST_DATE, _LAST_DATE, cursor=cursor, limit=page_size)
+        for entry_date in sorted(entries):
+            yield entries[entry_date]
+        if cursor is None:
+            return
+
+
+def iter_export_records(repository, uids, page_size=500, include_uid=False):
+    """Yields one flat record per entry for every uid in 'uids' (any iterable, e.g. a stream of all users)."""
+    for uid in uids:
+        for entry in iter_user_entries(repository, uid, page_size):
+            record = {field: entry.get(field) for field in ENTRY_FIELDS}
+            yield dict(uid=uid, **record) if include_uid else record
+
+
+def _chunked(lines, chunk_bytes=_CHUNK_BYTES):
+    """Joins small lines into ~chunk_bytes pieces, so the server isn't writing one tiny chunk per entry."""
+    pending, size = [], 0
+    for line in lines:
+        pending.append(line)
+        size += len(line)
+        if size >= chunk_bytes:
+            yield ''.join(pending)
+            pending, size = [], 0
+    if pending:
+        yield ''.join(pending)
+
+
+def _csv_lines(records, fields):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction='ignore')
+    writer.writeheader()
+    yield buffer.getvalue()
+    for record in records:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(record)
+        yield buffer.getvalue()
+
+
+def render_csv(records, include_uid=False):
+    """Yields CSV text: a header line, then one line per record."""
+    fields = (('uid',) if include_uid else ()) + ENTRY_FIELDS
+    return _chunked(_csv_lines(records, fields))
+
+
+def render_ndjson(records):
+    """Yields NDJSON text: one JSON object per line."""
+    return _chunked(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+
+
+def render_export(records, export_format, include_uid=False):
+    if export_format == 'csv':
+        return render_csv(records, include_uid)
+    if export_format == 'ndjson':
+        return render_ndjson(records)
+    raise ValueError(f"Unknown export format: {export_format!r}")
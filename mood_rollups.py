@@ -0,0 +1,87 @@
+from datetime import date, timedelta
+
+# Per-user, per-month summary documents: users/{uid}/mood_months/{YYYY-MM}
+# They let the calendar and stats read one document per month instead of up to 31 entries.
+ROLLUP_COLLECTION = 'mood_months'
+
+
+def month_key(date_str):
+    """Returns the 'YYYY-MM' rollup key for a 'YYYY-MM-DD' date string."""
+    return date_str[:7]
+
+
+def _run_lengths(sorted_days):
+    """Yields (first_day, last_day, length) for each run of consecutive dates."""
+    run_start = previous = None
+    length = 0
+    for day in sorted_days:
+        if previous is not None and day - previous == timedelta(days=1):
+            length += 1
+        else:
+            if previous is not None:
+                yield run_start, previous, length
+            run_start, length = day, 1
+        previous = day
+    if previous is not None:
+        yield run_start, previous, length
+
+
+def build_month_rollup(month, days):
+    """
+    Builds the rollup document for 'month' ('YYYY-MM') from a {'YYYY-MM-DD': emoji} map.
+
+    Streaks only cover this month. streak_at_month_start / streak_at_month_end are the runs
+    touching the first / last day of the month, so a caller can chain streaks across months.
+    """
+    days = {day: emoji for day, emoji in days.items() if month_key(day) == month}
+    emoji_counts = {}
+    for emoji in days.values():
+        emoji_counts[emoji] = emoji_counts.get(emoji, 0) + 1
+
+    first_of_month = date.fromisoformat(month + '-01')
+    last_of_month = (first_of_month + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    longest_streak = streak_at_month_start = streak_at_month_end = 0
+    for run_start, run_end, length in _run_lengths(sorted(date.fromisoformat(day) for day in days)):
+        longest_streak = max(longest_streak, length)
+        if run_start == first_of_month:
+            streak_at_month_start = length
+        if run_end == last_of_month:
+            streak_at_month_end = length
+
+    return {
+        'month': month,
+        'days': days,
+        'emoji_counts': emoji_counts,
+        'entry_count': len(days),
+        'longest_streak': longest_streak,
+        'streak_at_month_start': streak_at_month_start,
+        'streak_at_month_end': streak_at_month_end,
+        'last_entry_date': max(days) if days else None,
+    }
+
+
+def apply_entry_to_rollup(existing_rollup, date_str, emoji):
+    """
+    Returns the rollup for date_str's month after recording (or replacing) that day's emoji.
+    'version' goes up by one on every write, so it (with updated_at) identifies the month's
+    state for HTTP caching; the written entry is stamped with the same version.
+    """
+    month = month_key(date_str)
+    days = dict((existing_rollup or {}).get('days') or {})
+    days[date_str] = emoji
+    rollup = build_month_rollup(month, days)
+    rollup['version'] = (existing_rollup or {}).get('version', 0) + 1
+    return rollup
+
+
+def merge_into_rollup(existing_rollup, month, days):
+    """
+    Returns the rollup for 'month' after adding the days from 'days' (e.g. rebuilt from the mood
+    entries) that existing_rollup doesn't have. Days already in existing_rollup are kept: they were
+    written with their entries, so they are at least as new.
+    """
+    merged_days = dict(days)
+    merged_days.update((existing_rollup or {}).get('days') or {})
+    rollup = build_month_rollup(month, merged_days)
+    rollup['version'] = (existing_rollup or {}).get('version', 0) + 1
+    return rollup
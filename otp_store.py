@@ -0,0 +1,155 @@
+import heapq
+import hmac
+import itertools
+import os
+import sqlite3
+import threading
+import time
+
+
+class OTPStore:
+    """
+    Interface for pending OTP codes, keyed by E.164 phone number.
+    Times are Unix timestamps (time.time()) so they mean the same thing across processes.
+    """
+
+    def put(self, phone_number_e164, otp_code, expires_at):
+        """Stores (or replaces) the pending code for a phone number."""
+        raise NotImplementedError
+
+    def verify_and_consume(self, phone_number_e164, otp_code, now=None):
+        """Returns True and deletes the code if it matches and hasn't expired. Codes are single-use."""
+        raise NotImplementedError
+
+    def sweep(self, now=None):
+        """Deletes expired codes. Returns how many were removed."""
+        raise NotImplementedError
+
+
+class MemoryOTPStore(OTPStore):
+    """
+    Per-process store with a capacity bound. A min-heap ordered by expiry lets each put
+    sweep expired codes in O(log n) apiece. When full, the code closest to expiry is evicted.
+    Replaced or consumed codes leave stale heap entries that are skipped when popped.
+    """
+
+    def __init__(self, capacity=10000):
+        self.capacity = max(1, capacity)
+        self._codes = {}   # phone -> (otp_code, expires_at, seq)
+        self._expiry_heap = []  # (expires_at, seq, phone)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def _pop_heap_entry(self):
+        """Pops the soonest-expiring live code from the heap, skipping stale entries."""
+        while self._expiry_heap:
+            expires_at, seq, phone = heapq.heappop(self._expiry_heap)
+            current = self._codes.get(phone)
+            if current and current[2] == seq:
+                del self._codes[phone]
+                return expires_at
+        return None
+
+    def _sweep_locked(self, now):
+        removed = 0
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            if self._pop_heap_entry() is not None:
+                removed += 1
+        # Stale entries can pile up if the same numbers keep requesting codes; rebuild occasionally
+        if len(self._expiry_heap) > 2 * len(self._codes) + 64:
+            self._expiry_heap = [(expires_at, seq, phone) for phone, (_, expires_at, seq) in self._codes.items()]
+            heapq.heapify(self._expiry_heap)
+        return removed
+
+    def put(self, phone_number_e164, otp_code, expires_at):
+        with self._lock:
+            self._sweep_locked(time.time())
+            if phone_number_e164 not in self._codes and len(self._codes) >= self.capacity:
+                self._pop_heap_entry()
+            seq = next(self._seq)
+            self._codes[phone_number_e164] = (otp_code, expires_at, seq)
+            heapq.heappush(self._expiry_heap, (expires_at, seq, phone_number_e164))
+
+    def verify_and_consume(self, phone_number_e164, otp_code, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            stored = self._codes.get(phone_number_e164)
+            if not stored or not otp_code or stored[1] <= now:
+                return False
+            if not hmac.compare_digest(stored[0], str(otp_code)):
+                return False
+            del self._codes[phone_number_e164] # Clear OTP after use; its heap entry goes stale
+            return True
+
+    def sweep(self, now=None):
+        with self._lock:
+            return self._sweep_locked(time.time() if now is None else now)
+
+    def __len__(self):
+        return len(self._codes)
+
+
+class SQLiteOTPStore(OTPStore):
+    """
+    Store shared by every process on one host through a SQLite file in WAL mode.
+    Verification is a single conditional DELETE, so a code can only be used once even
+    when several waitress processes race on it.
+    """
+
+    def __init__(self, path, sweep_interval_seconds=60.0):
+        self.path = path
+        self.sweep_interval_seconds = sweep_interval_seconds
+        self._next_sweep_at = 0.0
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS otp_codes (
+                phone_number TEXT PRIMARY KEY,
+                otp_code TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_otp_codes_expires_at ON otp_codes (expires_at);
+        """)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def put(self, phone_number_e164, otp_code, expires_at):
+        now = time.time()
+        if now >= self._next_sweep_at:
+            self._next_sweep_at = now + self.sweep_interval_seconds
+            self.sweep(now)
+        self._conn().execute(
+            "INSERT OR REPLACE INTO otp_codes (phone_number, otp_code, expires_at) VALUES (?, ?, ?)",
+            (phone_number_e164, str(otp_code), expires_at),
+        )
+
+    def verify_and_consume(self, phone_number_e164, otp_code, now=None):
+        if not otp_code:
+            return False
+        now = time.time() if now is None else now
+        cursor = self._conn().execute(
+            "DELETE FROM otp_codes WHERE phone_number = ? AND otp_code = ? AND expires_at > ?",
+            (phone_number_e164, str(otp_code), now),
+        )
+        return cursor.rowcount == 1
+
+    def sweep(self, now=None):
+        now = time.time() if now is None else now
+        cursor = self._conn().execute("DELETE FROM otp_codes WHERE expires_at <= ?", (now,))
+        return cursor.rowcount
+
+
+def create_otp_store(backend, path=None, capacity=10000):
+    """Builds the configured OTP store: 'memory' (single process) or 'sqlite' (shared across processes)."""
+    if backend == 'sqlite':
+        return SQLiteOTPStore(path)
+    if backend == 'memory':
+        return MemoryOTPStore(capacity)
+    raise ValueError(f"Unknown OTP store backend: {backend!r}")
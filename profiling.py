@@ -0,0 +1,229 @@
+import functools
+import hmac
+import itertools
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+from metrics import profiles_captured
+
+logger = logging.getLogger(__name__)
+
+# --- Opt-in profiling ---
+# A request is profiled when it carries PROFILE_HEADER with the configured admin token, or is
+# picked by PROFILE_SAMPLE_RATE; daily prompt runs have a sample rate of their own. A capture
+# runs cProfile on the request's thread and samples its call stack every few milliseconds, then
+# writes two files per capture under PROFILE_DIR/<route or job>/:
+#   <id>.prof       cProfile stats (python -m pstats <file>, or snakeviz)
+#   <id>.collapsed  "frame;frame;frame count" lines (flamegraph.pl, speedscope, inferno)
+# Each route or job keeps only its newest max_dumps captures, and at most one capture runs per
+# process at a time, so profiling can stay on in production without piling up files or overhead.
+
+PROFILE_HEADER = 'X-Profile-Request'
+PROFILE_ID_HEADER = 'X-Profile-Id' # Set on header-triggered responses: the capture's file name
+
+
+def _slug(target):
+    """A directory name for a route or job, e.g. 'GET /api/mood_entry/<string:date_str>' -> 'GET_api_mood_entry_string_date_str'."""
+    return re.sub(r'[^A-Za-z0-9]+', '_', target).strip('_') or 'root'
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{frame.f_globals.get('__name__', '?')}.{getattr(code, 'co_qualname', code.co_name)}"
+
+
+class StackSampler:
+    """
+    Background thread that records the call stack of one thread (or of every thread, labelled by
+    thread name) every 'interval' seconds, as collapsed-stack counts.
+    """
+
+    def __init__(self, interval, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id # None: every thread but the sampler
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            if self.thread_id is not None:
+                self._record(frames.get(self.thread_id))
+                continue
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in frames.items():
+                if thread_id != own_id:
+                    self._record(frame, root=thread_names.get(thread_id, str(thread_id)))
+
+    def _record(self, frame, root=None):
+        stack = []
+        while frame is not None:
+            stack.append(_frame_name(frame))
+            frame = frame.f_back
+        if root is not None:
+            stack.append(root)
+        if stack:
+            self.counts[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in sorted(self.counts.items()))
+
+
+class ProfileRing:
+    """Capture files under directory/<target>/, keeping the newest max_dumps captures per target."""
+
+    def __init__(self, directory, max_dumps=20):
+        self.directory = directory
+        self.max_dumps = max(1, max_dumps)
+        self._sequence = itertools.count()
+
+    def new_id(self):
+        """A capture id that sorts by time: UTC timestamp, then process and a per-process counter."""
+        now = time.time()
+        return f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime(now))}{int(now % 1 * 1000):03d}-{os.getpid()}-{next(self._sequence)}"
+
+    def write(self, target, capture_id, profile, collapsed):
+        directory = os.path.join(self.directory, _slug(target))
+        os.makedirs(directory, exist_ok=True)
+        if profile is not None:
+            profile.dump_stats(os.path.join(directory, capture_id + '.prof'))
+        with open(os.path.join(directory, capture_id + '.collapsed'), 'w', encoding='utf-8') as collapsed_file:
+            collapsed_file.write(collapsed)
+        self._trim(directory)
+        return directory
+
+    def _trim(self, directory):
+        capture_ids = sorted({os.path.splitext(name)[0] for name in os.listdir(directory)})
+        for capture_id in capture_ids[:-self.max_dumps]:
+            for extension in ('.prof', '.collapsed'):
+                try:
+                    os.remove(os.path.join(directory, capture_id + extension))
+                except FileNotFoundError:
+                    pass # Trimmed by another process
+
+
+class ProfileCapture:
+    """One running capture (see Profiler.start). stop() writes its files and returns their directory."""
+
+    def __init__(self, profiler, target, capture_id, all_threads):
+        self.profiler = profiler
+        self.target = target
+        self.id = capture_id
+        import cProfile # Only loaded once something is profiled
+        self._profile = cProfile.Profile()
+        self._sampler = StackSampler(profiler.interval, thread_id=None if all_threads else threading.get_ident())
+        self._started_at = time.perf_counter()
+
+    def start(self):
+        try:
+            self._profile.enable()
+        except ValueError: # Another profiler is active in this interpreter: keep the stack samples only
+            self._profile = None
+        self._sampler.start()
+        return self
+
+    def stop(self):
+        if self._profile is not None:
+            self._profile.disable()
+        self._sampler.stop()
+        elapsed = time.perf_counter() - self._started_at
+        try:
+            directory = self.profiler.ring.write(self.target, self.id, self._profile, self._sampler.collapsed())
+            profiles_captured.inc(target=self.target)
+            logger.info(f"Profiled {self.target} ({elapsed * 1000:.0f} ms): {os.path.join(directory, self.id)}.*")
+            return directory
+        except OSError as e:
+            logger.error(f"Could not write the profile of {self.target}: {e}")
+            return None
+        finally:
+            self.profiler._active.release()
+
+
+class Profiler:
+    """
+    Decides what gets profiled and runs the captures. sample_rate is the fraction of requests
+    profiled at random; header_token enables PROFILE_HEADER (None turns the header off).
+    """
+
+    def __init__(self, ring, sample_rate=0.0, header_token=None, interval=0.005):
+        self.ring = ring
+        self.sample_rate = sample_rate
+        self.header_token = header_token
+        self.interval = interval
+        self._active = threading.Lock() # Held while a capture runs
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0 or bool(self.header_token)
+
+    def header_matches(self, header_value):
+        # compare_digest raises TypeError on non-ASCII str, so compare the UTF-8 bytes
+        return bool(self.header_token and header_value) and hmac.compare_digest(
+            header_value.encode('utf-8'), self.header_token.encode('utf-8'))
+
+    def start(self, target, all_threads=False):
+        """Starts a capture of the calling thread (or all threads). Returns None if one is already running."""
+        if not self._active.acquire(blocking=False):
+            return None
+        try:
+            return ProfileCapture(self, target, self.ring.new_id(), all_threads).start()
+        except BaseException:
+            self._active.release()
+            raise
+
+    def profiled(self, target, sample_rate, all_threads=False):
+        """Decorator: profiles a 'sample_rate' fraction of calls (e.g. scheduler jobs) as 'target'."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                capture = self.start(target, all_threads=all_threads) if random.random() < sample_rate else None
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    if capture is not None:
+                        capture.stop()
+            return wrapper
+        return decorator
+
+
+def init_app(app, profiler):
+    """Profiles sampled and header-flagged requests, filed by route template (e.g. 'POST /sms/receive')."""
+    if not profiler.enabled:
+        return
+    from flask import g, request
+
+    @app.before_request
+    def _start_profile():
+        requested = profiler.header_matches(request.headers.get(PROFILE_HEADER))
+        if requested or random.random() < profiler.sample_rate:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            g._profile_capture = profiler.start(f"{request.method} {route}")
+            g._profile_requested = requested
+
+    @app.after_request
+    def _add_profile_id(response):
+        capture = g.get('_profile_capture')
+        if capture is not None and g.get('_profile_requested'):
+            response.headers[PROFILE_ID_HEADER] = capture.id
+        return response
+
+    @app.teardown_request
+    def _stop_profile(exception):
+        capture = g.pop('_profile_capture', None)
+        if capture is not None:
+            capture.stop()
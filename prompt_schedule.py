@@ -0,0 +1,83 @@
+import os
+import re
+import zlib
+from datetime import datetime, date, timezone
+
+import pytz
+
+# --- Per-user prompt times ---
+# Each subscribed user has a local prompt time (profile 'prompt_time', 'HH:MM') in their own
+# timezone (profile 'timezone', an IANA name). That is precomputed into 'prompt_slot_utc', the
+# UTC minute of the day (0..1439) the prompt goes out, so the per-minute scheduler tick only
+# queries one slot's users. Slots are recomputed daily so DST changes take effect.
+# Users without a preference are spread over a window after the default time instead of all
+# landing in one minute.
+
+MINUTES_PER_DAY = 24 * 60
+_PROMPT_TIME_PATTERN = re.compile(r'^([01]\d|2[0-3]):([0-5]\d)$')
+
+
+def parse_prompt_time(value):
+    """Returns minutes after local midnight for 'HH:MM' (24-hour), or None if it isn't valid."""
+    match = _PROMPT_TIME_PATTERN.match(value or '')
+    return int(match.group(1)) * 60 + int(match.group(2)) if match else None
+
+
+def format_prompt_time(minute_of_day):
+    return f"{minute_of_day // 60:02d}:{minute_of_day % 60:02d}"
+
+
+def is_valid_timezone(name):
+    return bool(name) and name in pytz.all_timezones_set
+
+
+def utc_slot(timezone_name, local_minute, on_date=None):
+    """UTC minute of the day at which 'local_minute' in 'timezone_name' falls on 'on_date' (default: today)."""
+    on_date = on_date or date.today()
+    tz = pytz.timezone(timezone_name)
+    local = tz.localize(datetime(on_date.year, on_date.month, on_date.day, local_minute // 60, local_minute % 60))
+    utc = local.astimezone(pytz.utc)
+    return utc.hour * 60 + utc.minute
+
+
+def default_local_minute(uid, base_minute, stagger_minutes):
+    """The default prompt time for a user: base_minute plus a stable per-user offset in [0, stagger_minutes)."""
+    if stagger_minutes <= 1:
+        return base_minute % MINUTES_PER_DAY
+    return (base_minute + zlib.crc32(uid.encode('utf-8')) % stagger_minutes) % MINUTES_PER_DAY
+
+
+def slot_for_profile(uid, profile, default_timezone, default_minute, stagger_minutes, on_date=None):
+    """The UTC slot for a user's profile, falling back to the (staggered) defaults for missing or bad values."""
+    timezone_name = profile.get('timezone')
+    if not is_valid_timezone(timezone_name):
+        timezone_name = default_timezone
+    local_minute = parse_prompt_time(profile.get('prompt_time'))
+    if local_minute is None:
+        local_minute = default_local_minute(uid, default_minute, stagger_minutes)
+    return utc_slot(timezone_name, local_minute, on_date)
+
+
+class SlotCheckpoint:
+    """
+    The last UTC minute whose slot was dispatched, kept in a small file (shared by the processes on
+    a host) so the tick after a late, skipped or misfired one, or after a restart, catches up.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """Returns the last dispatched minute (an aware UTC datetime), or None if nothing was recorded."""
+        try:
+            with open(self.path, encoding='utf-8') as state_file:
+                return datetime.strptime(state_file.read().strip(), '%Y-%m-%dT%H:%MZ').replace(tzinfo=timezone.utc)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, minute):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as state_file:
+            state_file.write(minute.strftime('%Y-%m-%dT%H:%MZ'))
+        os.replace(temp_path, self.path) # Atomic, so a reader never sees half a timestamp
@@ -0,0 +1,297 @@
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# --- Sharding the daily prompt run across app instances ---
+# Every user has a fixed shard_bucket (0..SHARD_BUCKETS-1, from a hash of the uid) stored on their
+# profile. A run splits the buckets into N contiguous shards; each instance takes a time-limited
+# lease on a shard, renews it with a heartbeat while it works, and checkpoints the last uid it
+# finished so a shard picked up after a crash continues where it stopped. Expired leases are
+# taken over by the other instances, and a finished shard is never run twice.
+
+SHARD_BUCKETS = 1024 # Fixed, so changing the shard count never rewrites user profiles
+
+
+def shard_bucket(uid):
+    """Stable bucket for a uid, the same in every process (unlike hash())."""
+    return zlib.crc32(uid.encode('utf-8')) % SHARD_BUCKETS
+
+
+def bucket_range(shard, num_shards):
+    """The [start, end) bucket range covered by 'shard' out of 'num_shards'."""
+    return shard * SHARD_BUCKETS // num_shards, (shard + 1) * SHARD_BUCKETS // num_shards
+
+
+def default_owner_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+# Lease states returned by LeaseStore.acquire
+ACQUIRED = 'acquired'
+HELD = 'held'
+DONE = 'done'
+
+
+class LeaseStore:
+    """Interface for shard leases. Times are Unix timestamps so they mean the same on every host."""
+
+    def acquire(self, run_id, shard, owner, ttl_seconds):
+        """Returns (ACQUIRED, cursor), (HELD, None) if another owner's lease is live, or (DONE, None)."""
+        raise NotImplementedError
+
+    def renew(self, run_id, shard, owner, ttl_seconds, cursor=None):
+        """Extends the lease (and saves 'cursor' if given). Returns False if 'owner' no longer holds it."""
+        raise NotImplementedError
+
+    def complete(self, run_id, shard, owner):
+        """Marks the shard finished. Returns False if 'owner' no longer holds it."""
+        raise NotImplementedError
+
+    def release(self, run_id, shard, owner):
+        """Gives up an unfinished lease so another instance can take it over right away."""
+        raise NotImplementedError
+
+
+class SQLiteLeaseStore(LeaseStore):
+    """Leases in a SQLite file: coordinates the processes on one host."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS scheduler_leases (
+                run_id TEXT NOT NULL,
+                shard INTEGER NOT NULL,
+                owner TEXT,
+                expires_at REAL NOT NULL DEFAULT 0,
+                cursor TEXT,
+                done INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (run_id, shard)
+            );
+        """)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def acquire(self, run_id, shard, owner, ttl_seconds):
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT owner, expires_at, cursor, done FROM scheduler_leases WHERE run_id = ? AND shard = ?",
+                               (run_id, shard)).fetchone()
+            if row and row[3]:
+                result = (DONE, None)
+            elif row and row[0] != owner and row[1] > now:
+                result = (HELD, None)
+            else:
+                conn.execute(
+                    """INSERT INTO scheduler_leases (run_id, shard, owner, expires_at) VALUES (?, ?, ?, ?)
+                       ON CONFLICT (run_id, shard) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at""",
+                    (run_id, shard, owner, now + ttl_seconds))
+                result = (ACQUIRED, row[2] if row else None)
+            conn.execute("COMMIT")
+            return result
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def renew(self, run_id, shard, owner, ttl_seconds, cursor=None):
+        cursor_sql = ", cursor = ?" if cursor is not None else ""
+        params = [time.time() + ttl_seconds] + ([cursor] if cursor is not None else []) + [run_id, shard, owner]
+        updated = self._conn().execute(
+            f"UPDATE scheduler_leases SET expires_at = ?{cursor_sql} WHERE run_id = ? AND shard = ? AND owner = ? AND done = 0",
+            params)
+        return updated.rowcount == 1
+
+    def complete(self, run_id, shard, owner):
+        updated = self._conn().execute(
+            "UPDATE scheduler_leases SET done = 1 WHERE run_id = ? AND shard = ? AND owner = ? AND done = 0",
+            (run_id, shard, owner))
+        return updated.rowcount == 1
+
+    def release(self, run_id, shard, owner):
+        self._conn().execute(
+            "UPDATE scheduler_leases SET expires_at = 0 WHERE run_id = ? AND shard = ? AND owner = ? AND done = 0",
+            (run_id, shard, owner))
+
+
+class FirestoreLeaseStore(LeaseStore):
+    """Leases in Firestore (scheduler_leases/{run_id}__{shard}): coordinates instances on any host."""
+
+    COLLECTION = 'scheduler_leases'
+
+    def __init__(self, db):
+        from firebase_admin import firestore # Only needed by this backend
+        self.db = db
+        self._firestore = firestore
+
+    def _ref(self, run_id, shard):
+        return self.db.collection(self.COLLECTION).document(f"{run_id}__{shard}")
+
+    def _update_if_owner(self, run_id, shard, owner, fields):
+        """Applies 'fields' in a transaction if 'owner' holds the unfinished lease."""
+        @self._firestore.transactional
+        def _apply(transaction, ref):
+            lease = ref.get(transaction=transaction).to_dict() or {}
+            if lease.get('owner') != owner or lease.get('done'):
+                return False
+            transaction.update(ref, fields)
+            return True
+        return _apply(self.db.transaction(), self._ref(run_id, shard))
+
+    def acquire(self, run_id, shard, owner, ttl_seconds):
+        @self._firestore.transactional
+        def _acquire(transaction, ref):
+            snapshot = ref.get(transaction=transaction)
+            lease = snapshot.to_dict() if snapshot.exists else None
+            if lease and lease.get('done'):
+                return DONE, None
+            now = time.time()
+            if lease and lease.get('owner') != owner and lease.get('expires_at', 0) > now:
+                return HELD, None
+            transaction.set(ref, {'run_id': run_id, 'shard': shard, 'owner': owner,
+                                  'expires_at': now + ttl_seconds, 'done': False}, merge=True)
+            return ACQUIRED, (lease or {}).get('cursor')
+        return _acquire(self.db.transaction(), self._ref(run_id, shard))
+
+    def renew(self, run_id, shard, owner, ttl_seconds, cursor=None):
+        fields = {'expires_at': time.time() + ttl_seconds}
+        if cursor is not None:
+            fields['cursor'] = cursor
+        return self._update_if_owner(run_id, shard, owner, fields)
+
+    def complete(self, run_id, shard, owner):
+        return self._update_if_owner(run_id, shard, owner, {'done': True, 'completed_at': self._firestore.SERVER_TIMESTAMP})
+
+    def release(self, run_id, shard, owner):
+        self._update_if_owner(run_id, shard, owner, {'expires_at': 0})
+
+
+def create_lease_store(backend, path=None, firestore_db=None):
+    """Builds the configured lease store: 'none' (no coordination), 'sqlite' (one host) or 'firestore'."""
+    if backend == 'none':
+        return None
+    if backend == 'sqlite':
+        return SQLiteLeaseStore(path)
+    if backend == 'firestore':
+        if firestore_db is None:
+            raise ValueError("The 'firestore' scheduler lease backend needs Firestore to be initialized.")
+        return FirestoreLeaseStore(firestore_db)
+    raise ValueError(f"Unknown scheduler lease backend: {backend!r}")
+
+
+class LeaseLost(Exception):
+    """Another instance took over the shard (e.g. after a long pause); stop working on it."""
+
+
+class ShardLease:
+    """A held lease. A background heartbeat renews it every ttl/3 seconds until it is closed."""
+
+    def __init__(self, store, run_id, shard, owner, ttl_seconds, cursor=None):
+        self.store = store
+        self.run_id = run_id
+        self.shard = shard
+        self.owner = owner
+        self.ttl_seconds = ttl_seconds
+        self.cursor = cursor
+        self.lost = False
+        self._closed = threading.Event()
+        self._heartbeat = threading.Thread(target=self._beat, name=f"lease-heartbeat-{shard}", daemon=True)
+        self._heartbeat.start()
+
+    def _beat(self):
+        while not self._closed.wait(self.ttl_seconds / 3.0):
+            try:
+                if not self.store.renew(self.run_id, self.shard, self.owner, self.ttl_seconds):
+                    self.lost = True
+                    logger.warning(f"Scheduler: Lost the lease on shard {self.shard} of run {self.run_id}.")
+                    return
+            except Exception as e:
+                logger.warning(f"Scheduler: Lease heartbeat for shard {self.shard} failed: {e}")
+
+    def checkpoint(self, cursor):
+        """Saves progress (the last uid fully handled). Raises LeaseLost if the shard was taken over."""
+        if self.lost or not self.store.renew(self.run_id, self.shard, self.owner, self.ttl_seconds, cursor=cursor):
+            self.lost = True
+            raise LeaseLost(f"shard {self.shard} of run {self.run_id}")
+        self.cursor = cursor
+
+    def close(self, completed):
+        self._closed.set()
+        self._heartbeat.join()
+        if completed:
+            if not self.store.complete(self.run_id, self.shard, self.owner):
+                raise LeaseLost(f"shard {self.shard} of run {self.run_id}")
+        elif not self.lost:
+            self.store.release(self.run_id, self.shard, self.owner)
+
+
+class ShardedRun:
+    """
+    Runs process_shard(shard, lease) for every shard of a run, sharing the shards with the other
+    instances that run the same run_id. Keeps polling for shards whose owner stopped renewing
+    until every shard is done or 'run_window_seconds' has passed.
+    """
+
+    def __init__(self, lease_store, num_shards, owner=None, lease_ttl_seconds=60.0,
+                 run_window_seconds=3600.0, poll_interval_seconds=5.0):
+        self.lease_store = lease_store
+        self.num_shards = max(1, num_shards)
+        self.owner = owner or default_owner_id()
+        self.lease_ttl_seconds = lease_ttl_seconds
+        self.run_window_seconds = run_window_seconds
+        self.poll_interval_seconds = poll_interval_seconds
+
+    def run(self, run_id, process_shard):
+        """Returns {'shards_processed': [...], 'shards_pending': [...]} for this instance."""
+        deadline = time.monotonic() + self.run_window_seconds
+        # Start at a different shard per instance so they don't all contend for shard 0
+        offset = zlib.crc32(self.owner.encode('utf-8')) % self.num_shards
+        order = [(offset + i) % self.num_shards for i in range(self.num_shards)]
+        pending = set(order)
+        processed = []
+        while pending:
+            for shard in order:
+                if shard not in pending:
+                    continue
+                status, cursor = self.lease_store.acquire(run_id, shard, self.owner, self.lease_ttl_seconds)
+                if status == DONE:
+                    pending.discard(shard)
+                if status != ACQUIRED:
+                    continue
+                lease = ShardLease(self.lease_store, run_id, shard, self.owner, self.lease_ttl_seconds, cursor)
+                completed = False
+                try:
+                    logger.info(f"Scheduler: Processing shard {shard}/{self.num_shards} of run {run_id}"
+                                f"{f' from {cursor}' if cursor else ''}.")
+                    process_shard(shard, lease)
+                    completed = True
+                except LeaseLost:
+                    logger.warning(f"Scheduler: Stopped shard {shard} of run {run_id}; another instance took it over.")
+                finally:
+                    try:
+                        lease.close(completed)
+                    except LeaseLost:
+                        completed = False
+                if completed:
+                    processed.append(shard)
+                    pending.discard(shard)
+            if pending:
+                if time.monotonic() >= deadline:
+                    break
+                time.sleep(self.poll_interval_seconds) # Wait for live leases to finish or expire
+        return {'shards_processed': processed, 'shards_pending': sorted(pending)}
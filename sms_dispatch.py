@@ -0,0 +1,170 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket used to keep outbound SMS under the sender's
+    messages-per-second cap. Tokens refill continuously at `rate` per second
+    and at most `capacity` tokens can be banked for short bursts.
+    """
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError("TokenBucket rate must be positive.")
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity else max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._last_refill = now
+
+    def try_acquire(self, tokens=1):
+        """Takes `tokens` if available right now. Returns True on success."""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1):
+        """Blocks until `tokens` are available, then takes them."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait_seconds = (tokens - self._tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+class SQLiteTokenBucket:
+    """
+    TokenBucket whose tokens are kept in a SQLite file, so every process that opens the same file
+    (e.g. the app processes on one host and their outbound queue workers) draws from one bucket
+    and together stays under the sender's cap. Each take is one short write transaction.
+    """
+
+    def __init__(self, path, rate, capacity=None, name='sms'):
+        if rate <= 0:
+            raise ValueError("TokenBucket rate must be positive.")
+        self.path = path
+        self.name = name
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity else max(1.0, self.rate)
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+                name TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL  -- Unix time, the same clock in every process
+            )
+        """)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _take(self, tokens):
+        """Takes `tokens` if available. Returns 0.0 on success, else the seconds until they will be."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated_at FROM rate_limit_buckets WHERE name = ?", (self.name,)).fetchone()
+            available = self.capacity if row is None else min(self.capacity, row[0] + max(0.0, now - row[1]) * self.rate)
+            wait_seconds = 0.0
+            if available >= tokens:
+                available -= tokens
+            else:
+                wait_seconds = (tokens - available) / self.rate
+            conn.execute(
+                """INSERT INTO rate_limit_buckets (name, tokens, updated_at) VALUES (?, ?, ?)
+                   ON CONFLICT (name) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at""",
+                (self.name, available, now),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait_seconds
+
+    def try_acquire(self, tokens=1):
+        """Takes `tokens` if available right now. Returns True on success."""
+        return self._take(tokens) == 0.0
+
+    def acquire(self, tokens=1):
+        """Blocks until `tokens` are available, then takes them."""
+        while True:
+            wait_seconds = self._take(tokens)
+            if wait_seconds == 0.0:
+                return
+            time.sleep(wait_seconds)
+
+
+def dispatch_concurrently(recipients, send_func, max_workers=8, messages_per_second=1.0, limiter=None):
+    """
+    Sends one message per recipient through `send_func(recipient)` using a bounded
+    worker pool, throttled by a token bucket so we never exceed the sender's cap.
+    Pass a shared `limiter` (e.g. sms_queue.get_sender_limiter()) to count these sends
+    against the same cap as everything else; otherwise a bucket of `messages_per_second`
+    is used for this call alone.
+
+    `recipients` can be any iterable (e.g. a Firestore stream); at most
+    2 * max_workers sends are in flight at once, so it is never fully materialized.
+    `send_func` must return a truthy value on success.
+
+    Returns a stats dict: sent, failed, total, wall_time_seconds, throughput_per_second.
+    """
+    max_workers = max(1, int(max_workers))
+    limiter = limiter or TokenBucket(messages_per_second)
+    in_flight = threading.BoundedSemaphore(max_workers * 2)
+    stats_lock = threading.Lock()
+    stats = {'sent': 0, 'failed': 0}
+
+    def _send_one(recipient):
+        try:
+            limiter.acquire()
+            ok = send_func(recipient)
+        except Exception as e:
+            logger.error(f"Dispatch: Error sending to {recipient}: {e}")
+            ok = False
+        finally:
+            in_flight.release()
+        with stats_lock:
+            stats['sent' if ok else 'failed'] += 1
+
+    started_at = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sms-dispatch") as pool:
+        for recipient in recipients:
+            in_flight.acquire()
+            pool.submit(_send_one, recipient)
+    wall_time = time.monotonic() - started_at
+
+    total = stats['sent'] + stats['failed']
+    return {
+        'sent': stats['sent'],
+        'failed': stats['failed'],
+        'total': total,
+        'wall_time_seconds': round(wall_time, 3),
+        'throughput_per_second': round(total / wall_time, 2) if wall_time > 0 else 0.0,
+    }
@@ -1,22 +1,61 @@
-from twilio.rest import Client
+import functools
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from config import Config # Imports configuration values (Twilio SID, Token, Number)
+from metrics import track_dependency
 import phonenumbers # For phone number validation and formatting
 
+DAILY_MOOD_PROMPT_TEXT = "Hey, just checking in - how do you feel today?"
+
+# One Twilio client per process. Its requests.Session keeps TLS connections alive
+# in a urllib3 pool that is shared (and thread-safe) across waitress threads.
+_twilio_client = None
+_twilio_client_lock = threading.Lock()
+
+def _build_twilio_http_client():
+    """Creates a keep-alive Twilio HTTP client with a bounded connection pool."""
+    # twilio and requests are imported on first send rather than at startup (see benchmarks/startup_time.py)
+    from requests.adapters import HTTPAdapter
+    from twilio.http.http_client import TwilioHttpClient
+    http_client = TwilioHttpClient(pool_connections=True)
+    pool_size = max(1, Config.TWILIO_HTTP_POOL_SIZE)
+    # pool_block=True makes extra threads wait for a free connection instead of opening throwaway ones
+    http_client.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True))
+    # requests accepts a (connect, read) tuple; set after construction since the constructor only takes a float
+    http_client.timeout = (Config.TWILIO_HTTP_CONNECT_TIMEOUT, Config.TWILIO_HTTP_READ_TIMEOUT)
+    return http_client
+
 def get_twilio_client():
-    """Initializes and returns a Twilio Client instance."""
-    # Create client on demand. For high-volume apps, initialize once at app startup.
-    if not Config.TWILIO_ACCOUNT_SID or not Config.TWILIO_AUTH_TOKEN:
-        print("Error: Twilio Account SID or Auth Token is not configured.")
-        return None
-    return Client(Config.TWILIO_ACCOUNT_SID, Config.TWILIO_AUTH_TOKEN)
+    """Returns the process-wide Twilio Client instance, creating it on first use."""
+    global _twilio_client
+    if _twilio_client is not None:
+        return _twilio_client
+    with _twilio_client_lock:
+        if _twilio_client is None:
+            if not Config.TWILIO_ACCOUNT_SID or not Config.TWILIO_AUTH_TOKEN:
+                print("Error: Twilio Account SID or Auth Token is not configured.")
+                return None
+            from twilio.rest import Client
+            _twilio_client = Client(Config.TWILIO_ACCOUNT_SID, Config.TWILIO_AUTH_TOKEN,
+                                    http_client=_build_twilio_http_client())
+    return _twilio_client
+
+# Already in E.164 form: '+', a country code that doesn't start with 0, and at most 15 digits in all
+_E164_PATTERN = re.compile(r'\+[1-9]\d{1,14}')
 
 def format_phone_to_e164(phone_number_str, country_code="US"):
     """
     Validates and formats a phone number string to E.164 standard (e.g., +14155552671).
     Uses 'US' as the default region hint if the number isn't already international.
+    Results are memoized: the same numbers come back on every login and in bulk imports.
     """
     if not phone_number_str:
         return None
+    return _format_phone_to_e164(phone_number_str, country_code)
+
+@functools.lru_cache(maxsize=Config.PHONE_FORMAT_CACHE_SIZE)
+def _format_phone_to_e164(phone_number_str, country_code):
     try:
         # If number already starts with '+', assume it's E.164 or close to it.
         if phone_number_str.startswith('+'):
@@ -25,6 +64,8 @@ def format_phone_to_e164(phone_number_str, country_code="US"):
             parsed_number = phonenumbers.parse(phone_number_str, country_code)
 
         if phonenumbers.is_valid_number(parsed_number):
+            if _E164_PATTERN.fullmatch(phone_number_str):
+                return phone_number_str # Fast path: already E.164, formatting would return it unchanged
             return phonenumbers.format_number(parsed_number, phonenumbers.PhoneNumberFormat.E164)
         else:
             print(f"Debug: Phone number '{phone_number_str}' (parsed as '{parsed_number}') is not valid.")
@@ -51,11 +92,12 @@ def send_sms(to_phone_number_e164, body_text):
         return False
 
     try:
-        message = twilio_client.messages.create(
-            body=body_text,
-            from_=Config.TWILIO_PHONE_NUMBER, # Your Twilio phone number
-            to=to_phone_number_e164          # Recipient's phone number
-        )
+        with track_dependency('twilio', 'messages.create'):
+            message = twilio_client.messages.create(
+                body=body_text,
+                from_=Config.TWILIO_PHONE_NUMBER, # Your Twilio phone number
+                to=to_phone_number_e164          # Recipient's phone number
+            )
         print(f"SMS sent to {to_phone_number_e164}: SID {message.sid}")
         return True
     except Exception as e:
@@ -63,6 +105,20 @@ def send_sms(to_phone_number_e164, body_text):
         print(f"Error sending SMS to {to_phone_number_e164} from {Config.TWILIO_PHONE_NUMBER}: {e}")
         return False
 
+def send_many(messages, max_workers=None):
+    """
+    Sends a batch of SMS messages over the shared Twilio connection pool.
+    'messages' is an iterable of (to_phone_number_e164, body_text) pairs.
+    Returns a list of booleans in the same order as 'messages'.
+    """
+    messages = list(messages)
+    if not messages:
+        return []
+    # More workers than pooled connections would just queue on the pool
+    max_workers = max(1, min(max_workers or Config.TWILIO_HTTP_POOL_SIZE, len(messages)))
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sms-send") as pool:
+        return list(pool.map(lambda message: send_sms(*message), messages))
+
 def send_otp_sms(phone_number_e164, otp):
     """Sends the OTP verification code via SMS."""
     return send_sms(phone_number_e164, f"Your Mindful Moments verification code is: {otp}")
@@ -70,4 +126,4 @@ def send_otp_sms(phone_number_e164, otp):
 def send_daily_mood_prompt_sms(phone_number_e164):
     """Sends the daily mood prompt SMS."""
     print("sent sms")
-    return send_sms(phone_number_e164, "Hey, just checking in - how do you feel today?")
\ No newline at end of file
+    return send_sms(phone_number_e164, DAILY_MOOD_PROMPT_TEXT)
\ No newline at end of file
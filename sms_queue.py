@@ -0,0 +1,292 @@
+import atexit
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from config import Config
+from lazy import created_on_first_use
+from sms_dispatch import SQLiteTokenBucket
+from sms_handler import send_sms
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes: lower numbers are claimed first, so OTPs never wait behind prompts.
+PRIORITY_OTP = 0
+PRIORITY_WELCOME = 1
+PRIORITY_PROMPT = 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbound_sms (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    priority INTEGER NOT NULL,
+    to_number TEXT NOT NULL,
+    body TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',  -- pending | sending | dead
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    claimed_until REAL,
+    created_at REAL NOT NULL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_outbound_sms_due ON outbound_sms (status, priority, next_attempt_at);
+CREATE INDEX IF NOT EXISTS idx_outbound_sms_recipient ON outbound_sms (to_number, priority, id);
+"""
+
+# Next message to send: highest-priority due row that is pending (or whose claim lease
+# expired, e.g. the process died mid-send), keeping per-recipient FIFO order within a lane
+# so multi-part messages like the two welcome texts arrive in order.
+_CLAIM_SQL = """
+SELECT id, to_number, body, attempts FROM outbound_sms AS o
+WHERE o.next_attempt_at <= :now
+  AND (o.status = 'pending' OR (o.status = 'sending' AND o.claimed_until < :now))
+  AND NOT EXISTS (
+      SELECT 1 FROM outbound_sms AS earlier
+      WHERE earlier.to_number = o.to_number AND earlier.priority = o.priority
+        AND earlier.id < o.id AND earlier.status IN ('pending', 'sending')
+  )
+ORDER BY o.priority, o.next_attempt_at, o.id
+LIMIT 1
+"""
+
+# Whether anything is due at all (_CLAIM_SQL without the ordering); checked before taking a send token.
+_DUE_SQL = """
+SELECT 1 FROM outbound_sms
+WHERE next_attempt_at <= :now AND (status = 'pending' OR (status = 'sending' AND claimed_until < :now))
+LIMIT 1
+"""
+
+
+class OutboundSMSQueue:
+    """
+    Durable outbound SMS queue. Messages are spooled to a local SQLite file (WAL mode)
+    and sent by a pool of background worker threads, with exponential backoff on
+    failure and priority lanes. Rows are deleted once sent; rows that exhaust their
+    attempts are kept with status 'dead' for inspection.
+    """
+
+    def __init__(self, path, send_func=send_sms, num_workers=4, max_attempts=5,
+                 backoff_seconds=2.0, backoff_max_seconds=300.0, claim_lease_seconds=60.0,
+                 limiter=None, poll_interval_seconds=1.0):
+        self.path = path
+        self.send_func = send_func
+        self.num_workers = max(1, num_workers)
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.claim_lease_seconds = claim_lease_seconds
+        self.poll_interval_seconds = poll_interval_seconds
+        self.limiter = limiter # Token bucket taken before each send (None: unthrottled)
+
+        self._local = threading.local()
+        self._claim_lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._stopping = threading.Event()
+        self._workers = []
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self):
+        """Returns this thread's SQLite connection (sqlite3 connections are not shared across threads)."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # --- Producer side ---
+    def enqueue(self, to_phone_number_e164, body_text, priority=PRIORITY_PROMPT):
+        """Spools one message and returns its queue id. Returns immediately."""
+        now = time.time()
+        cursor = self._conn().execute(
+            "INSERT INTO outbound_sms (priority, to_number, body, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+            (priority, to_phone_number_e164, body_text, now, now),
+        )
+        self._notify()
+        return cursor.lastrowid
+
+    def enqueue_many(self, messages, priority=PRIORITY_PROMPT, chunk_size=500):
+        """Spools (to_phone_number_e164, body_text) pairs in chunked transactions. Returns the count."""
+        conn = self._conn()
+        count = 0
+        chunk = []
+
+        def _flush():
+            now = time.time()
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT INTO outbound_sms (priority, to_number, body, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(priority, to_number, body, now, now) for to_number, body in chunk],
+            )
+            conn.execute("COMMIT")
+            self._notify()
+
+        for message in messages:
+            chunk.append(message)
+            if len(chunk) >= chunk_size:
+                _flush()
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            _flush()
+            count += len(chunk)
+        return count
+
+    def _notify(self):
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    # --- Consumer side ---
+    def _claim_next(self):
+        conn = self._conn()
+        now = time.time()
+        # One claimer per process at a time; BEGIN IMMEDIATE serializes claimers across processes.
+        with self._claim_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(_CLAIM_SQL, {'now': now}).fetchone()
+                if row:
+                    conn.execute(
+                        "UPDATE outbound_sms SET status = 'sending', claimed_until = ? WHERE id = ?",
+                        (now + self.claim_lease_seconds, row[0]),
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return row
+
+    def _record_result(self, message_id, attempts, ok, error=None):
+        conn = self._conn()
+        if ok:
+            conn.execute("DELETE FROM outbound_sms WHERE id = ?", (message_id,))
+            return
+        attempts += 1
+        if attempts >= self.max_attempts:
+            conn.execute(
+                "UPDATE outbound_sms SET status = 'dead', attempts = ?, last_error = ? WHERE id = ?",
+                (attempts, error, message_id),
+            )
+            logger.error(f"SMS queue: Giving up on message {message_id} after {attempts} attempts: {error}")
+            return
+        delay = min(self.backoff_max_seconds, self.backoff_seconds * (2 ** (attempts - 1)))
+        delay *= random.uniform(0.5, 1.0)  # jitter so failed batches don't retry in lockstep
+        conn.execute(
+            "UPDATE outbound_sms SET status = 'pending', attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+            (attempts, time.time() + delay, error, message_id),
+        )
+        logger.warning(f"SMS queue: Message {message_id} failed (attempt {attempts}), retrying in {delay:.1f}s.")
+
+    def _has_due(self):
+        """Whether any message is due, without claiming it."""
+        now = time.time()
+        return self._conn().execute(_DUE_SQL, {'now': now}).fetchone() is not None
+
+    def _worker_loop(self):
+        have_token = self.limiter is None
+        while not self._stopping.is_set():
+            # The send token is taken before claiming, so a claimed row is sent at once: the lease
+            # can't run out while waiting on the limiter, and a message queued meanwhile (e.g. an
+            # OTP) is claimed ahead of lower-priority ones. A token whose claim found nothing is kept.
+            try:
+                row = None
+                if self._has_due():
+                    if not have_token:
+                        self.limiter.acquire()
+                        have_token = True
+                    row = self._claim_next()
+            except sqlite3.Error as e:
+                logger.error(f"SMS queue: Error claiming message: {e}")
+            if row is None:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval_seconds)
+                continue
+
+            have_token = self.limiter is None
+            message_id, to_number, body, attempts = row
+            error = None
+            try:
+                ok = bool(self.send_func(to_number, body))
+                if not ok:
+                    error = "send returned False"
+            except Exception as e:
+                ok, error = False, str(e)
+            try:
+                self._record_result(message_id, attempts, ok, error)
+            except sqlite3.Error as e:
+                logger.error(f"SMS queue: Error recording result for message {message_id}: {e}")
+
+    def start(self):
+        """Starts the worker pool. Safe to call more than once."""
+        if self._workers:
+            return
+        self._stopping.clear()
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self._worker_loop, name=f"sms-queue-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        logger.info(f"SMS queue: Started {self.num_workers} worker(s) on {self.path}.")
+
+    def stop(self, timeout=10.0):
+        """Stops the workers after their in-flight send. Unsent messages stay spooled."""
+        self._stopping.set()
+        self._notify()
+        for worker in self._workers:
+            worker.join(timeout)
+        self._workers = []
+
+    def stats(self):
+        """Returns message counts by status, e.g. {'pending': 3, 'dead': 1}."""
+        rows = self._conn().execute("SELECT status, COUNT(*) FROM outbound_sms GROUP BY status").fetchall()
+        return dict(rows)
+
+
+@created_on_first_use
+def get_sender_limiter():
+    """
+    The SMS_MAX_MESSAGES_PER_SECOND bucket that every send on this host draws from: the queue
+    workers of all processes sharing SMS_QUEUE_PATH, and 'parallel' prompt dispatch.
+    """
+    return SQLiteTokenBucket(Config.SMS_QUEUE_PATH, Config.SMS_MAX_MESSAGES_PER_SECOND)
+
+
+_outbound_queue = None
+_outbound_queue_lock = threading.Lock()
+
+def get_outbound_queue():
+    """Returns the process-wide outbound queue, creating it and starting its workers on first use."""
+    global _outbound_queue
+    if _outbound_queue is not None:
+        return _outbound_queue
+    with _outbound_queue_lock:
+        if _outbound_queue is None:
+            queue = OutboundSMSQueue(
+                Config.SMS_QUEUE_PATH,
+                num_workers=Config.SMS_QUEUE_WORKERS,
+                max_attempts=Config.SMS_QUEUE_MAX_ATTEMPTS,
+                backoff_seconds=Config.SMS_QUEUE_BACKOFF_SECONDS,
+                backoff_max_seconds=Config.SMS_QUEUE_BACKOFF_MAX_SECONDS,
+                limiter=get_sender_limiter(),
+            )
+            queue.start()
+            atexit.register(queue.stop)
+            _outbound_queue = queue
+    return _outbound_queue
+
+def enqueue_sms(to_phone_number_e164, body_text, priority=PRIORITY_PROMPT):
+    """Spools an SMS on the outbound queue. Returns True if it was queued."""
+    if not to_phone_number_e164:
+        print("Error: Invalid 'to' phone number for SMS (must be E.164). SMS not queued.")
+        return False
+    try:
+        get_outbound_queue().enqueue(to_phone_number_e164, body_text, priority)
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"SMS queue: Failed to enqueue SMS to {to_phone_number_e164}: {e}")
+        return False
@@ -3,6 +3,187 @@
 // This script assumes moodEntriesByDate and todayISO will be passed to its init function.
 
 let currentDisplayedDate; // To keep track of the month/year being shown
+const loadedMonths = new Set(); // "YYYY-MM" keys whose entries are already in moodEntries
+const pendingMonthLoads = new Map(); // "YYYY-MM" -> in-flight fetch promise
+
+// Full entry details (emoji + text) for the modal, kept for the life of the page.
+// A day is fetched again only if its emoji on the calendar no longer matches (it was re-logged).
+// Fetches are revalidated by the browser with the server's ETag, so unchanged data comes back as a 304.
+const entryDetailsCache = new Map(); // "YYYY-MM-DD" -> { emoji, details }
+const detailMonths = new Set(); // "YYYY-MM" keys whose details are all in entryDetailsCache
+const pendingDetailLoads = new Map(); // "YYYY-MM" or "YYYY-MM-DD" -> in-flight fetch promise
+
+/**
+ * Returns the "YYYY-MM" key for a year and 0-indexed month.
+ */
+function monthKey(year, month) {
+    return year + '-' + String(month + 1).padStart(2, '0');
+}
+
+/**
+ * Fetches one month of entries from /api/mood_month/<YYYY-MM> (a single rollup
+ * document on the server) and merges them into moodEntries. Each month is fetched at most once.
+ * @param {number} year - The full year.
+ * @param {number} month - The month (0-indexed).
+ * @param {object} moodEntries - The mood entries object to merge into.
+ * @returns {Promise<void>}
+ */
+function loadMonthEntries(year, month, moodEntries) {
+    const key = monthKey(year, month);
+    if (loadedMonths.has(key)) {
+        return Promise.resolve();
+    }
+    if (pendingMonthLoads.has(key)) {
+        return pendingMonthLoads.get(key);
+    }
+
+    const apiUrl = (window.moodMonthApiUrl || '/api/mood_month/MONTH').replace('MONTH', key);
+    const loadPromise = fetch(apiUrl, { credentials: 'same-origin' })
+        .then(response => {
+            if (!response.ok) {
+                throw new Error('Failed to load entries for ' + key + ': HTTP ' + response.status);
+            }
+            return response.json();
+        })
+        .then(summary => {
+            // Keep any entries already loaded in full (e.g. with text_response from the modal)
+            for (const [isoDate, entry] of Object.entries(summary.entries)) {
+                moodEntries[isoDate] = Object.assign({}, entry, moodEntries[isoDate]);
+            }
+            loadedMonths.add(key);
+        })
+        .catch(error => console.error(error))
+        .finally(() => pendingMonthLoads.delete(key));
+    pendingMonthLoads.set(key, loadPromise);
+    return loadPromise;
+}
+
+/**
+ * Fetches the details of every entry in a month with one request to
+ * /api/mood_entries/batch?month=YYYY-MM and caches them for the modal.
+ * @param {string} key - The "YYYY-MM" month.
+ * @returns {Promise<void>}
+ */
+function loadMonthDetails(key) {
+    if (detailMonths.has(key)) {
+        return Promise.resolve();
+    }
+    if (pendingDetailLoads.has(key)) {
+        return pendingDetailLoads.get(key);
+    }
+
+    const apiUrl = (window.moodEntriesBatchApiUrl || '/api/mood_entries/batch') + '?month=' + encodeURIComponent(key);
+    const loadPromise = fetch(apiUrl, { credentials: 'same-origin' })
+        .then(response => {
+            if (!response.ok) {
+                throw new Error('Failed to load entry details for ' + key + ': HTTP ' + response.status);
+            }
+            return response.json();
+        })
+        .then(batch => {
+            for (const [isoDate, details] of Object.entries(batch.entries)) {
+                entryDetailsCache.set(isoDate, { emoji: details.emoji, details: details });
+            }
+            detailMonths.add(key);
+        })
+        .catch(error => console.error(error))
+        .finally(() => pendingDetailLoads.delete(key));
+    pendingDetailLoads.set(key, loadPromise);
+    return loadPromise;
+}
+
+/**
+ * Returns one day's details ({ date, emoji, text_response }, or null if there is no entry),
+ * from memory when possible: a cached day, or the in-flight fetch of its month.
+ * @param {string} isoDate - The "YYYY-MM-DD" day.
+ * @param {string} [expectedEmoji] - The emoji the calendar shows for that day.
+ * @returns {Promise<object|null>}
+ */
+export function loadEntryDetails(isoDate, expectedEmoji) {
+    const cached = entryDetailsCache.get(isoDate);
+    if (cached && cached.emoji === expectedEmoji) {
+        return Promise.resolve(cached.details);
+    }
+    const key = isoDate.slice(0, 7);
+    if (pendingDetailLoads.has(key)) {
+        // The month's details are on their way; use them if they cover this day
+        return pendingDetailLoads.get(key).then(() => {
+            const loaded = entryDetailsCache.get(isoDate);
+            return loaded && loaded.emoji === expectedEmoji ? loaded.details : fetchEntryDetails(isoDate);
+        });
+    }
+    return fetchEntryDetails(isoDate);
+}
+
+/**
+ * Fetches one day's details from /api/mood_entry/<date>.
+ */
+function fetchEntryDetails(isoDate) {
+    if (pendingDetailLoads.has(isoDate)) {
+        return pendingDetailLoads.get(isoDate);
+    }
+    const apiUrl = (window.moodEntryApiUrl || '/api/mood_entry/DATE').replace('DATE', isoDate);
+    const loadPromise = fetch(apiUrl, { credentials: 'same-origin' })
+        .then(response => (response.ok ? response.json() : null))
+        .then(details => {
+            if (details) {
+                entryDetailsCache.set(isoDate, { emoji: details.emoji, details: details });
+            }
+            return details;
+        })
+        .catch(error => {
+            console.error('Could not load mood details for', isoDate, error);
+            return null;
+        })
+        .finally(() => pendingDetailLoads.delete(isoDate));
+    pendingDetailLoads.set(isoDate, loadPromise);
+    return loadPromise;
+}
+
+/**
+ * Runs 'task' when the browser is idle, so prefetching never competes with rendering.
+ */
+function whenIdle(task) {
+    if (typeof window.requestIdleCallback === 'function') {
+        window.requestIdleCallback(task, { timeout: 2000 });
+    } else {
+        setTimeout(task, 200);
+    }
+}
+
+/**
+ * In the background, loads the shown month's entry details and the previous and next
+ * months' calendar entries, so the modal and Prev/Next are served from memory.
+ * An adjacent month's details are prefetched once it is shown.
+ */
+function prefetchAround(year, month, moodEntries) {
+    whenIdle(() => {
+        loadMonthDetails(monthKey(year, month));
+        const previous = new Date(Date.UTC(year, month - 1, 1));
+        const next = new Date(Date.UTC(year, month + 1, 1));
+        loadMonthEntries(previous.getUTCFullYear(), previous.getUTCMonth(), moodEntries);
+        loadMonthEntries(next.getUTCFullYear(), next.getUTCMonth(), moodEntries);
+    });
+}
+
+/**
+ * Renders the given month right away with whatever entries are already loaded,
+ * then re-renders once that month's entries arrive (if it is still the month on screen).
+ */
+function showMonth(year, month, moodEntries, todayDateISO) {
+    renderCalendar(year, month, moodEntries, todayDateISO);
+    const key = monthKey(year, month);
+    if (loadedMonths.has(key)) {
+        prefetchAround(year, month, moodEntries);
+        return;
+    }
+    loadMonthEntries(year, month, moodEntries).then(() => {
+        if (monthKey(currentDisplayedDate.getUTCFullYear(), currentDisplayedDate.getUTCMonth()) === key) {
+            renderCalendar(year, month, moodEntries, todayDateISO);
+            prefetchAround(year, month, moodEntries);
+        }
+    });
+}
 
 /**
  * Renders the calendar grid for a given year and month.
@@ -90,8 +271,13 @@ function renderCalendar(year, month, moodEntries, todayDateISO) {
  * This function should be called once the DOM is ready and data is available.
  * @param {object} moodEntries - The mood entries object from your template.
  * @param {string} todayFromFlask - Today's date "YYYY-MM-DD" from your template.
+ * @param {string} [loadedMonth] - "YYYY-MM" of the month already embedded in moodEntries.
  */
-export function setupCalendarControlsAndRender(moodEntries, todayFromFlask) {
+export function setupCalendarControlsAndRender(moodEntries, todayFromFlask, loadedMonth) {
+    if (loadedMonth) {
+        loadedMonths.add(loadedMonth);
+    }
+
     const prevMonthBtn = document.getElementById('prevMonthBtn');
     const nextMonthBtn = document.getElementById('nextMonthBtn');
 
@@ -113,17 +299,17 @@ export function setupCalendarControlsAndRender(moodEntries, todayFromFlask) {
     if (prevMonthBtn) {
         prevMonthBtn.addEventListener('click', () => {
             currentDisplayedDate.setUTCMonth(currentDisplayedDate.getUTCMonth() - 1);
-            renderCalendar(currentDisplayedDate.getUTCFullYear(), currentDisplayedDate.getUTCMonth(), moodEntries, todayFromFlask);
+            showMonth(currentDisplayedDate.getUTCFullYear(), currentDisplayedDate.getUTCMonth(), moodEntries, todayFromFlask);
         });
     }
 
     if (nextMonthBtn) {
         nextMonthBtn.addEventListener('click', () => {
             currentDisplayedDate.setUTCMonth(currentDisplayedDate.getUTCMonth() + 1);
-            renderCalendar(currentDisplayedDate.getUTCFullYear(), currentDisplayedDate.getUTCMonth(), moodEntries, todayFromFlask);
+            showMonth(currentDisplayedDate.getUTCFullYear(), currentDisplayedDate.getUTCMonth(), moodEntries, todayFromFlask);
         });
     }
 
     // Initial render of the calendar
-    renderCalendar(currentDisplayedDate.getUTCFullYear(), currentDisplayedDate.getUTCMonth(), moodEntries, todayFromFlask);
+    showMonth(currentDisplayedDate.getUTCFullYear(), currentDisplayedDate.getUTCMonth(), moodEntries, todayFromFlask);
 }
\ No newline at end of file
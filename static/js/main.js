@@ -1,6 +1,6 @@
 // main.js
 
-import { setupCalendarControlsAndRender } from './calender_renderer.js'; // Adjust path
+import { setupCalendarControlsAndRender, loadEntryDetails } from './calender_renderer.js'; // Adjust path
 
 document.addEventListener('DOMContentLoaded', function () {
     // Check if we are on a page that has the calendar
@@ -9,7 +9,7 @@ document.addEventListener('DOMContentLoaded', function () {
     if (calendarDisplayDiv) {
         // Ensure global variables from the template are available
         if (typeof window.moodEntriesByDateGlobal !== 'undefined' && typeof window.todayISOGlobal !== 'undefined') {
-            setupCalendarControlsAndRender(window.moodEntriesByDateGlobal, window.todayISOGlobal);
+            setupCalendarControlsAndRender(window.moodEntriesByDateGlobal, window.todayISOGlobal, window.loadedMonthGlobal);
         } else {
             console.error('moodEntriesByDateGlobal or todayISOGlobal not available on window for calendar rendering.');
         }
@@ -49,6 +49,7 @@ document.addEventListener('DOMContentLoaded', function () {
         const entry = moodEntriesByDate[isoDate]; // Access the global variable
 
         if (modalDateSpan) {
+            modalDateSpan.dataset.dateiso = isoDate;
             try {
                 // Format the date for display (e.g., "May 18, 2025")
                 const dateObj = new Date(isoDate + 'T00:00:00'); // Ensure it's treated as local date
@@ -62,7 +63,16 @@ document.addEventListener('DOMContentLoaded', function () {
 
         if (entry) {
             if (modalEmojiElement) modalEmojiElement.textContent = entry.emoji || '❓'; // Default if no emoji
-            if (modalTextResponseElement) modalTextResponseElement.textContent = entry.text_response || 'No text response recorded.';
+            if (entry.text_response === undefined) {
+                // Calendar months come from rollups (emoji only); the text comes from the prefetched month details or is fetched now
+                if (modalTextResponseElement) modalTextResponseElement.textContent = 'Loading...';
+                loadEntryDetails(isoDate, entry.emoji).then(details => {
+                    if (modalDateSpan && modalDateSpan.dataset.dateiso !== isoDate) return; // Another day was opened meanwhile
+                    if (modalTextResponseElement) modalTextResponseElement.textContent = (details && details.text_response) || 'No text response recorded.';
+                });
+            } else if (modalTextResponseElement) {
+                modalTextResponseElement.textContent = entry.text_response || 'No text response recorded.';
+            }
         } else {
             if (modalEmojiElement) modalEmojiElement.textContent = ''; // Placeholder for no entry
             if (modalTextResponseElement) modalTextResponseElement.textContent = 'No mood recorded for this day.';
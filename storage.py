@@ -0,0 +1,884 @@
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from datetime import datetime, timezone
+
+from metrics import instrumented
+from mood_rollups import ROLLUP_COLLECTION, month_key, apply_entry_to_rollup, merge_into_rollup
+from scheduler_shards import shard_bucket
+
+# --- Storage repository ---
+# Every read and write the app makes goes through one of these classes, so data access can be
+# measured and tuned in one place. FirestoreRepository is the production backend (Firestore +
+# Firebase Auth); SQLiteRepository is a self-contained local backend for small deployments,
+# load tests and offline benchmarking.
+#
+# Shapes used throughout:
+#   user profile: {'phone_number', 'is_subscribed', 'consent_updated_at', 'created_at', 'shard_bucket', ...}
+#   mood entry:   {'emoji', 'text_response', 'entry_date'}  (entry_date is 'YYYY-MM-DD')
+#   mood write:   (uid, 'YYYY-MM-DD', {'entry_date', 'emoji', 'text_response', 'timestamp'})
+
+
+class UserNotFoundError(Exception):
+    """No account exists for the given phone number."""
+
+
+class Repository:
+    """Interface implemented by the storage backends."""
+
+    # Accounts (phone number -> uid)
+    def get_uid_by_phone(self, phone_number_e164):
+        """Returns the uid for a phone number. Raises UserNotFoundError."""
+        raise NotImplementedError
+
+    def create_user_for_phone(self, phone_number_e164):
+        """Creates an account for a phone number and returns its uid."""
+        raise NotImplementedError
+
+    def get_uids_by_phones(self, phone_numbers_e164):
+        """Returns {phone_number: uid} for the listed numbers that have an account (missing ones are left out)."""
+        raise NotImplementedError
+
+    def import_accounts(self, phone_numbers_e164):
+        """
+        Creates accounts for phone numbers that don't have one yet, in as few calls as possible.
+        Returns ({phone_number: uid} created, {phone_number: reason} failed).
+        """
+        raise NotImplementedError
+
+    # User profiles
+    def get_user(self, uid):
+        """Returns the user's profile dict, or None."""
+        raise NotImplementedError
+
+    def subscribe_user(self, uid, phone_number_e164):
+        """Creates/updates the profile as subscribed (consent now). Returns True if the profile is new."""
+        raise NotImplementedError
+
+    def subscribe_new_users(self, phone_numbers_by_uid):
+        """
+        Creates a subscribed profile for each {uid: phone_number} that doesn't have one yet, in as few
+        batches as possible. Existing profiles are left as they are, so a bulk import never overrides
+        a STOP. Returns (new_uids, opted_out_uids): the uids given a profile, and the existing ones
+        that are unsubscribed.
+        """
+        raise NotImplementedError
+
+    def set_subscription(self, uid, is_subscribed):
+        """Records a STOP/START consent change."""
+        raise NotImplementedError
+
+    def update_user(self, uid, fields):
+        """Sets profile fields (e.g. timezone, prompt_time, prompt_slot_utc) on an existing user."""
+        raise NotImplementedError
+
+    def iter_subscribed_users(self, bucket_range=None, after_uid=None, slot=None):
+        """
+        Yields (uid, phone_number) for every subscribed user with a phone number.
+        With bucket_range=(start, end), only users whose shard_bucket is in [start, end) are
+        returned, ordered by (shard_bucket, uid) and resuming after 'after_uid' if given.
+        With slot, only users whose prompt_slot_utc equals it (see prompt_schedule.py).
+        """
+        raise NotImplementedError
+
+    def iter_subscribed_profiles(self):
+        """Yields (uid, profile) for every subscribed user."""
+        raise NotImplementedError
+
+    def put_prompt_slots(self, slots):
+        """Writes {uid: prompt_slot_utc} in as few batches as possible."""
+        raise NotImplementedError
+
+    def backfill_shard_buckets(self):
+        """Sets shard_bucket on profiles that don't have it yet. Returns how many were updated."""
+        raise NotImplementedError
+
+    def iter_user_ids(self, page_size=500):
+        """Yields every user's uid in uid order, reading 'page_size' at a time."""
+        raise NotImplementedError
+
+    # Mood entries
+    def get_entry(self, uid, date_str):
+        """Returns one mood entry, or None. Also includes its 'version' and write 'timestamp' (None on old entries)."""
+        raise NotImplementedError
+
+    def get_entries(self, uid, date_strs):
+        """Returns {date_str: entry} (as get_entry) for the listed days that have one, in one round trip."""
+        raise NotImplementedError
+
+    def list_entries(self, uid, from_date_str, to_date_str, cursor=None, limit=None):
+        """
+        Returns (entries_by_date_iso, next_cursor) for entries dated from_date_str..to_date_str
+        (inclusive). 'cursor' is the last date of the previous page; next_cursor is None on the
+        last page.
+        """
+        raise NotImplementedError
+
+    def iter_entries(self, uid):
+        """Yields (date_str, entry) for all of a user's entries in date order."""
+        raise NotImplementedError
+
+    # Monthly rollups (see mood_rollups.py)
+    def get_month_rollup(self, uid, month):
+        """Returns the users/{uid}/mood_months/{YYYY-MM} rollup, or None."""
+        raise NotImplementedError
+
+    def get_month_rollups(self, keys):
+        """Returns {(uid, month): rollup or None} for a list of (uid, month) keys, in one round trip."""
+        raise NotImplementedError
+
+    def merge_month_rollups(self, rollups):
+        """
+        Merges rebuilt {(uid, month): rollup} into the stored rollups (see mood_rollups.merge_into_rollup),
+        reading and writing each one in a transaction so entries written meanwhile are kept.
+        """
+        raise NotImplementedError
+
+    def write_mood_entries(self, mood_writes):
+        """
+        Saves mood entries and updates each affected month's rollup. The rollups are read and
+        written back in the same transaction as the entries, so concurrent writes to one month
+        never lose a day. A write older than its day's stored entry is skipped (see
+        drop_stale_mood_writes); otherwise later entries for the same day overwrite earlier ones.
+        """
+        raise NotImplementedError
+
+
+def rollup_keys(mood_writes):
+    """The distinct (uid, YYYY-MM) rollups a list of mood writes touches."""
+    return list(dict.fromkeys((uid, month_key(date_str)) for uid, date_str, _ in mood_writes))
+
+
+def drop_stale_mood_writes(mood_writes, stored_timestamps):
+    """
+    Drops each write whose 'timestamp' is older than its day's stored entry (stored_timestamps:
+    {(uid, date_str): timestamp or None}) or than an earlier write in the list, so a retried or
+    delayed reply never overwrites a newer one. Writes or entries without a timestamp always count as newer.
+    """
+    latest = {key: _as_utc(timestamp) for key, timestamp in stored_timestamps.items()}
+    kept = []
+    for uid, date_str, mood_data in mood_writes:
+        timestamp = _as_utc(mood_data.get('timestamp'))
+        newest = latest.get((uid, date_str))
+        if timestamp is not None and newest is not None and timestamp < newest:
+            continue
+        latest[(uid, date_str)] = timestamp
+        kept.append((uid, date_str, mood_data))
+    return kept
+
+
+def _as_utc(timestamp):
+    """A stored or written timestamp (datetime, ISO text or None) as an aware datetime, or None."""
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    if isinstance(timestamp, datetime) and timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp if isinstance(timestamp, datetime) else None
+
+
+def stamp_mood_writes(mood_writes, rollups):
+    """
+    Applies mood writes to their month rollups. Returns (stamped_writes, updated_rollups): each
+    write's mood_data gets its rollup's new version. 'rollups' itself is left unchanged.
+    """
+    rollups = dict(rollups)
+    stamped_writes = []
+    for uid, date_str, mood_data in mood_writes:
+        key = (uid, month_key(date_str))
+        rollups[key] = apply_entry_to_rollup(rollups.get(key), date_str, mood_data['emoji'])
+        stamped_writes.append((uid, date_str, dict(mood_data, version=rollups[key]['version'])))
+    return stamped_writes, rollups
+
+
+class FirestoreRepository(Repository):
+    """
+    Firestore + Firebase Auth backend. Layout:
+    users/{uid}, users/{uid}/mood_entries/{YYYY-MM-DD}, users/{uid}/mood_months/{YYYY-MM}
+    """
+
+    MAX_BATCH_WRITES = 500 # Firestore's per-batch write limit
+    MAX_AUTH_LOOKUPS = 100 # Firebase Auth get_users() limit per call
+    MAX_AUTH_IMPORTS = 1000 # Firebase Auth import_users() limit per call
+
+    def __init__(self, db, auth):
+        from firebase_admin import firestore # Only needed by this backend
+        self.db = db
+        self.auth = auth
+        self._firestore = firestore
+
+    def _user_ref(self, uid):
+        return self.db.collection('users').document(uid)
+
+    def _entries_ref(self, uid):
+        return self._user_ref(uid).collection('mood_entries')
+
+    def _rollup_ref(self, uid, month):
+        return self._user_ref(uid).collection(ROLLUP_COLLECTION).document(month)
+
+    @staticmethod
+    def _entry_to_dict(entry_doc):
+        entry_data = entry_doc.to_dict()
+        # Ensure entry_date is a string in YYYY-MM-DD. Firestore Timestamp needs conversion.
+        entry_date_val = entry_data.get('entry_date')
+        if isinstance(entry_date_val, datetime): # If Firestore Timestamp
+            entry_date_str = entry_date_val.strftime('%Y-%m-%d')
+        elif isinstance(entry_date_val, str): # If already string
+            entry_date_str = entry_date_val
+        else: # Fallback or error
+            entry_date_str = entry_doc.id # Assuming doc ID is YYYY-MM-DD
+        return {
+            'emoji': entry_data.get('emoji'),
+            'text_response': entry_data.get('text_response'),
+            'entry_date': entry_date_str,
+        }
+
+    @classmethod
+    def _stamped_entry_to_dict(cls, entry_doc):
+        """_entry_to_dict plus the entry's version and write timestamp (see Repository.get_entry)."""
+        entry_data = entry_doc.to_dict()
+        return dict(cls._entry_to_dict(entry_doc), version=entry_data.get('version'), timestamp=entry_data.get('timestamp'))
+
+    def _commit_in_batches(self, writes):
+        """writes: iterable of (doc_ref, data, merge). Each chunk commits atomically."""
+        batch = self.db.batch()
+        pending = 0
+        for doc_ref, data, merge in writes:
+            batch.set(doc_ref, data, merge=merge)
+            pending += 1
+            if pending == self.MAX_BATCH_WRITES:
+                batch.commit()
+                batch = self.db.batch()
+                pending = 0
+        if pending:
+            batch.commit()
+
+    # Accounts
+    @instrumented('firebase_auth', 'get_user_by_phone_number', expected_errors=(UserNotFoundError,))
+    def get_uid_by_phone(self, phone_number_e164):
+        try:
+            return self.auth.get_user_by_phone_number(phone_number_e164).uid
+        except self.auth.UserNotFoundError as e:
+            raise UserNotFoundError(phone_number_e164) from e
+
+    @instrumented('firebase_auth', 'create_user')
+    def create_user_for_phone(self, phone_number_e164):
+        return self.auth.create_user(phone_number=phone_number_e164).uid
+
+    @instrumented('firebase_auth', 'get_users')
+    def get_uids_by_phones(self, phone_numbers_e164):
+        uids_by_phone = {}
+        for start in range(0, len(phone_numbers_e164), self.MAX_AUTH_LOOKUPS):
+            identifiers = [self.auth.PhoneIdentifier(phone_number)
+                           for phone_number in phone_numbers_e164[start:start + self.MAX_AUTH_LOOKUPS]]
+            for user_record in self.auth.get_users(identifiers).users:
+                uids_by_phone[user_record.phone_number] = user_record.uid
+        return uids_by_phone
+
+    @instrumented('firebase_auth', 'import_users')
+    def import_accounts(self, phone_numbers_e164):
+        created, failed = {}, {}
+        for start in range(0, len(phone_numbers_e164), self.MAX_AUTH_IMPORTS):
+            chunk = phone_numbers_e164[start:start + self.MAX_AUTH_IMPORTS]
+            # import_users needs the uids up front; same shape as the ones Firebase Auth generates
+            uids = [uuid.uuid4().hex[:28] for _ in chunk]
+            result = self.auth.import_users([self.auth.ImportUserRecord(uid, phone_number=phone_number)
+                                             for uid, phone_number in zip(uids, chunk)])
+            errors = {error.index: error.reason for error in result.errors}
+            for index, (uid, phone_number) in enumerate(zip(uids, chunk)):
+                if index in errors:
+                    failed[phone_number] = errors[index]
+                else:
+                    created[phone_number] = uid
+        return created, failed
+
+    # User profiles
+    @instrumented('firestore', 'get_user')
+    def get_user(self, uid):
+        user_doc = self._user_ref(uid).get()
+        return user_doc.to_dict() if user_doc.exists else None
+
+    @instrumented('firestore', 'subscribe_user')
+    def subscribe_user(self, uid, phone_number_e164):
+        user_doc_ref = self._user_ref(uid)
+        user_data_firestore = {
+            'phone_number': phone_number_e164,
+            'is_subscribed': True,
+            'consent_updated_at': self._firestore.SERVER_TIMESTAMP, # Use server timestamp
+            'shard_bucket': shard_bucket(uid),
+        }
+        # Add created_at only if document doesn't exist (new user profile in Firestore)
+        is_new = not user_doc_ref.get().exists
+        if is_new:
+            user_data_firestore['created_at'] = self._firestore.SERVER_TIMESTAMP
+        user_doc_ref.set(user_data_firestore, merge=True) # merge=True to update if exists, create if not
+        return is_new
+
+    @instrumented('firestore', 'subscribe_new_users')
+    def subscribe_new_users(self, phone_numbers_by_uid):
+        user_refs = [self._user_ref(uid) for uid in phone_numbers_by_uid]
+        subscribed_by_uid = {user_doc.id: bool((user_doc.to_dict() or {}).get('is_subscribed'))
+                             for user_doc in self.db.get_all(user_refs, field_paths=['is_subscribed']) if user_doc.exists}
+        new_uids = [uid for uid in phone_numbers_by_uid if uid not in subscribed_by_uid]
+        writes = []
+        for uid in new_uids:
+            writes.append((self._user_ref(uid), {
+                'phone_number': phone_numbers_by_uid[uid],
+                'is_subscribed': True,
+                'consent_updated_at': self._firestore.SERVER_TIMESTAMP,
+                'created_at': self._firestore.SERVER_TIMESTAMP,
+                'shard_bucket': shard_bucket(uid),
+            }, True))
+        self._commit_in_batches(writes)
+        return new_uids, [uid for uid, is_subscribed in subscribed_by_uid.items() if not is_subscribed]
+
+    @instrumented('firestore', 'set_subscription')
+    def set_subscription(self, uid, is_subscribed):
+        self._user_ref(uid).update({'is_subscribed': is_subscribed,
+                                    'consent_updated_at': self._firestore.SERVER_TIMESTAMP,
+                                    'shard_bucket': shard_bucket(uid)})
+
+    @instrumented('firestore', 'update_user')
+    def update_user(self, uid, fields):
+        self._user_ref(uid).update(fields)
+
+    @instrumented('firestore', 'iter_subscribed_users')
+    def iter_subscribed_users(self, bucket_range=None, after_uid=None, slot=None):
+        FieldFilter = self._firestore.FieldFilter
+        users_ref = self.db.collection('users').where(filter=FieldFilter('is_subscribed', '==', True))
+        if slot is not None:
+            users_ref = users_ref.where(filter=FieldFilter('prompt_slot_utc', '==', slot))
+        if bucket_range is not None:
+            # Needs a composite index on (is_subscribed, [prompt_slot_utc,] shard_bucket, __name__)
+            users_ref = (users_ref
+                         .where(filter=FieldFilter('shard_bucket', '>=', bucket_range[0]))
+                         .where(filter=FieldFilter('shard_bucket', '<', bucket_range[1]))
+                         .order_by('shard_bucket')
+                         .order_by('__name__'))
+            if after_uid:
+                users_ref = users_ref.start_after({'shard_bucket': shard_bucket(after_uid), '__name__': after_uid})
+        for user_doc in users_ref.stream():
+            phone_number = user_doc.to_dict().get('phone_number')
+            if phone_number:
+                yield user_doc.id, phone_number
+
+    @instrumented('firestore', 'iter_subscribed_profiles')
+    def iter_subscribed_profiles(self):
+        users_ref = self.db.collection('users').where(filter=self._firestore.FieldFilter('is_subscribed', '==', True))
+        for user_doc in users_ref.stream():
+            yield user_doc.id, user_doc.to_dict()
+
+    @instrumented('firestore', 'put_prompt_slots')
+    def put_prompt_slots(self, slots):
+        self._commit_in_batches((self._user_ref(uid), {'prompt_slot_utc': slot}, True) for uid, slot in slots.items())
+
+    @instrumented('firestore', 'backfill_shard_buckets')
+    def backfill_shard_buckets(self):
+        updates = [(user_doc.reference, {'shard_bucket': shard_bucket(user_doc.id)}, True)
+                   for user_doc in self.db.collection('users').stream()
+                   if user_doc.to_dict().get('shard_bucket') != shard_bucket(user_doc.id)]
+        self._commit_in_batches(updates)
+        return len(updates)
+
+    @instrumented('firestore', 'iter_user_ids')
+    def iter_user_ids(self, page_size=500):
+        # Pages by document ID rather than holding one stream open over the whole collection
+        users_ref = self.db.collection('users')
+        last_uid = None
+        while True:
+            query = users_ref.order_by('__name__').limit(page_size)
+            if last_uid is not None:
+                query = query.where(filter=self._firestore.FieldFilter('__name__', '>', users_ref.document(last_uid)))
+            page = [user_doc.id for user_doc in query.stream()]
+            yield from page
+            if len(page) < page_size:
+                return
+            last_uid = page[-1]
+
+    # Mood entries
+    @instrumented('firestore', 'get_entry')
+    def get_entry(self, uid, date_str):
+        entry_doc = self._entries_ref(uid).document(date_str).get()
+        return self._stamped_entry_to_dict(entry_doc) if entry_doc.exists else None
+
+    @instrumented('firestore', 'get_entries')
+    def get_entries(self, uid, date_strs):
+        entries_ref = self._entries_ref(uid)
+        entries = {}
+        if date_strs:
+            for entry_doc in self.db.get_all([entries_ref.document(date_str) for date_str in date_strs]):
+                if entry_doc.exists:
+                    entries[entry_doc.id] = self._stamped_entry_to_dict(entry_doc)
+        return entries
+
+    @instrumented('firestore', 'list_entries')
+    def list_entries(self, uid, from_date_str, to_date_str, cursor=None, limit=None):
+        # Entry document IDs are YYYY-MM-DD, so a date range is a document-ID range
+        entries_ref = self._entries_ref(uid)
+        FieldFilter = self._firestore.FieldFilter
+        lower_op, lower_id = ('>', cursor) if cursor else ('>=', from_date_str)
+        query = (entries_ref
+                 .where(filter=FieldFilter('__name__', lower_op, entries_ref.document(lower_id)))
+                 .where(filter=FieldFilter('__name__', '<=', entries_ref.document(to_date_str)))
+                 .order_by('__name__'))
+        if limit:
+            query = query.limit(limit + 1) # One extra document tells us whether there is another page
+
+        entries_by_date_iso = {}
+        next_cursor = last_doc_id = None
+        for position, entry_doc in enumerate(query.stream()):
+            if limit and position == limit:
+                next_cursor = last_doc_id
+                break
+            entry = self._entry_to_dict(entry_doc)
+            entries_by_date_iso[entry['entry_date']] = entry
+            last_doc_id = entry_doc.id
+        return entries_by_date_iso, next_cursor
+
+    @instrumented('firestore', 'iter_entries')
+    def iter_entries(self, uid):
+        for entry_doc in self._entries_ref(uid).order_by('__name__').stream():
+            yield entry_doc.id, self._entry_to_dict(entry_doc)
+
+    # Monthly rollups
+    @instrumented('firestore', 'get_month_rollup')
+    def get_month_rollup(self, uid, month):
+        rollup_doc = self._rollup_ref(uid, month).get()
+        return rollup_doc.to_dict() if rollup_doc.exists else None
+
+    @instrumented('firestore', 'get_month_rollups')
+    def get_month_rollups(self, keys):
+        refs = {self._rollup_ref(uid, month).path: (uid, month) for uid, month in keys}
+        rollups = dict.fromkeys(keys)
+        if refs:
+            for rollup_doc in self.db.get_all([self.db.document(path) for path in refs]):
+                if rollup_doc.exists:
+                    rollups[refs[rollup_doc.reference.path]] = rollup_doc.to_dict()
+        return rollups
+
+    def _rollup_writes(self, rollups):
+        for (uid, month), rollup in rollups.items():
+            rollup = dict(rollup, updated_at=self._firestore.SERVER_TIMESTAMP)
+            yield self._rollup_ref(uid, month), rollup, False
+
+    def _read_and_write(self, refs, build_writes):
+        """
+        Reads the documents at 'refs' and applies the (doc_ref, data, merge) writes that
+        build_writes({path: data or None}) returns, in one transaction (retried if one of them
+        changes meanwhile).
+        """
+        @self._firestore.transactional
+        def _apply(transaction):
+            docs = dict.fromkeys(ref.path for ref in refs)
+            for doc in self.db.get_all(refs, transaction=transaction):
+                if doc.exists:
+                    docs[doc.reference.path] = doc.to_dict()
+            for doc_ref, data, merge in build_writes(docs):
+                transaction.set(doc_ref, data, merge=merge)
+        _apply(self.db.transaction())
+
+    @instrumented('firestore', 'merge_month_rollups')
+    def merge_month_rollups(self, rollups):
+        keys = list(rollups)
+        for start in range(0, len(keys), self.MAX_BATCH_WRITES):
+            refs = {key: self._rollup_ref(*key) for key in keys[start:start + self.MAX_BATCH_WRITES]}
+            self._read_and_write(list(refs.values()), lambda docs, refs=refs: self._rollup_writes(
+                {key: merge_into_rollup(docs[ref.path], key[1], rollups[key]['days']) for key, ref in refs.items()}))
+
+    @instrumented('firestore', 'write_mood_entries')
+    def write_mood_entries(self, mood_writes):
+        # Each write adds at most one rollup, so half a batch of entries fits in one transaction
+        for start in range(0, len(mood_writes), self.MAX_BATCH_WRITES // 2):
+            chunk = mood_writes[start:start + self.MAX_BATCH_WRITES // 2]
+            refs = self._mood_write_refs(chunk)
+            self._read_and_write(refs, lambda docs, chunk=chunk: self._mood_writes(chunk, docs))
+
+    def _mood_write_refs(self, mood_writes):
+        """The entries and rollups a transaction writing 'mood_writes' reads."""
+        days = dict.fromkeys((uid, date_str) for uid, date_str, _ in mood_writes)
+        return ([self._entries_ref(uid).document(date_str) for uid, date_str in days] +
+                [self._rollup_ref(uid, month) for uid, month in rollup_keys(mood_writes)])
+
+    def _mood_writes(self, mood_writes, docs):
+        """The writes for 'mood_writes', given the documents _mood_write_refs names ({path: data or None})."""
+        stored_timestamps = {(uid, date_str): (docs[self._entries_ref(uid).document(date_str).path] or {}).get('timestamp')
+                             for uid, date_str, _ in mood_writes}
+        mood_writes = drop_stale_mood_writes(mood_writes, stored_timestamps)
+        rollups = {(uid, month): docs[self._rollup_ref(uid, month).path] for uid, month in rollup_keys(mood_writes)}
+        stamped_writes, rollups = stamp_mood_writes(mood_writes, rollups)
+        entry_writes = [(self._entries_ref(uid).document(date_str), mood_data, False) # Overwrites that day's entry
+                        for uid, date_str, mood_data in stamped_writes]
+        return entry_writes + list(self._rollup_writes(rollups))
+
+
+class SQLiteRepository(Repository):
+    """
+    Local single-file backend. The indexes cover the app's hot queries: (uid, entry_date) for
+    calendar ranges and day lookups, phone_number for the SMS webhook, and is_subscribed for
+    the daily prompt run.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            uid TEXT PRIMARY KEY,
+            phone_number TEXT UNIQUE,
+            is_subscribed INTEGER NOT NULL DEFAULT 0,
+            consent_updated_at TEXT,
+            created_at TEXT,
+            shard_bucket INTEGER,  -- see scheduler_shards.shard_bucket
+            prompt_slot_utc INTEGER,  -- see prompt_schedule.py
+            profile TEXT NOT NULL DEFAULT '{}'  -- any other profile fields, as JSON
+        );
+        CREATE TABLE IF NOT EXISTS mood_entries (
+            uid TEXT NOT NULL,
+            entry_date TEXT NOT NULL,  -- YYYY-MM-DD
+            emoji TEXT,
+            text_response TEXT,
+            timestamp TEXT,
+            version INTEGER,  -- see mood_rollups.apply_entry_to_rollup
+            PRIMARY KEY (uid, entry_date)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS mood_months (
+            uid TEXT NOT NULL,
+            month TEXT NOT NULL,  -- YYYY-MM
+            rollup TEXT NOT NULL,  -- JSON, see mood_rollups.build_month_rollup
+            updated_at TEXT,
+            PRIMARY KEY (uid, month)
+        ) WITHOUT ROWID;
+    """
+    _USER_COLUMNS = ('phone_number', 'is_subscribed', 'consent_updated_at', 'created_at', 'shard_bucket', 'prompt_slot_utc')
+    # Integer columns added after the first release of this schema
+    _ADDED_COLUMNS = {'users': ('shard_bucket', 'prompt_slot_utc'), 'mood_entries': ('version',)}
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._conn()
+        conn.executescript(self._SCHEMA)
+        # Files created with an older version of a table get the newer columns here
+        for table, columns in self._ADDED_COLUMNS.items():
+            existing_columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+            for column in columns:
+                if column not in existing_columns:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER")
+        conn.executescript("""
+            DROP INDEX IF EXISTS idx_users_is_subscribed;
+            CREATE INDEX IF NOT EXISTS idx_users_subscribed_shard ON users (is_subscribed, shard_bucket, uid);
+            CREATE INDEX IF NOT EXISTS idx_users_subscribed_slot ON users (is_subscribed, prompt_slot_utc, shard_bucket, uid);
+        """)
+        self.backfill_shard_buckets()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _now():
+        return datetime.now(timezone.utc).isoformat()
+
+    @staticmethod
+    def _to_text(value):
+        return value.isoformat() if isinstance(value, datetime) else value
+
+    _USER_FIELDS_SQL = ', '.join(_USER_COLUMNS + ('profile',))
+
+    def _user_from_row(self, row):
+        user = json.loads(row[-1])
+        user.update(zip(self._USER_COLUMNS, row[:-1]))
+        user['is_subscribed'] = bool(user['is_subscribed'])
+        return user
+
+    # Accounts
+    @instrumented('sqlite', 'get_uid_by_phone', expected_errors=(UserNotFoundError,))
+    def get_uid_by_phone(self, phone_number_e164):
+        row = self._conn().execute("SELECT uid FROM users WHERE phone_number = ?", (phone_number_e164,)).fetchone()
+        if row is None:
+            raise UserNotFoundError(phone_number_e164)
+        return row[0]
+
+    @instrumented('sqlite', 'create_user_for_phone')
+    def create_user_for_phone(self, phone_number_e164):
+        uid = uuid.uuid4().hex[:28]
+        # created_at belongs to the profile and is set by subscribe_user, as on Firestore
+        self._conn().execute("INSERT INTO users (uid, phone_number, shard_bucket) VALUES (?, ?, ?)",
+                             (uid, phone_number_e164, shard_bucket(uid)))
+        return uid
+
+    @instrumented('sqlite', 'get_uids_by_phones')
+    def get_uids_by_phones(self, phone_numbers_e164):
+        placeholders = ', '.join('?' * len(phone_numbers_e164))
+        return dict(self._conn().execute(f"SELECT phone_number, uid FROM users WHERE phone_number IN ({placeholders})",
+                                         list(phone_numbers_e164)))
+
+    @instrumented('sqlite', 'import_accounts')
+    def import_accounts(self, phone_numbers_e164):
+        created = {phone_number: uuid.uuid4().hex[:28] for phone_number in phone_numbers_e164}
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            # OR IGNORE: a number that got an account since the caller looked it up is reported as failed
+            conn.executemany("INSERT OR IGNORE INTO users (uid, phone_number, shard_bucket) VALUES (?, ?, ?)",
+                             [(uid, phone_number, shard_bucket(uid)) for phone_number, uid in created.items()])
+            stored = self.get_uids_by_phones(list(created))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        failed = {phone_number: 'phone number already exists' for phone_number, uid in created.items()
+                  if stored.get(phone_number) != uid}
+        return {phone_number: uid for phone_number, uid in created.items() if phone_number not in failed}, failed
+
+    # User profiles
+    @instrumented('sqlite', 'get_user')
+    def get_user(self, uid):
+        row = self._conn().execute(f"SELECT {self._USER_FIELDS_SQL} FROM users WHERE uid = ?", (uid,)).fetchone()
+        return self._user_from_row(row) if row else None
+
+    @instrumented('sqlite', 'subscribe_user')
+    def subscribe_user(self, uid, phone_number_e164):
+        now = self._now()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            is_new = conn.execute("SELECT created_at IS NULL FROM users WHERE uid = ?", (uid,)).fetchone()
+            is_new = is_new is None or bool(is_new[0])
+            conn.execute(
+                """INSERT INTO users (uid, phone_number, is_subscribed, consent_updated_at, created_at, shard_bucket)
+                   VALUES (?, ?, 1, ?, ?, ?)
+                   ON CONFLICT (uid) DO UPDATE SET phone_number = excluded.phone_number, is_subscribed = 1,
+                       consent_updated_at = excluded.consent_updated_at,
+                       created_at = COALESCE(users.created_at, excluded.created_at),
+                       shard_bucket = excluded.shard_bucket""",
+                (uid, phone_number_e164, now, now, shard_bucket(uid)))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return is_new
+
+    @instrumented('sqlite', 'subscribe_new_users')
+    def subscribe_new_users(self, phone_numbers_by_uid):
+        now = self._now()
+        uids = list(phone_numbers_by_uid)
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            placeholders = ', '.join('?' * len(uids))
+            # Rows without created_at are accounts with no profile yet (see create_user_for_phone)
+            subscribed_by_uid = dict(conn.execute(
+                f"SELECT uid, is_subscribed FROM users WHERE uid IN ({placeholders}) AND created_at IS NOT NULL", uids))
+            new_uids = [uid for uid in uids if uid not in subscribed_by_uid]
+            conn.executemany(
+                """INSERT INTO users (uid, phone_number, is_subscribed, consent_updated_at, created_at, shard_bucket)
+                   VALUES (?, ?, 1, ?, ?, ?)
+                   ON CONFLICT (uid) DO UPDATE SET phone_number = excluded.phone_number, is_subscribed = 1,
+                       consent_updated_at = excluded.consent_updated_at,
+                       created_at = COALESCE(users.created_at, excluded.created_at),
+                       shard_bucket = excluded.shard_bucket""",
+                [(uid, phone_numbers_by_uid[uid], now, now, shard_bucket(uid)) for uid in new_uids])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return new_uids, [uid for uid, is_subscribed in subscribed_by_uid.items() if not is_subscribed]
+
+    @instrumented('sqlite', 'set_subscription')
+    def set_subscription(self, uid, is_subscribed):
+        self._conn().execute("UPDATE users SET is_subscribed = ?, consent_updated_at = ? WHERE uid = ?",
+                             (int(bool(is_subscribed)), self._now(), uid))
+
+    @instrumented('sqlite', 'update_user')
+    def update_user(self, uid, fields):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT profile FROM users WHERE uid = ?", (uid,)).fetchone()
+            if row is None:
+                raise KeyError(f"No user to update: {uid}")
+            columns = {key: value for key, value in fields.items() if key in self._USER_COLUMNS}
+            profile = dict(json.loads(row[0]), **{key: value for key, value in fields.items() if key not in columns})
+            assignments = ''.join(f"{column} = ?, " for column in columns)
+            conn.execute(f"UPDATE users SET {assignments}profile = ? WHERE uid = ?",
+                         list(columns.values()) + [json.dumps(profile), uid])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    @instrumented('sqlite', 'iter_subscribed_users')
+    def iter_subscribed_users(self, bucket_range=None, after_uid=None, slot=None):
+        sql = "SELECT uid, phone_number FROM users WHERE is_subscribed = 1 AND phone_number IS NOT NULL"
+        params = []
+        if slot is not None:
+            sql += " AND prompt_slot_utc = ?"
+            params.append(slot)
+        if bucket_range is not None:
+            start, end = bucket_range
+            after = (shard_bucket(after_uid), after_uid) if after_uid else (start - 1, '')
+            sql += " AND shard_bucket >= ? AND shard_bucket < ? AND (shard_bucket, uid) > (?, ?) ORDER BY shard_bucket, uid"
+            params.extend((start, end) + after)
+        yield from self._conn().execute(sql, params)
+
+    @instrumented('sqlite', 'iter_subscribed_profiles')
+    def iter_subscribed_profiles(self):
+        for row in self._conn().execute(f"SELECT uid, {self._USER_FIELDS_SQL} FROM users WHERE is_subscribed = 1"):
+            yield row[0], self._user_from_row(row[1:])
+
+    @instrumented('sqlite', 'put_prompt_slots')
+    def put_prompt_slots(self, slots):
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany("UPDATE users SET prompt_slot_utc = ? WHERE uid = ?",
+                             [(slot, uid) for uid, slot in slots.items()])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    @instrumented('sqlite', 'backfill_shard_buckets')
+    def backfill_shard_buckets(self):
+        conn = self._conn()
+        missing = [(shard_bucket(uid), uid) for (uid,) in conn.execute("SELECT uid FROM users WHERE shard_bucket IS NULL")]
+        if missing:
+            conn.execute("BEGIN")
+            conn.executemany("UPDATE users SET shard_bucket = ? WHERE uid = ?", missing)
+            conn.execute("COMMIT")
+        return len(missing)
+
+    @instrumented('sqlite', 'iter_user_ids')
+    def iter_user_ids(self, page_size=500):
+        for (uid,) in self._conn().execute("SELECT uid FROM users ORDER BY uid"):
+            yield uid
+
+    # Mood entries
+    @instrumented('sqlite', 'get_entry')
+    def get_entry(self, uid, date_str):
+        row = self._conn().execute(
+            "SELECT emoji, text_response, version, timestamp FROM mood_entries WHERE uid = ? AND entry_date = ?",
+            (uid, date_str)).fetchone()
+        if row is None:
+            return None
+        emoji, text_response, version, timestamp = row
+        return {'emoji': emoji, 'text_response': text_response, 'entry_date': date_str,
+                'version': version, 'timestamp': timestamp}
+
+    @instrumented('sqlite', 'get_entries')
+    def get_entries(self, uid, date_strs):
+        date_strs = list(date_strs)
+        if not date_strs:
+            return {}
+        rows = self._conn().execute(
+            f"""SELECT entry_date, emoji, text_response, version, timestamp FROM mood_entries
+                WHERE uid = ? AND entry_date IN ({', '.join('?' * len(date_strs))})""",
+            [uid] + date_strs)
+        return {entry_date: {'emoji': emoji, 'text_response': text_response, 'entry_date': entry_date,
+                             'version': version, 'timestamp': timestamp}
+                for entry_date, emoji, text_response, version, timestamp in rows}
+
+    @instrumented('sqlite', 'list_entries')
+    def list_entries(self, uid, from_date_str, to_date_str, cursor=None, limit=None):
+        lower_op, lower = ('>', cursor) if cursor else ('>=', from_date_str)
+        sql = (f"SELECT entry_date, emoji, text_response FROM mood_entries "
+               f"WHERE uid = ? AND entry_date {lower_op} ? AND entry_date <= ? ORDER BY entry_date")
+        params = [uid, lower, to_date_str]
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit + 1)
+        rows = self._conn().execute(sql, params).fetchall()
+        next_cursor = None
+        if limit and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1][0]
+        entries = {entry_date: {'emoji': emoji, 'text_response': text_response, 'entry_date': entry_date}
+                   for entry_date, emoji, text_response in rows}
+        return entries, next_cursor
+
+    @instrumented('sqlite', 'iter_entries')
+    def iter_entries(self, uid):
+        rows = self._conn().execute(
+            "SELECT entry_date, emoji, text_response FROM mood_entries WHERE uid = ? ORDER BY entry_date", (uid,))
+        for entry_date, emoji, text_response in rows:
+            yield entry_date, {'emoji': emoji, 'text_response': text_response, 'entry_date': entry_date}
+
+    # Monthly rollups
+    @instrumented('sqlite', 'get_month_rollup')
+    def get_month_rollup(self, uid, month):
+        row = self._conn().execute("SELECT rollup FROM mood_months WHERE uid = ? AND month = ?", (uid, month)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @instrumented('sqlite', 'get_month_rollups')
+    def get_month_rollups(self, keys):
+        return self._read_rollups(self._conn(), keys)
+
+    @staticmethod
+    def _read_entry_timestamps(conn, mood_writes):
+        timestamps = {}
+        for uid, date_str, _ in mood_writes:
+            row = conn.execute("SELECT timestamp FROM mood_entries WHERE uid = ? AND entry_date = ?", (uid, date_str)).fetchone()
+            timestamps[(uid, date_str)] = row[0] if row else None
+        return timestamps
+
+    @staticmethod
+    def _read_rollups(conn, keys):
+        rollups = dict.fromkeys(keys)
+        for uid, month in keys:
+            row = conn.execute("SELECT rollup FROM mood_months WHERE uid = ? AND month = ?", (uid, month)).fetchone()
+            if row:
+                rollups[(uid, month)] = json.loads(row[0])
+        return rollups
+
+    def _write_rollups(self, conn, rollups):
+        now = self._now()
+        conn.executemany(
+            "INSERT OR REPLACE INTO mood_months (uid, month, rollup, updated_at) VALUES (?, ?, ?, ?)",
+            [(uid, month, json.dumps(dict(rollup, updated_at=now)), now) for (uid, month), rollup in rollups.items()])
+
+    @instrumented('sqlite', 'merge_month_rollups')
+    def merge_month_rollups(self, rollups):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE") # Takes the write lock before reading, so no write lands in between
+        try:
+            stored = self._read_rollups(conn, list(rollups))
+            self._write_rollups(conn, {key: merge_into_rollup(stored[key], key[1], rollup['days'])
+                                       for key, rollup in rollups.items()})
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    @instrumented('sqlite', 'write_mood_entries')
+    def write_mood_entries(self, mood_writes):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE") # Takes the write lock before reading the rollups, so no write lands in between
+        try:
+            mood_writes = drop_stale_mood_writes(mood_writes, self._read_entry_timestamps(conn, mood_writes))
+            mood_writes, rollups = stamp_mood_writes(mood_writes, self._read_rollups(conn, rollup_keys(mood_writes)))
+            conn.executemany(
+                """INSERT OR REPLACE INTO mood_entries (uid, entry_date, emoji, text_response, timestamp, version)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                [(uid, date_str, data.get('emoji'), data.get('text_response'), self._to_text(data.get('timestamp')),
+                  data.get('version')) for uid, date_str, data in mood_writes])
+            self._write_rollups(conn, rollups)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def create_repository(backend, sqlite_path=None, firestore_db=None, firebase_auth=None):
+    """Builds the configured repository: 'firestore' (default) or 'sqlite'."""
+    if backend == 'sqlite':
+        return SQLiteRepository(sqlite_path)
+    if backend == 'firestore':
+        if firestore_db is None or firebase_auth is None:
+            return None
+        return FirestoreRepository(firestore_db, firebase_auth)
+    raise ValueError(f"Unknown storage backend: {backend!r}")
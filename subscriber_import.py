@@ -0,0 +1,132 @@
+import csv
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sms_handler import format_phone_to_e164
+
+logger = logging.getLogger(__name__)
+
+# --- Bulk subscriber import ---
+# Onboards a cohort of phone numbers without each person going through /login -> /verify_otp.
+# Numbers are normalized to E.164 (memoized), de-duplicated, and grouped into batches. Each batch
+# costs a handful of round trips whatever its size: one account lookup, one account import for the
+# numbers without an account, and one profile read + batched write. Batches run in parallel.
+
+IMPORT_FORMATS = ('csv', 'ndjson')
+PHONE_FIELDS = ('phone_number', 'phone') # Column/key names accepted for the number
+
+
+def iter_subscriber_phones(lines, input_format):
+    """Yields the raw phone number of each record in a CSV (with a header) or NDJSON text stream."""
+    if input_format == 'csv':
+        records = csv.DictReader(lines)
+    elif input_format == 'ndjson':
+        records = (json.loads(line) for line in lines if line.strip())
+    else:
+        raise ValueError(f"Unknown import format: {input_format!r}")
+    for record in records:
+        yield next((record[field] for field in PHONE_FIELDS if record.get(field)), None)
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_batch(repository, phone_numbers):
+    """
+    Creates the missing accounts and profiles for a batch of distinct E.164 numbers. Numbers whose
+    profile is unsubscribed (they replied STOP) are left unsubscribed and counted as opted_out.
+    Returns a stats dict: existing, created, failed, new_profiles, opted_out, and
+    phone_numbers_by_uid / new_uids for the numbers now subscribed / given a profile.
+    """
+    uids_by_phone = repository.get_uids_by_phones(phone_numbers)
+    existing = len(uids_by_phone)
+    missing = [phone_number for phone_number in phone_numbers if phone_number not in uids_by_phone]
+    created, failed = repository.import_accounts(missing) if missing else ({}, {})
+    for phone_number, reason in failed.items():
+        logger.warning(f"Import: Could not create an account for {phone_number}: {reason}")
+    uids_by_phone.update(created)
+    phone_numbers_by_uid = {uid: phone_number for phone_number, uid in uids_by_phone.items()}
+    new_uids, opted_out_uids = repository.subscribe_new_users(phone_numbers_by_uid) if phone_numbers_by_uid else ([], [])
+    for uid in opted_out_uids:
+        del phone_numbers_by_uid[uid]
+    return {'existing': existing, 'created': len(created), 'failed': len(failed), 'new_profiles': len(new_uids),
+            'opted_out': len(opted_out_uids), 'phone_numbers_by_uid': phone_numbers_by_uid, 'new_uids': new_uids}
+
+
+def import_subscribers(repository, raw_phone_numbers, batch_size=500, max_workers=4, after_batch=None, on_progress=None):
+    """
+    Imports every number in 'raw_phone_numbers' (any iterable, read lazily) as a subscribed user,
+    except those that have opted out.
+    At most 2 * max_workers batches are queued or in flight, so the input is never fully
+    materialized (only the set of numbers already seen is kept, to drop duplicates).
+
+    after_batch(batch_result) runs in the worker after each batch is written (e.g. to set prompt
+    slots on the new profiles); on_progress(stats) runs after each batch completes.
+
+    Returns a stats dict: rows, invalid, duplicates, existing, created, failed, new_profiles,
+    opted_out, subscribed, wall_time_seconds, throughput_per_second (rows per second).
+    """
+    max_workers = max(1, int(max_workers))
+    in_flight = threading.BoundedSemaphore(max_workers * 2)
+    stats_lock = threading.Lock()
+    stats = {'rows': 0, 'invalid': 0, 'duplicates': 0, 'existing': 0, 'created': 0, 'failed': 0,
+             'new_profiles': 0, 'opted_out': 0, 'subscribed': 0}
+    seen = set()
+    started_at = time.monotonic()
+
+    def snapshot():
+        elapsed = time.monotonic() - started_at
+        return dict(stats, wall_time_seconds=round(elapsed, 3),
+                    throughput_per_second=round(stats['rows'] / elapsed, 2) if elapsed > 0 else 0.0)
+
+    def normalized_phones():
+        for raw_phone_number in raw_phone_numbers:
+            phone_number = format_phone_to_e164(raw_phone_number.strip()) if raw_phone_number else None
+            with stats_lock:
+                stats['rows'] += 1
+                if phone_number is None:
+                    stats['invalid'] += 1
+                    continue
+                if phone_number in seen:
+                    stats['duplicates'] += 1
+                    continue
+            seen.add(phone_number)
+            yield phone_number
+
+    def run_batch(phone_numbers):
+        try:
+            result = import_batch(repository, phone_numbers)
+            if after_batch is not None:
+                after_batch(result)
+        except Exception as e:
+            logger.error(f"Import: Batch of {len(phone_numbers)} numbers failed: {e}")
+            result = {'failed': len(phone_numbers)}
+        finally:
+            in_flight.release()
+        with stats_lock:
+            for key in ('existing', 'created', 'failed', 'new_profiles', 'opted_out'):
+                stats[key] += result.get(key, 0)
+            stats['subscribed'] += len(result.get('phone_numbers_by_uid', ()))
+            progress = snapshot()
+        if on_progress is not None:
+            on_progress(progress)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='subscriber-import') as executor:
+        for batch in _batches(normalized_phones(), max(1, int(batch_size))):
+            in_flight.acquire() # Backpressure: don't read further ahead than the workers can write
+            executor.submit(run_batch, batch)
+
+    result = snapshot()
+    logger.info(f"Import: {result}")
+    return result
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The app is a set of top-level modules, not a package: make them and the benchmark fakes importable
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'benchmarks')]
@@ -0,0 +1,62 @@
+import time
+
+import pytest
+
+from scheduler_shards import ACQUIRED, DONE, HELD, LeaseLost, ShardedRun, ShardLease, SQLiteLeaseStore
+
+
+@pytest.fixture
+def lease_store(tmp_path):
+    return SQLiteLeaseStore(str(tmp_path / 'leases.sqlite3'))
+
+
+def test_live_lease_is_held_and_expired_lease_is_taken_over(lease_store):
+    assert lease_store.acquire('run', 0, 'a', ttl_seconds=0.2) == (ACQUIRED, None)
+    assert lease_store.acquire('run', 0, 'b', ttl_seconds=0.2) == (HELD, None)
+    lease_store.renew('run', 0, 'a', ttl_seconds=0.2, cursor='uid-5')
+    time.sleep(0.3)
+    # b resumes from a's last checkpoint; a can no longer renew or complete
+    assert lease_store.acquire('run', 0, 'b', ttl_seconds=10) == (ACQUIRED, 'uid-5')
+    assert lease_store.renew('run', 0, 'a', ttl_seconds=10) is False
+    assert lease_store.complete('run', 0, 'a') is False
+    assert lease_store.complete('run', 0, 'b') is True
+    assert lease_store.acquire('run', 0, 'a', ttl_seconds=10) == (DONE, None)
+
+
+def test_checkpoint_after_takeover_raises_lease_lost(lease_store):
+    lease_store.acquire('run', 0, 'a', ttl_seconds=10)
+    lease = ShardLease(lease_store, 'run', 0, 'a', ttl_seconds=10)
+    lease.checkpoint('uid-1')
+    lease_store.release('run', 0, 'a')
+    lease_store.acquire('run', 0, 'b', ttl_seconds=10)
+    with pytest.raises(LeaseLost):
+        lease.checkpoint('uid-2')
+    lease.close(completed=False)
+
+
+def test_sharded_run_resumes_a_crashed_shard_from_its_cursor(lease_store):
+    # Instance 'a' checkpoints uid-1 on shard 0, then dies without releasing its lease
+    lease_store.acquire('run', 0, 'a', ttl_seconds=0.2)
+    lease_store.renew('run', 0, 'a', ttl_seconds=0.2, cursor='uid-1')
+
+    seen = {}
+
+    def process_shard(shard, lease):
+        seen[shard] = lease.cursor
+        lease.checkpoint(f'uid-{shard}-last')
+
+    result = ShardedRun(lease_store, num_shards=2, owner='b', lease_ttl_seconds=10,
+                        run_window_seconds=5, poll_interval_seconds=0.1).run('run', process_shard)
+    assert sorted(result['shards_processed']) == [0, 1] and result['shards_pending'] == []
+    assert seen == {0: 'uid-1', 1: None}
+
+    # A finished run is never processed again
+    again = ShardedRun(lease_store, num_shards=2, owner='c', run_window_seconds=1).run('run', process_shard)
+    assert again == {'shards_processed': [], 'shards_pending': []}
+
+
+def test_sharded_run_gives_up_on_shards_held_past_the_window(lease_store):
+    lease_store.acquire('run', 1, 'a', ttl_seconds=60)
+    result = ShardedRun(lease_store, num_shards=2, owner='b', lease_ttl_seconds=10,
+                        run_window_seconds=0.2, poll_interval_seconds=0.05).run('run', lambda shard, lease: None)
+    assert result == {'shards_processed': [0], 'shards_pending': [1]}
@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pytest
+
+from sms_dispatch import TokenBucket
+from sms_queue import PRIORITY_OTP, PRIORITY_PROMPT, PRIORITY_WELCOME, OutboundSMSQueue
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() >= deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+class Recorder:
+    """send_func that records messages and fails the first 'failures' sends of each body."""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.sent = []
+        self.attempts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, to_number, body):
+        with self._lock:
+            self.attempts[body] = self.attempts.get(body, 0) + 1
+            if self.attempts[body] <= self.failures:
+                return False
+            self.sent.append((to_number, body))
+            return True
+
+
+@pytest.fixture
+def make_queue(tmp_path):
+    queues = []
+
+    def make(send_func, **kwargs):
+        kwargs = dict(dict(num_workers=1, backoff_seconds=0.01, backoff_max_seconds=0.05, poll_interval_seconds=0.01), **kwargs)
+        queue = OutboundSMSQueue(str(tmp_path / 'sms_queue.sqlite3'), send_func=send_func, **kwargs)
+        queues.append(queue)
+        return queue
+
+    yield make
+    for queue in queues:
+        queue.stop()
+
+
+def test_higher_priority_lanes_are_sent_first(make_queue):
+    recorder = Recorder()
+    queue = make_queue(recorder)
+    queue.enqueue_many([(f'+1415555010{i}', f'prompt {i}') for i in range(3)], priority=PRIORITY_PROMPT)
+    queue.enqueue('+14155550200', 'welcome 1', priority=PRIORITY_WELCOME)
+    queue.enqueue('+14155550200', 'welcome 2', priority=PRIORITY_WELCOME)
+    queue.enqueue('+14155550300', 'otp', priority=PRIORITY_OTP)
+    queue.start()
+    wait_until(lambda: len(recorder.sent) == 6)
+    assert [body for _, body in recorder.sent] == ['otp', 'welcome 1', 'welcome 2', 'prompt 0', 'prompt 1', 'prompt 2']
+    assert queue.stats() == {}
+
+
+def test_failed_sends_are_retried(make_queue):
+    recorder = Recorder(failures=2)
+    queue = make_queue(recorder, max_attempts=5)
+    queue.enqueue('+14155550100', 'prompt')
+    queue.start()
+    wait_until(lambda: recorder.sent)
+    assert recorder.attempts == {'prompt': 3}
+    assert queue.stats() == {}
+
+
+def test_messages_that_keep_failing_are_dead_lettered(make_queue):
+    recorder = Recorder(failures=100)
+    queue = make_queue(recorder, max_attempts=3)
+    queue.enqueue('+14155550100', 'prompt')
+    queue.start()
+    wait_until(lambda: queue.stats() == {'dead': 1})
+    time.sleep(0.1)
+    assert recorder.attempts == {'prompt': 3} and recorder.sent == []
+
+
+def test_rate_limited_workers_never_send_twice(make_queue):
+    recorder = Recorder()
+    # Waiting for a send token takes longer than the claim lease
+    queue = make_queue(recorder, num_workers=4, claim_lease_seconds=0.2, limiter=TokenBucket(10, capacity=1))
+    queue.enqueue_many([(f'+1415555010{i}', f'prompt {i}') for i in range(8)])
+    queue.start()
+    wait_until(lambda: len(recorder.sent) == 8)
+    time.sleep(0.3)
+    assert sorted(recorder.attempts.values()) == [1] * 8
@@ -0,0 +1,109 @@
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from fakes import FakeFirebaseAuth, FakeFirestore, Latency
+from storage import FirestoreRepository, SQLiteRepository, UserNotFoundError
+
+RECEIVED_AT = datetime(2026, 10, 18, 9, 30, tzinfo=timezone.utc)
+
+
+def mood_write(uid, date_str, emoji, received_at=RECEIVED_AT):
+    return uid, date_str, {'entry_date': date_str, 'emoji': emoji, 'text_response': f"{emoji} note", 'timestamp': received_at}
+
+
+@pytest.fixture
+def sqlite_repository(tmp_path):
+    return SQLiteRepository(str(tmp_path / 'mood.sqlite3'))
+
+
+@pytest.fixture(params=['sqlite', 'firestore'])
+def repository(request, tmp_path):
+    if request.param == 'sqlite':
+        return SQLiteRepository(str(tmp_path / 'mood.sqlite3'))
+    return FirestoreRepository(FakeFirestore(latency=Latency(1)), FakeFirebaseAuth())
+
+
+def subscribed_user(repository, phone_number='+14155550100'):
+    uid = repository.create_user_for_phone(phone_number)
+    repository.subscribe_user(uid, phone_number)
+    return uid
+
+
+# --- SQLite round trips ---
+
+def test_user_round_trip(sqlite_repository):
+    uid = subscribed_user(sqlite_repository)
+    assert sqlite_repository.get_uid_by_phone('+14155550100') == uid
+    assert sqlite_repository.get_user(uid)['is_subscribed'] is True
+    with pytest.raises(UserNotFoundError):
+        sqlite_repository.get_uid_by_phone('+14155550199')
+
+    sqlite_repository.set_subscription(uid, False)
+    assert sqlite_repository.get_user(uid)['is_subscribed'] is False
+    assert list(sqlite_repository.iter_subscribed_users()) == []
+    sqlite_repository.set_subscription(uid, True)
+    assert list(sqlite_repository.iter_subscribed_users()) == [(uid, '+14155550100')]
+
+
+def test_entry_round_trip(sqlite_repository):
+    uid = subscribed_user(sqlite_repository)
+    sqlite_repository.write_mood_entries([mood_write(uid, '2026-10-01', '😊'), mood_write(uid, '2026-10-03', '😢'),
+                                          mood_write(uid, '2026-11-02', '😡')])
+
+    entry = sqlite_repository.get_entry(uid, '2026-10-01')
+    assert (entry['emoji'], entry['text_response'], entry['entry_date']) == ('😊', '😊 note', '2026-10-01')
+    assert datetime.fromisoformat(entry['timestamp']) == RECEIVED_AT
+    assert sqlite_repository.get_entry(uid, '2026-10-02') is None
+    assert set(sqlite_repository.get_entries(uid, ['2026-10-01', '2026-10-02', '2026-10-03'])) == {'2026-10-01', '2026-10-03'}
+    assert [date_str for date_str, _ in sqlite_repository.iter_entries(uid)] == ['2026-10-01', '2026-10-03', '2026-11-02']
+
+    first_page, cursor = sqlite_repository.list_entries(uid, '2026-10-01', '2026-11-30', limit=2)
+    assert list(first_page) == ['2026-10-01', '2026-10-03'] and cursor == '2026-10-03'
+    second_page, cursor = sqlite_repository.list_entries(uid, '2026-10-01', '2026-11-30', cursor=cursor, limit=2)
+    assert list(second_page) == ['2026-11-02'] and cursor is None
+
+
+def test_rollups_follow_the_entries(sqlite_repository):
+    uid = subscribed_user(sqlite_repository)
+    sqlite_repository.write_mood_entries([mood_write(uid, '2026-10-01', '😊'), mood_write(uid, '2026-10-03', '😢')])
+    sqlite_repository.write_mood_entries([mood_write(uid, '2026-10-03', '😡', RECEIVED_AT + timedelta(minutes=1))])
+
+    rollup = sqlite_repository.get_month_rollup(uid, '2026-10')
+    assert rollup['days'] == {'2026-10-01': '😊', '2026-10-03': '😡'}
+    assert sqlite_repository.get_entry(uid, '2026-10-03')['version'] == rollup['version']
+    assert sqlite_repository.get_month_rollup(uid, '2026-11') is None
+
+
+# --- Concurrent writes (both backends) ---
+
+def test_concurrent_writes_to_one_month_keep_every_day(repository):
+    uid = subscribed_user(repository)
+    threads = [threading.Thread(target=repository.write_mood_entries, args=([mood_write(uid, f'2026-10-{day:02d}', '😊')],))
+               for day in range(1, 21)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(repository.get_month_rollup(uid, '2026-10')['days']) == [f'2026-10-{day:02d}' for day in range(1, 21)]
+
+
+def test_older_write_does_not_overwrite_a_newer_entry(repository):
+    uid = subscribed_user(repository)
+    repository.write_mood_entries([mood_write(uid, '2026-10-05', '😊', RECEIVED_AT)])
+    repository.write_mood_entries([mood_write(uid, '2026-10-05', '😢', RECEIVED_AT - timedelta(minutes=5))])
+    assert repository.get_entry(uid, '2026-10-05')['emoji'] == '😊'
+    assert repository.get_month_rollup(uid, '2026-10')['days'] == {'2026-10-05': '😊'}
+
+    # Within one batch the newest write wins, whatever its position
+    repository.write_mood_entries([mood_write(uid, '2026-10-05', '😡', RECEIVED_AT + timedelta(minutes=5)),
+                                   mood_write(uid, '2026-10-05', '😴', RECEIVED_AT + timedelta(minutes=1))])
+    assert repository.get_entry(uid, '2026-10-05')['emoji'] == '😡'
+
+
+def test_merge_month_rollups_keeps_days_written_meanwhile(repository):
+    uid = subscribed_user(repository)
+    repository.write_mood_entries([mood_write(uid, '2026-10-01', '😊')])
+    repository.merge_month_rollups({(uid, '2026-10'): {'days': {'2026-10-01': '😢', '2026-10-02': '😡'}}})
+    assert repository.get_month_rollup(uid, '2026-10')['days'] == {'2026-10-01': '😊', '2026-10-02': '😡'}
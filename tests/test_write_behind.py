@@ -0,0 +1,103 @@
+import json
+import threading
+import time
+
+import pytest
+
+from write_behind import SQLiteSpool, WriteBehindBuffer
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() >= deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+class Store:
+    """flush_func that writes items to a list, or hands them all back while 'failing' is set."""
+
+    def __init__(self, failing=False):
+        self.failing = failing
+        self.written = []
+        self._lock = threading.Lock()
+
+    def __call__(self, items):
+        if self.failing:
+            return items
+        with self._lock:
+            self.written.extend(items)
+        return []
+
+
+@pytest.fixture
+def make_spool(tmp_path):
+    def make(**kwargs):
+        kwargs = dict(dict(backoff_seconds=0.01, backoff_max_seconds=0.05), **kwargs)
+        return SQLiteSpool(str(tmp_path / 'spool.sqlite3'), json.dumps, json.loads, **kwargs)
+    return make
+
+
+def make_buffer(store, spool, **kwargs):
+    return WriteBehindBuffer(store, batch_size=10, flush_interval_seconds=0.02, spool=spool, **kwargs)
+
+
+def test_failed_writes_are_spooled_and_replayed(make_spool):
+    store = Store(failing=True)
+    spool = make_spool()
+    buffer = make_buffer(store, spool)
+    for i in range(5):
+        assert buffer.submit(['item', i])
+    wait_until(lambda: spool.stats() == {'pending': 5})
+
+    store.failing = False
+    wait_until(lambda: spool.stats() == {})
+    buffer.drain()
+    assert sorted(store.written) == [['item', i] for i in range(5)]
+
+
+def test_spooled_items_are_replayed_after_a_restart(make_spool):
+    failing_buffer = make_buffer(Store(failing=True), make_spool(backoff_seconds=60))
+    failing_buffer.submit(['item', 1])
+    failing_buffer.drain()
+    assert failing_buffer.spool.stats() == {'pending': 1}
+
+    store = Store()
+    # The next process's spool, with its retry due now
+    spool = make_spool(backoff_seconds=0.01)
+    spool._conn().execute("UPDATE spooled_items SET next_attempt_at = 0")
+    buffer = make_buffer(store, spool)
+    wait_until(lambda: store.written == [['item', 1]])
+    buffer.drain()
+    assert spool.stats() == {}
+
+
+def test_items_that_keep_failing_are_marked_dead(make_spool):
+    spool = make_spool(max_attempts=3)
+    buffer = make_buffer(Store(failing=True), spool)
+    buffer.submit(['item', 1])
+    wait_until(lambda: spool.stats() == {'dead': 1})
+    buffer.drain()
+
+
+def test_submit_or_spool_spools_when_the_buffer_is_full(make_spool):
+    release = threading.Event()
+    store = Store()
+
+    def blocked_flush(items):
+        release.wait()
+        return store(items)
+
+    spool = make_spool()
+    buffer = WriteBehindBuffer(blocked_flush, max_items=1, batch_size=1, flush_interval_seconds=0.02, spool=spool)
+    buffer.submit(['item', 1])
+    wait_until(lambda: buffer.qsize() == 0) # The writer holds item 1
+    assert buffer.submit_or_spool(['item', 2]) # Fills the buffer
+    assert buffer.submit_or_spool(['item', 3]) # Goes to the spool
+    assert spool.stats() == {'pending': 1}
+
+    release.set()
+    wait_until(lambda: len(store.written) == 3)
+    buffer.drain()
+    assert sorted(store.written) == [['item', 1], ['item', 2], ['item', 3]]
@@ -0,0 +1,260 @@
+import atexit
+import logging
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """
+    Bounded in-memory buffer drained by one background thread. Items are handed to
+    `flush_func(items)` in groups of up to `batch_size`, or whatever has arrived after
+    `flush_interval_seconds`, whichever comes first. flush_func returns the items it could not
+    write (or None if it wrote them all); if it raises, the whole group counts as not written.
+
+    Items that weren't written go to `spool` (a SQLiteSpool) and are retried from there with
+    backoff, by this process or, after a restart, the next one. Without a spool they are logged
+    and dropped.
+
+    submit() blocks for at most `timeout` seconds when the buffer is full and returns False
+    if there is still no room, so callers can push back instead of buffering without bound.
+    drain() flushes everything still buffered; it is registered with atexit so a normal
+    shutdown or restart loses nothing.
+    """
+
+    def __init__(self, flush_func, max_items=10000, batch_size=200, flush_interval_seconds=1.0,
+                 name="write-behind", spool=None):
+        self.flush_func = flush_func
+        self.batch_size = max(1, batch_size)
+        self.flush_interval_seconds = flush_interval_seconds
+        self.name = name
+        self.spool = spool
+        self._queue = queue.Queue(maxsize=max_items)
+        self._accepting = True
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        atexit.register(self.drain)
+
+    def submit(self, item, timeout=0.0):
+        """Buffers one item. Returns False if the buffer is closed or stayed full for 'timeout' seconds."""
+        if not self._accepting:
+            return False
+        try:
+            self._queue.put(item, timeout=timeout) if timeout else self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            return False
+
+    def submit_or_spool(self, item):
+        """
+        Buffers one item without waiting, or, if the buffer is full, spools it for the writer to
+        retry. Returns False only if it could do neither.
+        """
+        if self.submit(item):
+            return True
+        if self.spool is None:
+            return False
+        try:
+            self.spool.add([item])
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"{self.name}: Could not spool an item: {e}: {item}")
+            return False
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def _take_batch(self):
+        """Waits for the first item, then collects more until the batch is full or the interval passes."""
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval_seconds)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval_seconds
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        """Hands 'batch' to flush_func. Returns the items that weren't written."""
+        try:
+            return list(self.flush_func(batch) or [])
+        except Exception as e:
+            logger.error(f"{self.name}: Failed to flush {len(batch)} item(s): {e}", exc_info=True)
+            return batch
+
+    def _flush(self, batch):
+        unwritten = self._write(batch)
+        if unwritten:
+            self._spill(unwritten)
+
+    def _spill(self, items):
+        if self.spool is None:
+            logger.error(f"{self.name}: Dropping {len(items)} unwritten item(s): {items}")
+            return
+        try:
+            self.spool.add(items)
+            logger.warning(f"{self.name}: Spooled {len(items)} unwritten item(s) for retry.")
+        except sqlite3.Error as e:
+            logger.error(f"{self.name}: Could not spool {len(items)} item(s), dropping them: {e}: {items}")
+
+    def _retry_spooled(self):
+        """Retries the spooled items that are due, one batch at a time."""
+        while not self._stopping.is_set():
+            try:
+                claimed = self.spool.claim_due(self.batch_size)
+            except sqlite3.Error as e:
+                logger.error(f"{self.name}: Error reading the spool: {e}")
+                return
+            if not claimed:
+                return
+            unwritten = self._write([item for _, item in claimed])
+            try:
+                self.spool.record_results(claimed, unwritten)
+            except sqlite3.Error as e:
+                logger.error(f"{self.name}: Error updating the spool: {e}")
+
+    def _run(self):
+        next_spool_check = 0.0
+        while not self._stopping.is_set():
+            batch = self._take_batch()
+            if batch:
+                self._flush(batch)
+            if self.spool is not None and time.monotonic() >= next_spool_check:
+                self._retry_spooled()
+                next_spool_check = time.monotonic() + self.flush_interval_seconds
+
+    def drain(self, timeout=30.0):
+        """
+        Stops accepting items and flushes everything still buffered (or spools it, if the writer is
+        still stuck in a flush after 'timeout' seconds). Safe to call more than once.
+        """
+        self._accepting = False
+        self._stopping.set()
+        self._thread.join(timeout)
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if not batch:
+            return
+        if self._thread.is_alive():
+            # Still inside a slow flush: writing alongside it could reorder or duplicate writes, so
+            # leave the rest to the spool (this process is about to exit).
+            logger.warning(f"{self.name}: Writer still busy after {timeout:.0f}s; spooling {len(batch)} buffered item(s).")
+            self._spill(batch)
+            return
+        for start in range(0, len(batch), self.batch_size):
+            self._flush(batch[start:start + self.batch_size])
+
+
+class SQLiteSpool:
+    """
+    Durable retry spool for a WriteBehindBuffer: items are stored in a local SQLite file (via
+    `encode`/`decode`, to and from text) and retried with exponential backoff. Processes that
+    share the file take turns through short claim leases. Items that exhaust their attempts are
+    kept with status 'dead' for inspection. A retried item can land after items submitted later,
+    so only spool items whose writes are safe to reorder.
+    """
+
+    def __init__(self, path, encode, decode, max_attempts=10, backoff_seconds=2.0, backoff_max_seconds=300.0,
+                 claim_lease_seconds=120.0):
+        self.path = path
+        self.encode = encode
+        self.decode = decode
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.claim_lease_seconds = claim_lease_seconds
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS spooled_items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                item TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',  -- pending | dead
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_spooled_items_due ON spooled_items (status, next_attempt_at);
+        """)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _backoff(self, attempts):
+        delay = min(self.backoff_max_seconds, self.backoff_seconds * (2 ** max(0, attempts - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    def add(self, items):
+        """Spools items for their first retry."""
+        rows = [(self.encode(item), time.time() + self._backoff(1)) for item in items]
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany("INSERT INTO spooled_items (item, attempts, next_attempt_at) VALUES (?, 1, ?)", rows)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def claim_due(self, limit):
+        """Returns up to 'limit' due (id, item) pairs, leased to this caller until their results are recorded."""
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute("SELECT id, item FROM spooled_items WHERE status = 'pending' AND next_attempt_at <= ? "
+                                "ORDER BY id LIMIT ?", (now, limit)).fetchall()
+            conn.executemany("UPDATE spooled_items SET next_attempt_at = ? WHERE id = ?",
+                             [(now + self.claim_lease_seconds, row_id) for row_id, _ in rows])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return [(row_id, self.decode(item)) for row_id, item in rows]
+
+    def record_results(self, claimed, unwritten):
+        """Deletes the claimed items that were written; schedules the 'unwritten' ones again (or marks them dead)."""
+        unwritten_ids = {id(item) for item in unwritten} # flush_func hands back the very objects it was given
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            for row_id, item in claimed:
+                if id(item) not in unwritten_ids:
+                    conn.execute("DELETE FROM spooled_items WHERE id = ?", (row_id,))
+                    continue
+                attempts = conn.execute("SELECT attempts FROM spooled_items WHERE id = ?", (row_id,)).fetchone()[0] + 1
+                if attempts >= self.max_attempts:
+                    conn.execute("UPDATE spooled_items SET status = 'dead', attempts = ? WHERE id = ?", (attempts, row_id))
+                    logger.error(f"Spool: Giving up on item {row_id} after {attempts} attempts: {item}")
+                else:
+                    conn.execute("UPDATE spooled_items SET attempts = ?, next_attempt_at = ? WHERE id = ?",
+                                 (attempts, time.time() + self._backoff(attempts), row_id))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def stats(self):
+        """Returns item counts by status, e.g. {'pending': 3, 'dead': 1}."""
+        return dict(self._conn().execute("SELECT status, COUNT(*) FROM spooled_items GROUP BY status").fetchall())